@@ -1,34 +1,64 @@
 import asyncio
-import sqlalchemy
 import signal
 import sys
 
 from crawler.region import RegionCrawler
 from crawler.corporate import CorporateCrawler
-from crawler.common import config
+from crawler.common import config, logger
+from crawler.frontier import Frontier
+from crawler.storage import create_storage_engine
+from crawler.work_queue import WorkQueue
+from crawler.distributed import crawl_distributed
 
 
-def sigint_handler(*args):
-    config.remove_all_gateways()
-    sys.exit(1)
+def install_signal_handlers(task: asyncio.Task):
+    # The first signal cancels the crawl so that gateways are released in
+    # the cleanup below, a second one ends the process right away
+    loop = asyncio.get_running_loop()
 
+    def handle(signum: signal.Signals):
+        logger.warning(f"Received {signum.name}, shutting down")
+        for other in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(other)
+        task.cancel()
 
-signal.signal(signal.SIGINT, sigint_handler)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, handle, signum)
 
 
 async def main():
-    for _ in range(8):
-        config.new_gateway()
+    install_signal_handlers(asyncio.current_task())
+    await config.metrics.start()
+    await config.progress_reporter.start()
 
     config.output_path.mkdir(exist_ok=True)
-    storage_engine = sqlalchemy.create_engine(config.db_url)
+    storage_engine = create_storage_engine(config.db_url)
 
-    crawler = RegionCrawler(storage_engine)
-    await crawler.crawl()
+    # Nodes of a distributed crawl share the frontier, it is never reset
+    frontier = Frontier(storage_engine, resume=config.resume or config.distributed)
 
-    crawler = CorporateCrawler(storage_engine)
-    await crawler.crawl()
+    try:
+        await config.start_egress()
+        if config.distributed:
+            work_queue = WorkQueue(storage_engine, config.node_id, config.lease_seconds)
+            await crawl_distributed(storage_engine, frontier, work_queue)
+        else:
+            # Corporates of a ward are crawled as soon as the ward is found
+            region_crawler = RegionCrawler(storage_engine, frontier)
+            corporate_crawler = CorporateCrawler(storage_engine, frontier)
+            await corporate_crawler.crawl(region_crawler.crawl_wards())
+    finally:
+        await config.progress_reporter.stop()
+        await config.close_egress()
+        await config.close_connector()
+        config.parser.close()
+        if config.archive != None:
+            config.archive.close()
+        await config.metrics.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        sys.exit(1)
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import timedelta
+
+import aiohttp
+import sqlalchemy
+from sqlalchemy.orm import Session as SqlSession
+
+from crawler.archive import ResponseArchive
+from crawler.common import config, logger
+from crawler.corporate import Corporate, CorporateCrawler
+from crawler.frontier import Frontier
+from crawler.metrics import registry
+from crawler.egress import DirectEgress, GatewayEgress, ProxyEgress, StaticEgress
+from crawler.gateway_pool import GatewayPool
+from crawler.ratelimit import RateLimiter
+from crawler.region import Region, RegionCrawler
+from crawler.reparse import Reparser
+from crawler.storage import create_storage_engine
+
+from .server import SiteSpec, run_server
+from .stubs import StubGatewayProvider
+
+
+class LatencyTracer:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self.on_request_start)
+        self.trace_config.on_request_end.append(self.on_request_end)
+        self.connections = 0
+        self.trace_config.on_connection_create_end.append(self.on_connection_create_end)
+
+    async def on_request_start(self, session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(self, session, context, params):
+        self.latencies.append(time.perf_counter() - context.start)
+
+    async def on_connection_create_end(self, session, context, params):
+        self.connections += 1
+
+    def percentile(self, q: float) -> float:
+        if len(self.latencies) == 0:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def start_server(spec: SiteSpec) -> tuple[multiprocessing.Process, int]:
+    # The stand-in server runs in its own process so it does not compete with
+    # the crawler for the event loop
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    process = context.Process(target=run_server, args=(spec, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+
+async def timed_wards(wards, timings: dict):
+    # Regions and corporates are crawled together, note when wards arrive
+    async for ward in wards:
+        timings.setdefault("first_ward_at", time.perf_counter())
+        yield ward
+    timings["regions_done_at"] = time.perf_counter()
+
+
+async def fetch_stats(host: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://{host}/__stats") as resp:
+            return await resp.json()
+
+
+def count_rows(engine: sqlalchemy.Engine) -> dict[str, int]:
+    with SqlSession(engine) as session:
+        return {
+            "regions": session.query(Region).count(),
+            "corporates": session.query(Corporate).count(),
+        }
+
+
+def count_without_region(engine: sqlalchemy.Engine) -> int:
+    with SqlSession(engine) as session:
+        return session.query(Corporate).where(Corporate.region_id == None).count()
+
+
+def new_egress(backend: str, host: str, routes: int):
+    if backend == "gateway":
+        pool = GatewayPool(config.source_uri, routes, 0, factory=StubGatewayProvider(host),
+                           idle_timeout=config.keepalive_seconds)
+        return GatewayEgress(pool, "http")
+    if backend == "proxy":
+        # Requests to an unresolvable origin only arrive through the proxies
+        proxies = [f"http://proxy{i}@{host}" for i in range(routes)]
+        return ProxyEgress(proxies, "http://origin.invalid/proxied")
+    if backend == "static":
+        return StaticEgress.from_urls([f"http://{host}/static{i}" for i in range(routes)])
+    return DirectEgress(f"http://{host}/direct")
+
+
+async def run(args) -> dict:
+    spec = SiteSpec(provinces=args.provinces, districts=args.districts, wards=args.wards,
+                    corporates=args.corporates, latency=args.latency / 1000,
+                    error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    process, port = start_server(spec)
+    host = f"127.0.0.1:{port}"
+
+    # Point the crawler at the stand-in server through stub gateways, or
+    # through the egress backend under test. Each route is a path prefix
+    # of the server, which also serves as the HTTP proxy.
+    config.egress = new_egress(args.egress, host, args.gateways)
+    # Routes share the host of the server, so a per-host limit would cap
+    # every route together
+    config.connections_per_host = 0
+    config.rate_limiter = RateLimiter(args.rate, args.rate / 8, args.rate * 4)
+    tracer = LatencyTracer()
+    config.trace_configs = [tracer.trace_config]
+    if args.sitemap:
+        config.discovery = "sitemap"
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        engine = create_storage_engine(f"sqlite:///{pathlib.Path(tmp_path) / 'benchmark.db'}")
+        frontier = Frontier(engine, resume=False)
+        if args.archive:
+            config.archive = ResponseArchive(pathlib.Path(tmp_path) / "archive")
+        await config.start_egress()
+        incremental = {}
+        rerun = {}
+        archive = {}
+
+        try:
+            started_at = time.perf_counter()
+            timings = {}
+            wards = timed_wards(RegionCrawler(engine, frontier).crawl_wards(), timings)
+            await CorporateCrawler(engine, frontier).crawl(wards)
+            finished_at = time.perf_counter()
+            server_stats = await fetch_stats(host)
+            requests = len(tracer.latencies)
+            latency_p50, latency_p99 = tracer.percentile(0.50), tracer.percentile(0.99)
+
+            if args.rerun:
+                # Full second pass over the same site and the full database,
+                # known tax IDs are skipped before their detail pages
+                frontier.reset()
+                rerun_requests = len(tracer.latencies)
+                rerun_started_at = time.perf_counter()
+                await CorporateCrawler(engine, frontier).crawl()
+                rerun = {
+                    "rerun_crawl_sec": round(time.perf_counter() - rerun_started_at, 3),
+                    "rerun_requests": len(tracer.latencies) - rerun_requests,
+                }
+            if args.incremental:
+                # Second pass over the same site, every detail page is due
+                config.incremental = True
+                config.recrawl_interval = timedelta(0)
+                frontier.reset()
+                incremental_requests = len(tracer.latencies)
+                incremental_started_at = time.perf_counter()
+                await CorporateCrawler(engine, frontier).crawl()
+                incremental_stats = await fetch_stats(host)
+                incremental = {
+                    "incremental_crawl_sec": round(time.perf_counter() - incremental_started_at, 3),
+                    "incremental_requests": len(tracer.latencies) - incremental_requests,
+                    "incremental_not_modified": incremental_stats["not_modified"],
+                }
+            if args.archive:
+                # Rebuild both tables from the archive into a fresh database
+                config.archive.flush()
+                reparse_engine = create_storage_engine(f"sqlite:///{pathlib.Path(tmp_path) / 'reparse.db'}")
+                reparse_started_at = time.perf_counter()
+                await Reparser(config.archive, reparse_engine).reparse()
+                reparse_sec = time.perf_counter() - reparse_started_at
+                reparse_rows = count_rows(reparse_engine)
+                archive_bytes = sum(file.stat().st_size for file in config.archive.path.glob("segment-*"))
+                archive = {
+                    "archive_mb": round(archive_bytes / 1024 / 1024, 2),
+                    "reparse_sec": round(reparse_sec, 3),
+                    "reparse_rows": reparse_rows,
+                    "reparse_rows_per_sec": round(sum(reparse_rows.values()) / reparse_sec, 1),
+                    "reparse_without_region": count_without_region(reparse_engine),
+                }
+        finally:
+            await config.close_egress()
+            await config.close_connector()
+            config.parser.close()
+            if config.archive != None:
+                config.archive.close()
+
+        process.terminate()
+
+        rows = count_rows(engine)
+        without_region = count_without_region(engine)
+
+    elapsed = finished_at - started_at
+    return {
+        "spec": asdict(spec),
+        "elapsed_sec": round(elapsed, 3),
+        "first_ward_sec": round(timings["first_ward_at"] - started_at, 3),
+        "region_crawl_sec": round(timings["regions_done_at"] - started_at, 3),
+        "requests": requests,
+        "connections_opened": tracer.connections,
+        "pages_served": server_stats["pages"],
+        "pages_per_sec": round(server_stats["pages"] / elapsed, 1),
+        "latency_p50_ms": round(latency_p50 * 1000, 1),
+        "latency_p99_ms": round(latency_p99 * 1000, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rows": rows,
+        "rows_per_sec": round(sum(rows.values()) / elapsed, 1),
+        "expected_corporates": spec.provinces * spec.districts * spec.wards * spec.corporates,
+        "discovery": config.discovery,
+        "egress": args.egress,
+        "corporates_without_region": without_region,
+        **rerun,
+        **incremental,
+        **archive,
+        **({"metrics": registry.summary().splitlines()} if args.metrics else {}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run both crawlers against a local stand-in of the origin")
+    parser.add_argument("--provinces", type=int, default=2)
+    parser.add_argument("--districts", type=int, default=3)
+    parser.add_argument("--wards", type=int, default=4)
+    parser.add_argument("--corporates", type=int, default=50, help="corporates per ward")
+    parser.add_argument("--latency", type=float, default=20, help="mean origin latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of 503 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability of 429 responses")
+    parser.add_argument("--gateways", type=int, default=8, help="gateways, proxies or static routes")
+    parser.add_argument("--egress", choices=["gateway", "proxy", "direct", "static"], default="gateway")
+    parser.add_argument("--rate", type=float, default=50, help="initial requests/sec per route")
+    parser.add_argument("--sitemap", action="store_true", help="discover corporates from the sitemaps")
+    parser.add_argument("--rerun", action="store_true", help="run a second, full corporate crawl")
+    parser.add_argument("--incremental", action="store_true", help="run a second, incremental corporate crawl")
+    parser.add_argument("--archive", action="store_true", help="archive responses and reparse them afterwards")
+    parser.add_argument("--metrics", action="store_true", help="include the metrics summary")
+    parser.add_argument("--output", type=pathlib.Path, help="write the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="log progress and per-record messages")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "WARNING")
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output != None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
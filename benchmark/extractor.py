@@ -0,0 +1,79 @@
+import argparse
+import pathlib
+import time
+
+from lxml import etree
+
+from crawler.parser import corporate_extractor, parse_html
+from .pages import detail_page
+
+# Separate absolute queries used before the compiled extractor, kept as the
+# baseline of this benchmark
+LEGACY_XPATH_QUERIES = {
+    "tax_id": '//table[@class = "table-taxinfo"]//td[@itemprop="taxID"]/span/text()',
+    "name": '//table[@class = "table-taxinfo"]//th[@itemprop="name"]/span/text()',
+    "international_name": '//table[@class = "table-taxinfo"]//i[contains(@class, "fa-globe")]/parent::td/following-sibling::td[@itemprop="alternateName"]/span/text()',
+    "short_name": '//table[@class = "table-taxinfo"]//i[contains(@class, "fa-reorder")]/parent::td/following-sibling::td[@itemprop="alternateName"]/span/text()',
+    "representative": '//table[@class = "table-taxinfo"]//td/span[@itemprop="name"]/a/text()',
+    "company_type": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-building")]/parent::td/following-sibling::td/a/text()',
+    "industry": '//h3[contains(text(), "Ngành nghề kinh doanh")]//following-sibling::table//td/strong/a/text()',
+    "address": '//table[@class = "table-taxinfo"]//td[@itemprop="address"]/span/text()',
+    "phone": '//table[@class = "table-taxinfo"]//td[@itemprop="telephone"]/span/text()',
+    "active_date": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-calendar")]/parent::td/following-sibling::td/span/text()',
+    "status": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-info")]/parent::td/following-sibling::td/a/text()',
+    "last_update": '//table[@class = "table-taxinfo"]//button[@data-target = "#modal-update"]/preceding-sibling::em/text()',
+}
+
+
+def legacy_extract(document: etree._Element) -> dict[str, str]:
+    fields = {}
+    for field_name, query in LEGACY_XPATH_QUERIES.items():
+        results = document.xpath(query)
+        if len(results) != 0:
+            fields[field_name] = " ".join(str(result) for result in results)
+    return fields
+
+
+def load_pages(path: pathlib.Path, count: int) -> list[bytes]:
+    if path != None:
+        return [file.read_bytes() for file in sorted(path.glob("*.htm*"))]
+    return [detail_page(f"{100000000 + i:010d}").encode() for i in range(count)]
+
+
+def measure(extract, documents: list, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for document in documents:
+            extract(document)
+    return (time.perf_counter() - start) / (rounds * len(documents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare corporate detail page extractors")
+    parser.add_argument("pages", nargs="?", type=pathlib.Path,
+                        help="directory of saved detail pages, synthetic pages are used if omitted")
+    parser.add_argument("--count", type=int, default=200, help="number of synthetic pages")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages, args.count)
+    documents = [parse_html(page) for page in pages]
+    if len(documents) == 0:
+        raise SystemExit(f"No pages found in {args.pages}")
+
+    mismatches = sum(
+        legacy_extract(document) != corporate_extractor.extract(document)
+        for document in documents
+    )
+
+    legacy = measure(legacy_extract, documents, args.rounds)
+    compiled = measure(corporate_extractor.extract, documents, args.rounds)
+    print(f"pages:      {len(documents)}")
+    print(f"mismatches: {mismatches}")
+    print(f"legacy:     {legacy * 1e6:.1f} us/page")
+    print(f"compiled:   {compiled * 1e6:.1f} us/page")
+    print(f"speedup:    {legacy / compiled:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import random
+
+# Synthetic pages which mimic the markup of masothue.com closely enough for
+# the crawler's selectors
+
+_layout = """<!DOCTYPE html>
+<html lang="vi">
+<head><meta charset="utf-8"><title>{title}</title>{scripts}</head>
+<body>
+<header><nav><ul>{menu}</ul></nav></header>
+<main>{content}</main>
+<aside id="sidebar-right"><ul>{menu}</ul></aside>
+<footer>{footer}</footer>
+</body>
+</html>"""
+
+_names = ["AN PHÁT", "BÌNH MINH", "HOÀNG GIA", "ĐẠI VIỆT", "THÀNH CÔNG", "PHÚ QUÝ", "SAO MAI", "TÂN TIẾN"]
+_industries = ["Bán buôn thực phẩm", "Xây dựng nhà các loại", "Vận tải hàng hóa bằng đường bộ",
+               "Hoạt động tư vấn quản lý", "Lập trình máy vi tính", "Bán lẻ lương thực"]
+
+
+def layout(title: str, content: str, noise: int = 40) -> str:
+    # Navigation, scripts and footer make pages as heavy as real ones
+    menu = "".join(
+        f'<li><a href="/tra-cuu-ma-so-thue-theo-nganh-nghe/{i}">Ngành nghề {i}</a></li>'
+        for i in range(noise)
+    )
+    scripts = "".join(f"<script>var v{i} = {i};</script>" for i in range(noise // 4))
+    footer = "".join(f"<p>Thông tin liên hệ {i}</p>" for i in range(noise // 2))
+    return _layout.format(title=title, scripts=scripts, menu=menu,
+                          content=content, footer=footer)
+
+
+def corporate_name(tax_id: str) -> str:
+    rng = random.Random(tax_id)
+    return f"CÔNG TY TNHH {rng.choice(_names)} {tax_id[-4:]}"
+
+
+def detail_page(tax_id: str, address: str = "Phường Tràng Tiền, Quận Hoàn Kiếm, Thành phố Hà Nội",
+                noise: int = 40) -> str:
+    rng = random.Random(tax_id)
+    name = corporate_name(tax_id)
+    industries = "".join(
+        f'<tr><td><strong><a href="/tra-cuu-ma-so-thue-theo-nganh-nghe/{i}">{industry}</a></strong></td></tr>'
+        for i, industry in enumerate(rng.sample(_industries, 1))
+    )
+    content = f"""
+<div class="container">
+<table class="table-taxinfo" width="100%">
+<thead><tr><th itemprop="name" colspan="2"><span class="copy">{name}</span></th></tr></thead>
+<tbody>
+<tr><td><i class="fa fa-hashtag"></i> Mã số thuế</td><td itemprop="taxID"><span class="copy">{tax_id}</span></td></tr>
+<tr><td><i class="fa fa-globe"></i> Tên quốc tế</td><td itemprop="alternateName"><span class="copy">{rng.choice(_names)} COMPANY LIMITED</span></td></tr>
+<tr><td><i class="fa fa-reorder"></i> Tên viết tắt</td><td itemprop="alternateName"><span class="copy">{rng.choice(_names)} CO., LTD</span></td></tr>
+<tr><td><i class="fa fa-map-marker"></i> Địa chỉ</td><td itemprop="address"><span class="copy">Số {rng.randint(1, 200)}, {address}</span></td></tr>
+<tr><td><i class="fa fa-user"></i> Người đại diện</td><td><span itemprop="name"><a href="/legal/{tax_id}">NGUYỄN VĂN {rng.choice(_names)}</a></span></td></tr>
+<tr><td><i class="fa fa-phone"></i> Điện thoại</td><td itemprop="telephone"><span class="copy">024{rng.randint(1000000, 9999999)}</span></td></tr>
+<tr><td><i class="fa fa-calendar"></i> Ngày hoạt động</td><td><span class="copy">20{rng.randint(10, 23)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}</span></td></tr>
+<tr><td><i class="fa fa-users"></i> Quản lý bởi</td><td><span class="copy">Chi cục Thuế Quận Hoàn Kiếm</span></td></tr>
+<tr><td><i class="fa fa-building"></i> Loại hình DN</td><td><a href="/loai-hinh/1">Công ty trách nhiệm hữu hạn ngoài NN</a></td></tr>
+<tr><td><i class="fa fa-info"></i> Tình trạng</td><td><a href="/tinh-trang/1">Đang hoạt động (đã được cấp GCN ĐKT)</a></td></tr>
+<tr><td colspan="2"><em>Cập nhật mã số thuế {tax_id} lần cuối vào 2023-0{rng.randint(1, 9)}-1{rng.randint(0, 9)} 10:00:00.</em> <button data-target="#modal-update">Cập nhật</button></td></tr>
+</tbody>
+</table>
+<h3 class="h3">Ngành nghề kinh doanh</h3>
+<table class="table"><thead><tr><th>Mã</th><th>Ngành</th></tr></thead><tbody>{industries}</tbody></table>
+</div>"""
+    return layout(name, content, noise)
+
+
+def sidebar_page(title: str, children: list[tuple[str, str]], noise: int = 40) -> str:
+    # children are (url, name) of the sub-regions
+    items = "".join(f'<li><a href="{url}">{name}</a></li>' for url, name in children)
+    content = f'<div id="sidebar"><h3>{title}</h3><ul>{items}</ul></div>'
+    return layout(title, content, noise)
+
+
+def search_page(title: str, results: list[tuple[str, str]], page: int, max_page: int,
+                noise: int = 40) -> str:
+    # results are (url, name) of corporates, the pager shows a window of pages
+    # around the current one like the origin does
+    listing = "".join(
+        f'<div data-prefetch="{url}"><h3><a href="{url}">{name}</a></h3>'
+        f'<div><i class="fa fa-hashtag"></i> Mã số thuế: <a href="{url}">{url[1:].split("-")[0]}</a></div></div>'
+        for url, name in results
+    )
+    window = range(max(1, page - 2), min(max_page, page + 2) + 1)
+    pager = "".join(
+        f'<li><span class="page-numbers current">{i}</span></li>' if i == page
+        else f'<li><a class="page-numbers" href="?page={i}">{i}</a></li>'
+        for i in window
+    )
+    content = (
+        f'<div class="tax-listing">{listing}</div>'
+        f'<ul class="page-numbers">{pager}</ul>'
+    )
+    return layout(title, content, noise)
+
+
+def sitemap_index(paths: list[str]) -> str:
+    entries = "".join(f"<sitemap><loc>https://masothue.com{path}</loc></sitemap>" for path in paths)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</sitemapindex>'
+    )
+
+
+def sitemap_urlset(urls: list[str]) -> str:
+    entries = "".join(
+        f"<url><loc>https://masothue.com{url}</loc><lastmod>2023-01-01</lastmod></url>" for url in urls
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</urlset>'
+    )
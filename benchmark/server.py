@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import random
+from dataclasses import dataclass, asdict
+from typing import Union
+
+from aiohttp import web
+
+from . import pages
+
+
+@dataclass
+class SiteSpec:
+    provinces: int = 2
+    districts: int = 3
+    wards: int = 4
+    corporates: int = 50
+    page_size: int = 20
+    # Mean added response latency in seconds
+    latency: float = 0.02
+    # Probability of 503 and 429 responses
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    noise: int = 40
+    seed: int = 0
+    # Send ETags and answer conditional requests of detail pages
+    etags: bool = True
+    # Detail urls per child sitemap of /sitemap.xml
+    sitemap_size: int = 1000
+
+
+class StandInSite:
+    # Region ids are numeric like the origin: province "01", district "0102",
+    # ward "010203". Tax IDs are the ward id followed by a sequence number.
+    def __init__(self, spec: SiteSpec):
+        self.spec = spec
+        self.random = random.Random(spec.seed)
+        self.stats = {"requests": 0, "pages": 0, "not_modified": 0, "errors": 0, "throttled": 0}
+
+    @staticmethod
+    def region_url(level: int, region_id: str) -> str:
+        prefix = {1: "tinh", 2: "quan", 3: "phuong"}[level]
+        return f"/tra-cuu-ma-so-thue-theo-tinh/{prefix}-{region_id}"
+
+    def children(self, level: int, region_id: str) -> list[tuple[str, str]]:
+        count = {0: self.spec.provinces, 1: self.spec.districts, 2: self.spec.wards}[level]
+        names = {0: "Tỉnh", 1: "Quận", 2: "Phường"}[level]
+        return [
+            (self.region_url(level + 1, f"{region_id}{i:02d}"), f"{names} {region_id}{i:02d}")
+            for i in range(1, count + 1)
+        ]
+
+    def corporate_url(self, ward_id: str, index: int) -> str:
+        tax_id = f"{ward_id}{index:04d}"
+        return f"/{tax_id}-cong-ty-tnhh-{tax_id}"
+
+    def listing(self, ward_id: str, page: int) -> tuple[list[tuple[str, str]], int]:
+        max_page = max(1, -(-self.spec.corporates // self.spec.page_size))
+        start = (page - 1) * self.spec.page_size
+        end = min(start + self.spec.page_size, self.spec.corporates)
+        results = []
+        for index in range(start, end):
+            url = self.corporate_url(ward_id, index)
+            results.append((url, pages.corporate_name(url[1:11])))
+        return results, max_page
+
+    def ward_ids(self) -> list[str]:
+        return [
+            f"{province:02d}{district:02d}{ward:02d}"
+            for province in range(1, self.spec.provinces + 1)
+            for district in range(1, self.spec.districts + 1)
+            for ward in range(1, self.spec.wards + 1)
+        ]
+
+    def sitemap(self, path: str) -> Union[str, None]:
+        # An index of child sitemaps which list every detail url
+        urls = [self.corporate_url(ward_id, index)
+                for ward_id in self.ward_ids() for index in range(self.spec.corporates)]
+        size = self.spec.sitemap_size
+        if path == "sitemap.xml":
+            count = max(1, -(-len(urls) // size))
+            return pages.sitemap_index([f"/sitemap-companies-{i}.xml" for i in range(1, count + 1)])
+        number = path.removeprefix("sitemap-companies-").removesuffix(".xml")
+        if not number.isdigit():
+            return None
+        start = (int(number) - 1) * size
+        return pages.sitemap_urlset(urls[start:start + size])
+
+    @property
+    def total_pages(self) -> int:
+        spec = self.spec
+        wards = spec.provinces * spec.districts * spec.wards
+        search_pages = max(1, -(-spec.corporates // spec.page_size))
+        return (1 + spec.provinces + spec.provinces * spec.districts
+                + wards * search_pages + wards * spec.corporates)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        if self.spec.latency > 0:
+            await asyncio.sleep(self.random.expovariate(1.0 / self.spec.latency))
+
+        roll = self.random.random()
+        if roll < self.spec.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        if roll < self.spec.error_rate + self.spec.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.Response(status=429, text="Too Many Requests")
+
+        path = request.match_info["path"]
+        etag = self.etag(path)
+        if etag != None and request.headers.get("If-None-Match") == etag:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+
+        body = self.render(path, request.query)
+        if body == None:
+            return web.Response(status=404, text="Not Found")
+        self.stats["pages"] += 1
+        headers = {"ETag": etag} if etag != None else None
+        content_type = "application/xml" if path.endswith(".xml") else "text/html"
+        return web.Response(body=body.encode(), content_type=content_type,
+                            charset="utf-8", headers=headers)
+
+    def etag(self, path: str) -> str:
+        # Detail pages never change, so their validator is derived from the url
+        if self.spec.etags and path.split("-")[0].isdigit():
+            return f'"{hashlib.md5(path.encode()).hexdigest()}"'
+        return None
+
+    def render(self, path: str, query) -> str:
+        noise = self.spec.noise
+        if path == "":
+            return pages.sidebar_page("Tra cứu mã số thuế", self.children(0, ""), noise)
+        if path.startswith("sitemap"):
+            return self.sitemap(path)
+
+        if path.startswith("tra-cuu-ma-so-thue-theo-tinh/"):
+            prefix, region_id = path.split("/")[-1].split("-")
+            if prefix == "tinh":
+                return pages.sidebar_page(f"Tỉnh {region_id}", self.children(1, region_id), noise)
+            if prefix == "quan":
+                return pages.sidebar_page(f"Quận {region_id}", self.children(2, region_id), noise)
+            page = int(query.get("page", "1"))
+            results, max_page = self.listing(region_id, page)
+            return pages.search_page(f"Phường {region_id}", results, page, max_page, noise)
+
+        tax_id = path.split("-")[0]
+        if tax_id.isdigit():
+            # The address names the ward, district and province like the origin
+            address = f"Phường {tax_id[:6]}, Quận {tax_id[:4]}, Tỉnh {tax_id[:2]}"
+            return pages.detail_page(tax_id, address=address, noise=noise)
+        return None
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "spec": asdict(self.spec)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/__stats", self.handle_stats)
+        # The first path segment plays the role of an API Gateway stage
+        app.router.add_get("/{stage}/{path:.*}", self.handle)
+        return app
+
+
+async def serve(spec: SiteSpec, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+    runner = web.AppRunner(StandInSite(spec).app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def run_server(spec: SiteSpec, port_queue, host: str = "127.0.0.1"):
+    # Entry point of the server process, reports the bound port to the parent
+    async def main():
+        runner = await serve(spec, host)
+        port = runner.addresses[0][1]
+        port_queue.put(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+import itertools
+
+
+class StubGateway:
+    # Stands in for ApiGateway, each gateway is a path prefix on the local
+    # server just like the stage of a real API Gateway endpoint
+    _counter = itertools.count()
+
+    def __init__(self, host: str):
+        self.endpoint = f"{host}/gw{next(self._counter)}"
+
+    async def delete_api_gateway(self) -> bool:
+        return True
+
+
+class StubGatewayProvider:
+    def __init__(self, host: str):
+        self.host = host
+
+    def __call__(self, source_uri: str) -> StubGateway:
+        return StubGateway(self.host)
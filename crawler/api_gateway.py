@@ -1,8 +1,9 @@
 import asyncio
 import boto3
 import random
+from typing import Callable
 
-from .common import logger
+from loguru import logger
 
 ALL_REGIONS = [
     "us-east-1", "us-east-2", "us-west-1", "us-west-2",
@@ -13,9 +14,40 @@ ALL_REGIONS = [
     "sa-east-1"
 ]
 
+API_NAME = "corporate-info-crawler"
+
+
+def boto_client(region: str):
+    session = boto3.session.Session()
+    return session.client("apigateway", region_name=region)
+
+
+def list_apis(region: str, client_factory: Callable = boto_client) -> list[dict]:
+    # Every API of the crawler in the region, with its id, tags and
+    # creation date
+    awsclient = client_factory(region)
+    apis = []
+    position = None
+    while True:
+        kwargs = {"limit": 500}
+        if position != None:
+            kwargs["position"] = position
+        response = awsclient.get_rest_apis(**kwargs)
+        apis.extend(item for item in response.get("items", []) if item.get("name") == API_NAME)
+        position = response.get("position")
+        if position == None:
+            return apis
+
+
+def delete_api(region: str, rest_api_id: str, client_factory: Callable = boto_client):
+    awsclient = client_factory(region)
+    status = awsclient.delete_rest_api(restApiId=rest_api_id)
+    logger.info(f"Deleted API Gateway {status}")
+
 
 class ApiGateway:
-    def __init__(self, uri: str, region=None, stage_name="default"):
+    def __init__(self, uri: str, region=None, stage_name="default", rest_api_id: str = None,
+                 tags: dict[str, str] = None, client_factory: Callable = boto_client):
         self.uri = uri
 
         self.region = region
@@ -23,7 +55,10 @@ class ApiGateway:
             self.region = random.choice(ALL_REGIONS)
 
         self.stage_name = stage_name
-        self.rest_api_id = self.__new_api_gateway()
+        self.tags = tags or {}
+        self.client_factory = client_factory
+        # Gateways of an earlier run are attached to rather than created
+        self.rest_api_id = rest_api_id or self.__new_api_gateway()
 
     async def __aenter__(self):
         return self
@@ -37,14 +72,14 @@ class ApiGateway:
 
     def __new_api_gateway(self):
         # Init client
-        session = boto3.session.Session()
-        awsclient = session.client("apigateway", region_name=self.region)
+        awsclient = self.client_factory(self.region)
 
-        # Create simple rest API resource
-        api_name = "corporate-info-crawler"
+        # Create simple rest API resource, tagged with the registry which
+        # owns it
         create_api_response = awsclient.create_rest_api(
-            name=api_name,
-            endpointConfiguration={"types": ["REGIONAL"]}
+            name=API_NAME,
+            endpointConfiguration={"types": ["REGIONAL"]},
+            tags=self.tags
         )
 
         logger.info(f"Created new API Gateway {create_api_response}")
@@ -123,15 +158,23 @@ class ApiGateway:
         # Return endpoint name and whether it show it is newly created
         return rest_api_id
 
-    async def delete_api_gateway(self):
+    def alive(self) -> bool:
+        # The API still exists and is deployed to the stage
+        awsclient = self.client_factory(self.region)
+        try:
+            awsclient.get_stage(restApiId=self.rest_api_id, stageName=self.stage_name)
+            return True
+        except Exception:
+            return False
+
+    async def delete_api_gateway(self) -> bool:
         for i in range(5):
             try:
-                self.__delete_api_gateway()
+                await asyncio.to_thread(self.__delete_api_gateway)
+                return True
             except Exception:
                 await asyncio.sleep(2**i)
+        return False
 
     def __delete_api_gateway(self):
-        session = boto3.session.Session()
-        awsclient = session.client('apigateway', region_name=self.region)
-        status = awsclient.delete_rest_api(restApiId=self.rest_api_id)
-        logger.info(f"Deleted API Gateway {status}")
+        delete_api(self.region, self.rest_api_id, self.client_factory)
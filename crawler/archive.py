@@ -0,0 +1,212 @@
+import hashlib
+import pathlib
+import threading
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Union
+
+import sqlalchemy
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import Session as SqlSession
+from sqlalchemy import Column as SqlColumn, String as SqlString, Integer as SqlInteger
+from sqlalchemy import DateTime as SqlDateTime
+from sqlalchemy.dialects import sqlite
+from loguru import logger
+
+# Parser worker processes import this module to read archived pages, so it
+# must not import .common
+
+ArchiveTableBase = declarative_base()
+
+
+class ArchiveBlob(ArchiveTableBase):
+    # Compressed contents, stored once per distinct content
+    __tablename__ = "archive_blobs"
+    content_hash = SqlColumn(SqlString, primary_key=True)
+    segment = SqlColumn(SqlInteger)
+    offset = SqlColumn(SqlInteger)
+    length = SqlColumn(SqlInteger)
+    size = SqlColumn(SqlInteger)
+
+
+class ArchivePage(ArchiveTableBase):
+    # Latest content of every archived url
+    __tablename__ = "archive_pages"
+    url = SqlColumn(SqlString, primary_key=True)
+    kind = SqlColumn(SqlString, index=True)
+    region_id = SqlColumn(SqlString)
+    content_hash = SqlColumn(SqlString)
+    encoding = SqlColumn(SqlString)
+    fetched_at = SqlColumn(SqlDateTime)
+
+
+@dataclass(frozen=True)
+class BlobLocation:
+    path: str
+    offset: int
+    length: int
+
+
+@dataclass
+class ArchivedPage:
+    url: str
+    kind: str
+    region_id: str
+    encoding: str
+    blob: BlobLocation
+
+
+def segment_name(segment: int) -> str:
+    return f"segment-{segment:05d}.zz"
+
+
+def read_blob(blob: BlobLocation) -> bytes:
+    with open(blob.path, "rb") as file:
+        file.seek(blob.offset)
+        return zlib.decompress(file.read(blob.length))
+
+
+def parse_blob(func: Callable, blob: BlobLocation, encoding: str = "utf-8"):
+    # Runs in parser workers so that only the location crosses the process
+    # boundary, not the page
+    return func(read_blob(blob), encoding)
+
+
+class ResponseArchive:
+    # Raw responses compressed one by one and appended to segment files,
+    # with a SQLite index from url to content and from content to its
+    # place in a segment. Identical contents are stored once.
+    def __init__(self, path: pathlib.Path, segment_size: int = 256 * 1024 * 1024,
+                 compression_level: int = 6, batch_size: int = 200):
+        self.path = pathlib.Path(path)
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.batch_size = batch_size
+
+        self.engine: sqlalchemy.Engine = None
+        self.__lock = threading.Lock()
+        self.__segment = -1
+        self.__segment_file = None
+        self.__blobs: dict[str, dict] = {}
+        self.__pages: dict[str, dict] = {}
+
+    def open(self):
+        # Opened lazily so that disabled archives leave no files behind
+        if self.engine != None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.engine = sqlalchemy.create_engine(f"sqlite:///{self.path / 'index.db'}")
+        ArchiveTableBase.metadata.create_all(self.engine)
+
+        segments = sorted(self.path.glob("segment-*.zz"))
+        self.__segment = int(segments[-1].stem.split("-")[1]) if len(segments) != 0 else 0
+
+    def put(self, url: str, kind: str, content: bytes, encoding: str = "utf-8",
+            region_id: str = None):
+        # Blocking, call it off the event loop
+        content_hash = hashlib.sha256(content).hexdigest()
+        with self.__lock:
+            self.open()
+            known = content_hash in self.__blobs or self.__has_blob(content_hash)
+        # Compress outside of the lock, zlib releases the GIL
+        compressed = None if known else zlib.compress(content, self.compression_level)
+
+        with self.__lock:
+            if compressed != None and content_hash not in self.__blobs:
+                segment, offset = self.__append(compressed)
+                self.__blobs[content_hash] = {
+                    "content_hash": content_hash, "segment": segment, "offset": offset,
+                    "length": len(compressed), "size": len(content),
+                }
+            self.__pages[url] = {
+                "url": url, "kind": kind, "region_id": region_id,
+                "content_hash": content_hash, "encoding": encoding,
+                "fetched_at": datetime.now(timezone.utc).replace(tzinfo=None),
+            }
+            if len(self.__pages) >= self.batch_size:
+                self.__flush()
+
+    def flush(self):
+        with self.__lock:
+            if self.engine != None:
+                self.__flush()
+
+    def close(self):
+        with self.__lock:
+            if self.engine == None:
+                return
+            self.__flush()
+            if self.__segment_file != None:
+                self.__segment_file.close()
+                self.__segment_file = None
+            self.engine.dispose()
+            self.engine = None
+
+    def get(self, url: str) -> Union[ArchivedPage, None]:
+        self.open()
+        with SqlSession(self.engine) as session:
+            row = self.__pages_query(session).where(ArchivePage.url == url).first()
+            return self.__archived_page(row) if row != None else None
+
+    def pages(self, kind: str, batch_size: int = 1000) -> Iterator[ArchivedPage]:
+        self.open()
+        with SqlSession(self.engine) as session:
+            query = self.__pages_query(session).where(ArchivePage.kind == kind)
+            for row in query.yield_per(batch_size):
+                yield self.__archived_page(row)
+
+    def read(self, page: ArchivedPage) -> bytes:
+        return read_blob(page.blob)
+
+    def __pages_query(self, session: SqlSession):
+        return (
+            session.query(ArchivePage.url, ArchivePage.kind, ArchivePage.region_id,
+                          ArchivePage.encoding, ArchiveBlob.segment,
+                          ArchiveBlob.offset, ArchiveBlob.length)
+            .join(ArchiveBlob, ArchiveBlob.content_hash == ArchivePage.content_hash)
+        )
+
+    def __archived_page(self, row) -> ArchivedPage:
+        blob = BlobLocation(str(self.path / segment_name(row.segment)), row.offset, row.length)
+        return ArchivedPage(row.url, row.kind, row.region_id, row.encoding, blob)
+
+    def __has_blob(self, content_hash: str) -> bool:
+        with SqlSession(self.engine) as session:
+            return session.get(ArchiveBlob, content_hash) != None
+
+    def __append(self, compressed: bytes) -> tuple[int, int]:
+        if self.__segment_file == None:
+            self.__segment_file = open(self.path / segment_name(self.__segment), "ab")
+        offset = self.__segment_file.tell()
+        if offset >= self.segment_size:
+            self.__segment_file.close()
+            self.__segment += 1
+            self.__segment_file = open(self.path / segment_name(self.__segment), "ab")
+            offset = 0
+        self.__segment_file.write(compressed)
+        return self.__segment, offset
+
+    def __flush(self):
+        if len(self.__pages) == 0 and len(self.__blobs) == 0:
+            return
+        # Contents reach the segment file before the index refers to them
+        if self.__segment_file != None:
+            self.__segment_file.flush()
+
+        with self.engine.begin() as connection:
+            if len(self.__blobs) != 0:
+                statement = sqlite.insert(ArchiveBlob).on_conflict_do_nothing()
+                connection.execute(statement, list(self.__blobs.values()))
+            if len(self.__pages) != 0:
+                statement = sqlite.insert(ArchivePage)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[ArchivePage.url],
+                    set_={column: statement.excluded[column]
+                          for column in ("kind", "region_id", "content_hash", "encoding", "fetched_at")},
+                )
+                connection.execute(statement, list(self.__pages.values()))
+
+        logger.debug(f"Archived {len(self.__pages)} pages, {len(self.__blobs)} new contents")
+        self.__blobs.clear()
+        self.__pages.clear()
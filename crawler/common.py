@@ -1,89 +1,350 @@
-import asyncio
+import aiohttp
 from sqlalchemy.orm import declarative_base
 from loguru import logger
 import pathlib
+from datetime import timedelta
 import sys
-import random
 import os
+from typing import Callable
 
+from .concurrency import ConcurrencyLimiter
 from .ratelimit import RateLimiter
+from .retry_policy import CircuitBreakers, RetryPolicy
 from .api_gateway import ApiGateway
+from .egress import EGRESS_BACKENDS, DirectEgress, EgressBackend, GatewayEgress, ProxyEgress, Route, StaticEgress
+from .gateway_pool import GatewayPool
+from .gateway_registry import GatewayRegistry, owner_tags
+from .parser import ParsingEngine
+from .archive import ResponseArchive
+from .metrics import MetricsReporter, registry
+from .progress import ProgressReporter, ProgressTracker
 
 __all__ = ["SqlTableBase", "logger", "config"]
 
 SqlTableBase = declarative_base()
 
 
+LOGGER_FORMAT = (
+    "<green>{time}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
+    "<level>{message}</level>"
+)
+# Messages per record are logged at DEBUG level
+LOG_LEVEL = os.environ.get("CRAWLER_LOG_LEVEL", "INFO")
+
+console_sink: int = None
+
+
 def configure_logger():
-    logger_format = (
-        "<green>{time}</green> | "
-        "<level>{level: <8}</level> | "
-        "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
-        "<level>{message}</level>"
-    )
+    global console_sink
 
     log_path = pathlib.Path.cwd() / "output" / "logs"
     log_path.mkdir(parents=True, exist_ok=True)
     log_file = log_path / "log_{time}.txt"
 
     logger.remove()
-    logger.add(sys.stdout, format=logger_format)
-    logger.add(log_file, format=logger_format, rotation="64 MB", enqueue=True)
+    console_sink = logger.add(sys.stdout, format=LOGGER_FORMAT, level=LOG_LEVEL)
+    # Delay creating the file, parser worker processes never log
+    logger.add(log_file, format=LOGGER_FORMAT, level=LOG_LEVEL, rotation="64 MB", enqueue=True, delay=True)
 
     return logger
 
 
+def set_console_logging(enabled: bool):
+    # The progress dashboard owns the terminal while it runs
+    global console_sink
+    if not enabled and console_sink != None:
+        logger.remove(console_sink)
+        console_sink = None
+    elif enabled and console_sink == None:
+        console_sink = logger.add(sys.stdout, format=LOGGER_FORMAT, level=LOG_LEVEL)
+
+
 logger = configure_logger()
 
 
 class Config:
     def __init__(self):
         self.source_uri = "https://masothue.com"
-        self.__api_gateways: dict[str, ApiGateway] = {}
+        self.scheme = os.environ.get("CRAWLER_SCHEME", "https")
 
-        rate_limit = os.environ.get("CRAWLER_MAX_REQUESTS_PER_SEC", "8")
-        rate_limit = int(rate_limit)
-        self.rate_limiter = RateLimiter(rate_limit)
+        # aiohttp tracing hooks installed on every crawler client session
+        self.trace_configs = []
 
-        max_retries = os.environ.get("CRAWLER_MAX_RETRIES", "3")
-        self.max_retries = int(max_retries)
+        # Connections shared by every crawler client. Gateways are separate
+        # hosts, so the per-host limit bounds the connections to each one.
+        connections_per_host = os.environ.get("CRAWLER_CONNECTIONS_PER_HOST", "32")
+        self.connections_per_host = int(connections_per_host)
+        dns_cache_seconds = os.environ.get("CRAWLER_DNS_CACHE_SECONDS", "300")
+        self.dns_cache_seconds = int(dns_cache_seconds)
+        keepalive_seconds = os.environ.get("CRAWLER_KEEPALIVE_SECONDS", "30")
+        self.keepalive_seconds = float(keepalive_seconds)
+        self.connector: aiohttp.TCPConnector = None
 
         __output_path = pathlib.Path.cwd() / "output"
         self.__output_path = os.environ.get(
             "CRAWLER_OUTPUT_PATH", f"{__output_path}"
         )
 
+        # Requests to the origin leave through API Gateways, through a list
+        # of HTTP or SOCKS proxies, straight from this host, or through the
+        # fixed base urls of CRAWLER_EGRESS_URLS with "static", such as
+        # local stand-ins of the origin
+        self.egress_backend = os.environ.get("CRAWLER_EGRESS", "gateway")
+        self.gateway_registry = None
+        self.egress = self.new_egress(self.egress_backend)
+
+        # Initial, lowest and highest request rate of each gateway or proxy
+        rate_limit = os.environ.get("CRAWLER_MAX_REQUESTS_PER_SEC", "8")
+        min_rate_limit = os.environ.get("CRAWLER_MIN_REQUESTS_PER_SEC", "1")
+        peak_rate_limit = os.environ.get("CRAWLER_PEAK_REQUESTS_PER_SEC", "32")
+        self.rate_limiter = RateLimiter(
+            float(rate_limit), float(min_rate_limit), float(peak_rate_limit)
+        )
+
+        # Initial, lowest and highest limit of requests in flight over all
+        # gateways, adapted to the latency and errors of the origin
+        concurrency = os.environ.get("CRAWLER_CONCURRENCY", "16")
+        min_concurrency = os.environ.get("CRAWLER_MIN_CONCURRENCY", "4")
+        max_concurrency = os.environ.get("CRAWLER_MAX_CONCURRENCY", "128")
+        self.concurrency_limiter = ConcurrencyLimiter(
+            int(concurrency), int(min_concurrency), int(max_concurrency)
+        )
+
+        # Retries after the first attempt of a request, 0 makes one attempt
+        max_retries = os.environ.get("CRAWLER_MAX_RETRIES", "3")
+        self.max_retries = int(max_retries)
+        # Jittered exponential backoff between attempts, in seconds
+        retry_base_delay = os.environ.get("CRAWLER_RETRY_BASE_DELAY", "0.5")
+        retry_max_delay = os.environ.get("CRAWLER_RETRY_MAX_DELAY", "30")
+        self.retry_policy = RetryPolicy(float(retry_base_delay), float(retry_max_delay))
+
+        # A gateway's breaker opens after this many failures in a row and
+        # lets requests through again after the reset time. The gateway is
+        # replaced once its breaker opened that many times in a row.
+        breaker_failures = os.environ.get("CRAWLER_BREAKER_FAILURES", "5")
+        breaker_reset = os.environ.get("CRAWLER_BREAKER_RESET_SECONDS", "30")
+        breaker_trips = os.environ.get("CRAWLER_BREAKER_TRIPS", "3")
+        self.circuit_breakers = CircuitBreakers(
+            int(breaker_failures), float(breaker_reset), int(breaker_trips)
+        )
+
+        # Concurrent region pages of the region tree crawl
+        self.region_workers = int(os.environ.get("CRAWLER_REGION_WORKERS", "16"))
+
+        # Worker counts and queue capacity of the corporate crawl pipeline
+        self.search_workers = int(os.environ.get("CRAWLER_SEARCH_WORKERS", "4"))
+        self.detail_workers = int(os.environ.get("CRAWLER_DETAIL_WORKERS", "128"))
+        self.store_workers = int(os.environ.get("CRAWLER_STORE_WORKERS", "2"))
+        self.queue_size = int(os.environ.get("CRAWLER_QUEUE_SIZE", "256"))
+        # Search pages of one region fetched concurrently, and how many pages
+        # past the last linked one are fetched speculatively
+        self.search_page_concurrency = int(os.environ.get("CRAWLER_SEARCH_PAGE_CONCURRENCY", "4"))
+        self.search_lookahead = int(os.environ.get("CRAWLER_SEARCH_LOOKAHEAD", "2"))
+
+        # Batched storage writes, existing corporates are skipped or updated
+        self.write_mode = os.environ.get("CRAWLER_WRITE_MODE", "skip")
+        write_batch_size = os.environ.get("CRAWLER_WRITE_BATCH_SIZE", "500")
+        self.write_batch_size = int(write_batch_size)
+        write_flush_interval = os.environ.get("CRAWLER_WRITE_FLUSH_INTERVAL", "1.0")
+        self.write_flush_interval = float(write_flush_interval)
+
+        # HTML parsing pool, defaults to one process per core
+        parse_workers = os.environ.get("CRAWLER_PARSE_WORKERS", "0")
+        parse_executor = os.environ.get("CRAWLER_PARSE_EXECUTOR", "process")
+        self.parser = ParsingEngine(int(parse_workers) or None, parse_executor)
+
+        # Incremental recrawl only fetches detail pages again after this many
+        # days, conditionally, and skips records whose content did not change
+        incremental = os.environ.get("CRAWLER_INCREMENTAL", "0")
+        self.incremental = incremental != "0"
+        recrawl_days = os.environ.get("CRAWLER_RECRAWL_AFTER_DAYS", "7")
+        self.recrawl_interval = timedelta(days=float(recrawl_days))
+
+        # Corporates are discovered from the search listing of every ward,
+        # or from the sitemaps of the origin with "sitemap", which need far
+        # fewer requests. Sitemap corporates get their region from their
+        # address. Distributed crawls always search.
+        self.discovery = os.environ.get("CRAWLER_DISCOVERY", "search")
+        self.sitemap_url = os.environ.get("CRAWLER_SITEMAP_URL", "/sitemap.xml")
+
+        # Skip detail pages of tax IDs which are stored already or were seen
+        # under another region, before they are fetched
+        dedup = os.environ.get("CRAWLER_DEDUP", "1")
+        self.dedup = dedup != "0"
+
+        # Continue from the checkpoints of the previous run
+        resume = os.environ.get("CRAWLER_RESUME", "1")
+        self.resume = resume != "0"
+
+        # Distributed mode shares the regions to crawl between every node
+        # pointed at the same database through a leased work queue
+        distributed = os.environ.get("CRAWLER_DISTRIBUTED", "0")
+        self.distributed = distributed != "0"
+        lease_seconds = os.environ.get("CRAWLER_LEASE_SECONDS", "120")
+        self.lease_seconds = float(lease_seconds)
+        self.node_id = os.environ.get("CRAWLER_NODE_ID", None)
+
+        # Optional archive of raw responses, tables can be rebuilt from it
+        # offline with `python -m crawler.reparse`
+        archive = os.environ.get("CRAWLER_ARCHIVE", "0")
+        archive_segment_mb = os.environ.get("CRAWLER_ARCHIVE_SEGMENT_MB", "256")
+        self.archive = None
+        if archive != "0":
+            self.archive = ResponseArchive(
+                self.output_path / "archive", int(archive_segment_mb) * 1024 * 1024
+            )
+
+        # Tax ID lookup service on localhost, `python -m crawler.lookup`.
+        # Recent answers are cached, rows older than the recrawl interval
+        # are fetched again.
+        lookup_port = os.environ.get("CRAWLER_LOOKUP_PORT", "8080")
+        self.lookup_port = int(lookup_port)
+        lookup_cache_size = os.environ.get("CRAWLER_LOOKUP_CACHE_SIZE", "10000")
+        self.lookup_cache_size = int(lookup_cache_size)
+        lookup_cache_seconds = os.environ.get("CRAWLER_LOOKUP_CACHE_SECONDS", "300")
+        self.lookup_cache_seconds = float(lookup_cache_seconds)
+
+        # Full-text search index of corporate names, representatives and
+        # addresses, `python -m crawler.search`. Kept in sync by triggers.
+        search_index = os.environ.get("CRAWLER_SEARCH_INDEX", "1")
+        self.search_index = search_index != "0"
+
+        # Prometheus endpoint on localhost and periodic summary in the log,
+        # 0 disables either
+        metrics_port = os.environ.get("CRAWLER_METRICS_PORT", "0")
+        metrics_interval = os.environ.get("CRAWLER_METRICS_INTERVAL", "60")
+        self.metrics = MetricsReporter(registry, int(metrics_port), float(metrics_interval))
+
+        # Aggregated progress of the crawl, logged every interval as one line
+        # or shown on a live terminal dashboard, or off
+        progress = os.environ.get("CRAWLER_PROGRESS", "log")
+        progress_interval = os.environ.get("CRAWLER_PROGRESS_INTERVAL", "10")
+        self.progress = ProgressTracker()
+        self.progress_reporter = ProgressReporter(self.progress, progress, float(progress_interval),
+                                                  console=set_console_logging)
+
+        # Pragmas of SQLite databases, see storage.create_storage_engine
+        self.sqlite_synchronous = os.environ.get("CRAWLER_SQLITE_SYNCHRONOUS", "NORMAL")
+        sqlite_cache_mb = os.environ.get("CRAWLER_SQLITE_CACHE_MB", "64")
+        self.sqlite_cache_mb = int(sqlite_cache_mb)
+        sqlite_mmap_mb = os.environ.get("CRAWLER_SQLITE_MMAP_MB", "1024")
+        self.sqlite_mmap_mb = int(sqlite_mmap_mb)
+        sqlite_busy_timeout_ms = os.environ.get("CRAWLER_SQLITE_BUSY_TIMEOUT_MS", "30000")
+        self.sqlite_busy_timeout_ms = int(sqlite_busy_timeout_ms)
+
         db_url = __output_path / "corporate-info.sqlite3.db"
         self.db_url = os.environ.get(
             "CRAWLER_SQL_ENGINE_URL", f"sqlite:///{db_url}"
         )
 
-    async def remove_gateway(self, endpoint):
-        gateway = self.__api_gateways.get(endpoint)
-        if gateway != None:
-            await gateway.delete_api_gateway()
+    def new_egress(self, backend: str) -> EgressBackend:
+        if backend == "gateway":
+            # Gateways are kept for later runs in a registry under the output
+            # path, orphaned ones are swept after the grace period. APIs
+            # without the tags of the crawler, from older builds, are only
+            # swept when asked to.
+            gateway_reuse = os.environ.get("CRAWLER_GATEWAY_REUSE", "1")
+            gateway_sweep_hours = os.environ.get("CRAWLER_GATEWAY_SWEEP_HOURS", "24")
+            gateway_sweep_untagged = os.environ.get("CRAWLER_GATEWAY_SWEEP_UNTAGGED", "0")
+            self.gateway_registry = None
+            if gateway_reuse != "0":
+                self.gateway_registry = GatewayRegistry(
+                    self.output_path / "gateways.sqlite3.db",
+                    sweep_grace=timedelta(hours=float(gateway_sweep_hours)),
+                    sweep_untagged=gateway_sweep_untagged != "0"
+                )
+
+            # Requests fail once no gateway could be created for this long
+            gateway_count = os.environ.get("CRAWLER_GATEWAY_COUNT", "8")
+            gateway_spares = os.environ.get("CRAWLER_GATEWAY_SPARES", "2")
+            gateway_wait_seconds = os.environ.get("CRAWLER_GATEWAY_WAIT_SECONDS", "300")
+            gateway_pool = GatewayPool(
+                self.source_uri, int(gateway_count), int(gateway_spares),
+                factory=self.new_gateway, idle_timeout=self.keepalive_seconds,
+                registry=self.gateway_registry, wait_timeout=float(gateway_wait_seconds)
+            )
+            return GatewayEgress(gateway_pool, self.scheme, self.gateway_registry)
+
+        # Proxies and base urls cannot be replaced, failing ones rest for
+        # the cooldown instead
+        cooldown = os.environ.get("CRAWLER_PROXY_COOLDOWN_SECONDS", "300")
+        if backend == "proxy":
+            # Comma separated, or one per line in a file
+            proxies = os.environ.get("CRAWLER_PROXIES", "")
+            proxy_file = os.environ.get("CRAWLER_PROXY_FILE", None)
+            if proxy_file != None:
+                proxies += "\n" + pathlib.Path(proxy_file).read_text()
+            return ProxyEgress(ProxyEgress.parse_list(proxies), self.source_uri, float(cooldown))
+        if backend == "direct":
+            return DirectEgress(self.source_uri)
+        if backend == "static":
+            urls = os.environ.get("CRAWLER_EGRESS_URLS", "")
+            return StaticEgress.from_urls(ProxyEgress.parse_list(urls), float(cooldown))
+        raise ValueError(f"Unknown egress backend {backend}, expected one of {EGRESS_BACKENDS}")
+
+    def new_gateway(self, source_uri: str) -> ApiGateway:
+        # Tagged either way, so that sweepers leave the gateway of a running
+        # crawl alone
+        tags = self.gateway_registry.tags if self.gateway_registry != None else owner_tags()
+        return ApiGateway(source_uri, tags=tags)
+
+    async def start_egress(self):
+        await self.egress.start()
+
+    def retire_route(self, route: Route):
+        self.egress.retire(route)
+        self.rate_limiter.discard(route.key)
+        self.circuit_breakers.discard(route.key)
 
-    async def remove_all_gateways(self):
-        for gateway in self.__api_gateways.values():
-            await gateway.delete_api_gateway()
+    async def close_egress(self):
+        # Deletes the gateways, or keeps them for the next run with a registry
+        await self.egress.close()
 
-    def new_gateway(self) -> ApiGateway:
-        gateway = ApiGateway(self.source_uri)
-        self.__api_gateways[gateway.endpoint] = gateway
-        return gateway
+    def get_connector(self) -> aiohttp.TCPConnector:
+        # Created on first use since it needs the running event loop
+        if self.connector == None or self.connector.closed:
+            self.connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.connections_per_host,
+                ttl_dns_cache=self.dns_cache_seconds,
+                keepalive_timeout=self.keepalive_seconds,
+            )
+        return self.connector
+
+    async def close_connector(self):
+        if self.connector != None:
+            await self.connector.close()
+            self.connector = None
+
+    def release_route(self, route: Route, rtt: float = None):
+        self.egress.release(route, rtt)
 
     @property
     def output_path(self) -> pathlib.Path:
         return pathlib.Path(self.__output_path)
 
-    @property
-    def domain(self) -> str:
-        if len(self.__api_gateways) == 0:
-            gateway = self.new_gateway()
-            return gateway.endpoint
-
-        gateway = random.choice(list(self.__api_gateways.values()))
-        return gateway.endpoint
+    async def get_route(self, accept: Callable[[str], bool] = None) -> Route:
+        return await self.egress.get_route(accept)
 
 
 config = Config()
+
+# Read through config so that replaced limiters and pools are reported
+registry.gauge("crawler_limiter_queue_depth", "Requests waiting for a rate limiter token",
+               lambda: config.rate_limiter.queue_depth)
+registry.gauge("crawler_limiter_total_rate", "Sum of the request rates of all gateways",
+               lambda: config.rate_limiter.total_rate)
+registry.gauge("crawler_concurrency_limit", "Adaptive limit of requests in flight",
+               lambda: config.concurrency_limiter.limit)
+registry.gauge("crawler_concurrency_in_flight", "Requests in flight",
+               lambda: config.concurrency_limiter.in_flight)
+registry.gauge("crawler_concurrency_queue_depth", "Requests waiting for an in-flight slot",
+               lambda: config.concurrency_limiter.queue_depth)
+registry.gauge("crawler_breakers_open", "Gateways whose circuit breaker is open",
+               lambda: config.circuit_breakers.open_count)
+registry.gauge("crawler_gateways_active", "Active API Gateways or egress routes",
+               lambda: len(config.egress.active))
+registry.gauge("crawler_gateways_spare", "Spare API Gateways or resting egress routes",
+               lambda: config.egress.spare_count)
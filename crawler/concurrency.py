@@ -0,0 +1,99 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional
+
+
+class ConcurrencyLimiter:
+    # Adaptive limit of in-flight requests in the spirit of TCP Vegas and the
+    # gradient limit of Netflix's concurrency-limits. Queueing at the origin
+    # shows as a short-term average latency above the long-term one. The
+    # limit grows by about its square root while the two are within
+    # `tolerance`, shrinks in proportion to the excess beyond it, and is cut
+    # multiplicatively on throttling and errors. Averages rather than the
+    # minimum latency are compared, since single latencies vary a lot.
+    def __init__(self, initial_limit: int, min_limit: int = 1, max_limit: int = 256,
+                 tolerance: float = 1.5, decrease: float = 0.9, smoothing: float = 0.2,
+                 short_window: int = 10, long_window: int = 600):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.short_weight = 1 / short_window
+        self.long_weight = 1 / long_window
+
+        self.in_flight = 0
+        self.short_rtt: Optional[float] = None
+        self.long_rtt: Optional[float] = None
+        self.decreased_at = 0.0
+
+        # Waiters park on futures which are resolved as slots are released
+        self.waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self):
+        if len(self.waiters) == 0 and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Hand the slot on if it was granted just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self, rtt: float = None, throttled: bool = False):
+        # `rtt` is None for requests which tell nothing about the origin
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if throttled:
+            self.__on_throttled()
+        elif rtt != None:
+            self.__on_sample(rtt, in_flight)
+        self.__wakeup()
+
+    def __on_throttled(self):
+        # Once per round trip so that a burst of in-flight failures does not
+        # collapse the limit to the floor
+        now = time.monotonic()
+        if now - self.decreased_at < (self.short_rtt or 0.0):
+            return
+        self.decreased_at = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def __on_sample(self, rtt: float, in_flight: int):
+        if self.long_rtt == None:
+            self.short_rtt = self.long_rtt = rtt
+            return
+        self.short_rtt += self.short_weight * (rtt - self.short_rtt)
+        self.long_rtt += self.long_weight * (rtt - self.long_rtt)
+        if self.long_rtt > 2 * self.short_rtt:
+            # Recover the baseline quickly once the origin got faster again
+            self.long_rtt = (self.long_rtt + self.short_rtt) / 2
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / self.short_rtt))
+        if gradient == 1.0 and in_flight * 2 < self.limit:
+            # The crawler does not use the current limit, do not grow it
+            return
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = (1 - self.smoothing) * self.limit + self.smoothing * target
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+
+    def __wakeup(self):
+        while len(self.waiters) != 0 and self.in_flight < int(self.limit):
+            future = self.waiters.popleft()
+            if future.done():
+                # Cancelled waiter does not take a slot
+                continue
+            self.in_flight += 1
+            future.set_result(None)
@@ -1,19 +1,31 @@
 import asyncio
 import aiohttp
-from lxml import etree
+from contextlib import aclosing
 from dataclasses import dataclass
-from typing import Union
+from typing import AsyncIterable, AsyncIterator, Iterable, Union
 
 import sqlalchemy
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import mapped_column
 from sqlalchemy import Engine as SqlEngine
 from sqlalchemy.orm import Session as SqlSession
-from sqlalchemy import Column as SqlColumn, String as SqlString
+from sqlalchemy import Column as SqlColumn, String as SqlString, DateTime as SqlDateTime
 
 from .common import *
+from . import metrics
+from .dedup import DedupIndex
+from .frontier import Frontier
+from .incremental import (
+    KnownCorporate, conditional_headers, content_hash, recrawl_due, tax_id_from_url, utcnow
+)
+from .parser import parse_corporate, parse_search
+from .pipeline import Pipeline
+from .search import SearchIndex
+from .storage import StorageWriter, add_missing_columns, add_missing_indexes, create_tables
 from .region import Region
 from .retry_client import RetryClient
+from .sitemap import RegionResolver, read_sitemap, sitemap_path
+from .work_queue import WorkQueue
 
 
 class Corporate(SqlTableBase):
@@ -28,13 +40,35 @@ class Corporate(SqlTableBase):
     address = SqlColumn(SqlString)
     phone = SqlColumn(SqlString)
     active_date = SqlColumn(SqlString)
-    region_id = mapped_column(ForeignKey(Region.id))
+    region_id = mapped_column(ForeignKey(Region.id), index=True)
     status = SqlColumn(SqlString)
     last_update = SqlColumn(SqlString)
+    # Fetch state used by incremental recrawls
+    content_hash = SqlColumn(SqlString)
+    fetched_at = SqlColumn(SqlDateTime)
+    etag = SqlColumn(SqlString)
+    http_last_modified = SqlColumn(SqlString)
+
+    # Columns of the full-text search index and their weight in the ranking
+    search_weights = {
+        "name": 10.0, "international_name": 5.0, "short_name": 5.0,
+        "representative": 2.0, "address": 1.0,
+    }
 
     @classmethod
     def create_table(Self, engine: sqlalchemy.Engine):
-        Self.metadata.create_all(engine)
+        create_tables(engine)
+        add_missing_columns(engine, Self.__table__)
+        add_missing_indexes(engine, Self.__table__)
+        if config.search_index:
+            Self.search_index(engine).create()
+        else:
+            # A stale index would return wrong results
+            Self.search_index(engine).drop()
+
+    @classmethod
+    def search_index(Self, engine: sqlalchemy.Engine) -> SearchIndex:
+        return SearchIndex(engine, Self, Self.search_weights)
 
     def __repr__(self) -> str:
         return f'Tax ID: "{self.tax_id}", Name: "{self.name}"'
@@ -46,12 +80,117 @@ class SearchResult:
     urls: set[str] = None
 
 
+@dataclass
+class Page:
+    content: bytes
+    encoding: str = "utf-8"
+    etag: str = None
+    last_modified: str = None
+    not_modified: bool = False
+
+
+@dataclass
+class RegionProgress:
+    # Progress of the detail urls found in a region, or in a sitemap whose
+    # corporates get their region from their address
+    region: Union[Region, None]
+    searched: bool = False
+    emitted: bool = False
+    outstanding: int = 0
+    stored: int = 0
+    unchanged: int = 0
+    skipped: int = 0
+    failed: int = 0
+    # Frontier key, the region id or the sitemap
+    key: str = None
+
+    def __post_init__(self):
+        if self.key == None:
+            self.key = self.region.id
+
+    @property
+    def region_id(self) -> Union[str, None]:
+        return self.region.id if self.region != None else None
+
+
 class CorporateCrawler:
-    def __init__(self,  storage_engine: SqlEngine):
+    def __init__(self,  storage_engine: SqlEngine, frontier: Frontier = None,
+                 work_queue: WorkQueue = None):
         self.storage_engine = storage_engine
         Corporate.create_table(self.storage_engine)
+        self.frontier = frontier or Frontier(storage_engine, resume=config.resume)
+        # Regions are claimed from the shared work queue in distributed mode
+        self.work_queue = work_queue
+
+    async def crawl(self, regions: Union[Iterable[Region], AsyncIterable[Region]] = None):
+        # Regions at level 3 come from the database, or from `regions` such
+        # as RegionCrawler.crawl_wards() while the region tree is crawled
+        search_queue_size = config.queue_size
+        sitemaps = config.discovery == "sitemap" and self.work_queue == None
+        if sitemaps:
+            # Regions only serve to resolve addresses, so the region tree is
+            # crawled to the end first
+            if regions != None and hasattr(regions, "__aiter__"):
+                async for _ in regions:
+                    pass
+            regions = self._sitemaps()
+        elif self.work_queue != None:
+            regions = self._claimed_regions()
+            # Claim little more than the search workers can take on, the
+            # rest is left to other nodes
+            search_queue_size = config.search_workers
+        elif regions != None:
+            regions = self._unfinished_regions(regions)
+        else:
+            regions = self._pending_regions()
+
+        writer = StorageWriter(self.storage_engine,
+                               batch_size=config.write_batch_size,
+                               flush_interval=config.write_flush_interval)
+        # Incremental runs have to overwrite corporates which changed
+        writer.register(Corporate, mode="update" if config.incremental else config.write_mode)
+        self.frontier.register(writer)
+        if self.work_queue != None:
+            self.work_queue.register(writer)
 
-    async def crawl(self):
+        # Stored corporates are only skipped if they would not be overwritten
+        self.dedup = None
+        if config.dedup and not config.incremental and config.write_mode == "skip":
+            self.dedup = await asyncio.to_thread(DedupIndex.load, self.storage_engine, Corporate.tax_id)
+            logger.info(f"Loaded {len(self.dedup)} known tax IDs")
+        elif config.dedup:
+            self.dedup = DedupIndex()
+        await asyncio.to_thread(self._load_progress_regions)
+        self.resolver = None
+        if sitemaps:
+            self.resolver = await asyncio.to_thread(RegionResolver.load, self.storage_engine)
+            logger.info(f"Discovering corporates from sitemaps, with regions of {len(self.resolver)} provinces")
+
+        cookie_jar = aiohttp.DummyCookieJar()
+        async with RetryClient(max_retries=config.max_retries,
+                               limiter=config.rate_limiter,
+                               concurrency=config.concurrency_limiter,
+                               cookie_jar=cookie_jar) as client, writer:
+            self.client = client
+            self.writer = writer
+            self.pipeline = Pipeline()
+            self.search_stage = self.pipeline.add_stage(
+                "search", self._sitemap_worker if sitemaps else self._search_worker,
+                config.search_workers, search_queue_size
+            )
+            self.detail_stage = self.pipeline.add_stage(
+                "detail", self._detail_worker,
+                config.detail_workers, config.queue_size
+            )
+            self.store_stage = self.pipeline.add_stage(
+                "store", self._store_worker,
+                config.store_workers, config.queue_size
+            )
+            config.progress.watch_pipeline(self.pipeline)
+            config.progress.watch_queue("write", writer.queue)
+            await self.pipeline.run(regions)
+
+    def _pending_regions(self) -> list[Region]:
         with SqlSession(self.storage_engine) as session:
             query = session.query(Region).where(Region.level == 3)
             regions = [region for region in query]
@@ -59,85 +198,390 @@ class CorporateCrawler:
                 f"Got {len(regions)} regions at level 3 from database"
             )
 
-        cookie_jar = aiohttp.DummyCookieJar()
-        async with RetryClient(max_retries=config.max_retries,
-                               limiter=config.rate_limiter,
-                               cookie_jar=cookie_jar) as client:
+        done_regions = self.frontier.done_regions("corporates")
+        config.progress.add_regions(regions)
+        for region in regions:
+            if region.id in done_regions:
+                config.progress.ward_done(region, resumed=True)
+        regions = [region for region in regions if region.id not in done_regions]
+        logger.info(f"{len(regions)} regions at level 3 remain to be crawled")
+        return regions
+
+    async def _unfinished_regions(self, regions: Union[Iterable[Region], AsyncIterable[Region]]):
+        done_regions = self.frontier.done_regions("corporates")
+        if not hasattr(regions, "__aiter__"):
+            regions = self.__iterate(regions)
+        async for region in regions:
+            if region.id not in done_regions:
+                yield region
+            else:
+                config.progress.ward_done(region, resumed=True)
+
+    async def __iterate(self, items: Iterable):
+        for item in items:
+            yield item
+
+    async def _sitemaps(self):
+        # Child sitemaps listed by the sitemap index, unless already done
+        paths = []
+        async with aclosing(read_sitemap(self.client, config.sitemap_url)) as entries:
+            async for kind, loc in entries:
+                metrics.sitemap_entries.inc(kind=kind)
+                paths.append(sitemap_path(loc))
+                if kind == "url":
+                    # A plain url set instead of an index
+                    paths = [config.sitemap_url]
+                    break
+
+        done = self.frontier.done_regions("corporates")
+        for path in paths:
+            if f"sitemap:{path}" not in done:
+                yield path
+
+    async def _read_sitemap(self, path: str, key: str) -> list[str]:
+        # Streams the sitemap into the frontier a chunk of urls at a time and
+        # returns the pending ones. A sitemap which was read to the end
+        # before is not fetched again.
+        max_page, _ = await asyncio.to_thread(self.frontier.fetched_pages, key)
+        if max_page == 0:
+            page = 0
+            chunk = set()
+            async for kind, loc in read_sitemap(self.client, path):
+                metrics.sitemap_entries.inc(kind=kind)
+                url = sitemap_path(loc)
+                if kind != "url" or tax_id_from_url(url) == None:
+                    continue
+                chunk.add(url)
+                if len(chunk) >= config.write_batch_size:
+                    page += 1
+                    await asyncio.to_thread(self.frontier.mark_page_fetched, key, page, 0, chunk)
+                    chunk = set()
+            # The page count marks the sitemap as read to the end
+            page += 1
+            await asyncio.to_thread(self.frontier.mark_page_fetched, key, page, page, chunk)
+        return await asyncio.to_thread(self.frontier.pending_urls, key)
+
+    async def _claimed_regions(self):
+        while True:
+            region_ids = await asyncio.to_thread(
+                self.work_queue.claim, "region", config.search_workers
+            )
+            if len(region_ids) == 0:
+                # Leases of other nodes may still expire and be claimed here
+                if await asyncio.to_thread(self.work_queue.remaining, "region") == 0:
+                    return
+                await asyncio.sleep(self.work_queue.poll_interval)
+                continue
+
+            with SqlSession(self.storage_engine) as session:
+                query = session.query(Region).where(Region.id.in_(region_ids))
+                regions = [region for region in query]
+            config.progress.add_regions(regions)
+            done_regions = self.frontier.done_regions("corporates")
+
             for region in regions:
-                urls = await self._search_by_region(client, region)
-                tasks = [
-                    self._extract_corporate_info(client, url, region) for url in urls
-                ]
-                corporates = await asyncio.gather(*tasks)
-
-                record_counter = 0
-                with SqlSession(self.storage_engine) as sql_session:
-                    for corporate in corporates:
-                        if corporate != None and sql_session.get(Corporate, ident=corporate.tax_id) == None:
-                            sql_session.add(corporate)
-                            record_counter += 1
-                    sql_session.commit()
-
-                logger.success(
-                    f'Added {record_counter} corporate infor records '
-                    f'in region {region} into "corporates table"'
+                if region.id in done_regions:
+                    await asyncio.to_thread(self.work_queue.complete, "region", region.id)
+                    continue
+                yield region
+
+    async def _search_worker(self, region: Region):
+        progress = RegionProgress(region)
+        config.progress.ward_started(region)
+        known = {}
+        if config.incremental:
+            known = await asyncio.to_thread(self._load_known_corporates, region.id)
+
+        # Detail urls are handed on as soon as their search page is parsed
+        try:
+            async for url in self._search_by_region(self.client, region, progress):
+                await self._discovered(url, progress, known)
+        except Exception as err:
+            # The region stays unfinished, its urls found so far are crawled
+            logger.error(f"Failed to search corporates in region {region} with error {err}")
+            progress.searched = False
+
+        progress.emitted = True
+        await self._finish_region(progress)
+
+    async def _sitemap_worker(self, path: str):
+        progress = RegionProgress(None, key=f"sitemap:{path}")
+        try:
+            urls = await self._read_sitemap(path, progress.key)
+            progress.searched = True
+            for start in range(0, len(urls), config.write_batch_size):
+                batch = urls[start:start + config.write_batch_size]
+                known = {}
+                if config.incremental:
+                    tax_ids = [tax_id_from_url(url) for url in batch]
+                    known = await asyncio.to_thread(self._load_known_corporates, tax_ids=tax_ids)
+                for url in batch:
+                    await self._discovered(url, progress, known)
+        except Exception as err:
+            # The sitemap stays unfinished, its urls found so far are crawled
+            logger.error(f"Failed to read corporates of sitemap {path} with error {err}")
+            progress.searched = False
+
+        progress.emitted = True
+        await self._finish_region(progress)
+
+    async def _discovered(self, url: str, progress: RegionProgress, known: dict[str, KnownCorporate]):
+        # Hands a detail url on to the detail stage unless it can be skipped
+        if self.dedup != None and self.dedup.is_stored(url):
+            metrics.dedup_skips.inc(reason="stored")
+            await self.frontier.put_url_done(self.writer, url, progress.key)
+            progress.skipped += 1
+            config.progress.record(progress.region_id, "skipped")
+            return
+        if self.dedup != None and not self.dedup.claim(url):
+            # Crawled under another region, whose progress owns the url
+            metrics.dedup_skips.inc(reason="duplicate")
+            progress.skipped += 1
+            config.progress.record(progress.region_id, "skipped")
+            return
+
+        # Skip detail pages which were fetched recently enough
+        known_corporate = known.get(tax_id_from_url(url))
+        if known_corporate != None and not recrawl_due(known_corporate, utcnow(), config.recrawl_interval):
+            await self.frontier.put_url_done(self.writer, url, progress.key)
+            progress.unchanged += 1
+            config.progress.record(progress.region_id, "unchanged")
+            return
+
+        progress.outstanding += 1
+        await self.detail_stage.put((url, progress, known_corporate))
+
+    async def _detail_worker(self, item: tuple[str, RegionProgress, KnownCorporate]):
+        url, progress, known_corporate = item
+        try:
+            page = await self._fetch_corporate_page(self.client, url, known_corporate)
+        except Exception as err:
+            logger.error(f"Failed to get corporate data from {url} with error {err}")
+            page = None
+
+        if page == None:
+            progress.failed += 1
+            config.progress.record(progress.region_id, "failed")
+            progress.outstanding -= 1
+            await self._finish_region(progress)
+            return
+
+        if config.archive != None and not page.not_modified:
+            await asyncio.to_thread(
+                config.archive.put, url, "corporate", page.content, page.encoding, progress.region_id
+            )
+        await self.store_stage.put((url, page, progress, known_corporate))
+
+    async def _store_worker(self, item: tuple[str, Page, RegionProgress, KnownCorporate]):
+        url, page, progress, known_corporate = item
+        try:
+            fetched_at = utcnow()
+            page_hash = None if page.not_modified else content_hash(page.content)
+            unchanged = known_corporate != None and (
+                page.not_modified or page_hash == known_corporate.content_hash
+            )
+            if unchanged:
+                # Unchanged content, only record that it was checked
+                await self.writer.put(
+                    {"tax_id": known_corporate.tax_id, "fetched_at": fetched_at},
+                    model=Corporate, mode="update", columns=["fetched_at"]
                 )
+                await self.frontier.put_url_done(self.writer, url, progress.key)
+                progress.unchanged += 1
+                config.progress.record(progress.region_id, "unchanged")
+                return
 
-    _corporate_xpath_queries = {
-        "tax_id": '//table[@class = "table-taxinfo"]//td[@itemprop="taxID"]/span/text()',
-        "name": '//table[@class = "table-taxinfo"]//th[@itemprop="name"]/span/text()',
-        "international_name": '//table[@class = "table-taxinfo"]//i[contains(@class, "fa-globe")]/parent::td/following-sibling::td[@itemprop="alternateName"]/span/text()',
-        "short_name": '//table[@class = "table-taxinfo"]//i[contains(@class, "fa-reorder")]/parent::td/following-sibling::td[@itemprop="alternateName"]/span/text()',
-        "representative": '//table[@class = "table-taxinfo"]//td/span[@itemprop="name"]/a/text()',
-        "company_type": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-building")]/parent::td/following-sibling::td/a/text()',
-        "industry": '//h3[contains(text(), "Ngành nghề kinh doanh")]//following-sibling::table//td/strong/a/text()',
-        "address": '//table[@class = "table-taxinfo"]//td[@itemprop="address"]/span/text()',
-        "phone": '//table[@class = "table-taxinfo"]//td[@itemprop="telephone"]/span/text()',
-        "active_date": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-calendar")]/parent::td/following-sibling::td/span/text()',
-        "status": '//table[@class = "table-taxinfo"]//td/i[contains(@class, "fa-info")]/parent::td/following-sibling::td/a/text()',
-        "last_update": '//table[@class = "table-taxinfo"]//button[@data-target = "#modal-update"]/preceding-sibling::em/text()',
-    }
+            corporate = await self._parse_corporate_info(page, url, progress.region)
+            if progress.region == None and self.resolver != None:
+                region = self.resolver.resolve(corporate.address)
+                corporate.region_id = region.id if region != None else None
+            if corporate.tax_id == None:
+                raise ValueError(f"Missing tax ID in corporate data from {url}")
+            corporate.content_hash = page_hash
+            corporate.fetched_at = fetched_at
+            corporate.etag = page.etag
+            corporate.http_last_modified = page.last_modified
+            # The writer commits records in order, so the url is only marked
+            # as done together with or after its corporate record
+            await self.writer.put(corporate)
+            await self.frontier.put_url_done(self.writer, url, progress.key)
+            progress.stored += 1
+            config.progress.record(corporate.region_id, "stored")
+        except Exception:
+            progress.failed += 1
+            config.progress.record(progress.region_id, "failed")
+            raise
+        finally:
+            progress.outstanding -= 1
+            await self._finish_region(progress)
+
+    async def _finish_region(self, progress: RegionProgress):
+        if not progress.emitted or progress.outstanding != 0:
+            return
+
+        # Detail urls which failed stay pending for the next run
+        complete = progress.searched and progress.failed == 0
+        if complete:
+            await self.frontier.put_region_done(self.writer, progress.key, "corporates")
+
+        if self.work_queue != None and complete:
+            await self.work_queue.put_done(self.writer, "region", progress.key)
+        elif self.work_queue != None:
+            await asyncio.to_thread(self.work_queue.release, "region", progress.key)
 
-    async def _extract_corporate_info(self, client: RetryClient, url: str, region: Region) -> Union[Corporate, None]:
-        # Fetch corporate data from url
-        async with client.get(url) as resp:
+        if progress.region != None:
+            config.progress.ward_done(progress.region)
+        logger.debug(
+            'Added {} corporate infor records in region {} into "corporates table", '
+            '{} records were unchanged, {} were skipped as known',
+            progress.stored, progress.region or progress.key, progress.unchanged, progress.skipped
+        )
+
+    def _load_progress_regions(self):
+        # Provinces and districts which wards are grouped by in the progress
+        with SqlSession(self.storage_engine) as session:
+            query = session.query(Region).where(Region.level < 3).order_by(Region.level)
+            config.progress.add_regions([region for region in query])
+
+    def _load_known_corporates(self, region_id: str = None,
+                               tax_ids: list[str] = None) -> dict[str, KnownCorporate]:
+        # Corporates of a region, or with the given tax IDs
+        columns = [Corporate.tax_id, Corporate.content_hash, Corporate.fetched_at,
+                   Corporate.etag, Corporate.http_last_modified, Corporate.last_update]
+        with SqlSession(self.storage_engine) as session:
+            if tax_ids != None:
+                query = session.query(*columns).where(Corporate.tax_id.in_(tax_ids))
+            else:
+                query = session.query(*columns).where(Corporate.region_id == region_id)
+            return {row.tax_id: KnownCorporate(*row) for row in query}
+
+    async def _extract_corporate_info(self, client: RetryClient, url: str,
+                                      region: Region = None) -> Union[Corporate, None]:
+        page = await self._fetch_corporate_page(client, url)
+        if page == None:
+            return None
+        corporate = await self._parse_corporate_info(page, url, region)
+        corporate.content_hash = content_hash(page.content)
+        corporate.fetched_at = utcnow()
+        corporate.etag = page.etag
+        corporate.http_last_modified = page.last_modified
+        return corporate
+
+    async def _fetch_corporate_page(self, client: RetryClient, url: str,
+                                    known_corporate: KnownCorporate = None) -> Union[Page, None]:
+        # Fetch corporate data from url, conditionally if it was fetched before
+        headers = conditional_headers(known_corporate) if known_corporate != None else {}
+        async with client.get(url, headers=headers) as resp:
             if not resp.ok:
                 logger.error(
                     f"Failed to get corporate data from {url} with status {resp.status}"
                 )
                 return None
-            content = await resp.text()
+            if resp.status == 304:
+                return Page(content=b"", not_modified=True)
+            return Page(content=await resp.read(), encoding=resp.charset or "utf-8",
+                        etag=resp.headers.get("ETag"),
+                        last_modified=resp.headers.get("Last-Modified"))
 
-        # Extract data from response
-        document = etree.HTML(content)
-        corporate = Corporate()
-        corporate.region_id = region.id
+    async def _parse_corporate_info(self, page: Page, url: str, region: Region = None) -> Corporate:
+        # Extract data from response off the event loop
+        fields = await config.parser.parse(parse_corporate, page.content, page.encoding)
+        corporate = Corporate(**fields)
+        corporate.region_id = region.id if region != None else None
 
-        for field_name, query in self._corporate_xpath_queries.items():
-            results = document.xpath(query)
-            if len(results) != 0:
-                field_value = " ".join(results)
-                corporate.__dict__[field_name] = field_value
-
-        logger.success(
-            f"Extracted corporate information item {corporate} from {url}"
-        )
+        # Formatted only if DEBUG messages are logged
+        logger.debug("Extracted corporate information item {} from {}", corporate, url)
 
         return corporate
 
-    async def _search_by_region(self, client: RetryClient, region: Region) -> set[str]:
+    async def _search_by_region(self, client: RetryClient, region: Region,
+                                progress: RegionProgress) -> AsyncIterator[str]:
+        # Yields the pending detail urls of the region. Search pages and the
+        # urls found in them are checkpointed in the frontier, fetched pages
+        # are skipped when resuming. Page 1 tells the page count, the other
+        # pages are fetched concurrently.
         search_url = region.url
-        corporate_urls = set()
-        current_page = 1
-        max_page = 1
+        max_page, fetched_pages = await asyncio.to_thread(self.frontier.fetched_pages, region.id)
+
+        seen = set()
+        for url in await asyncio.to_thread(self.frontier.pending_urls, region.id):
+            seen.add(url)
+            yield url
+
+        semaphore = asyncio.Semaphore(config.search_page_concurrency)
+        results = asyncio.Queue()
+        scheduled = set(fetched_pages)
+        tasks = set()
+        # The pager only links nearby pages, so a few pages past the last
+        # linked one are fetched speculatively until the last page is found
+        lookahead = config.search_lookahead
+        last_page = 1 if 1 in fetched_pages and max_page <= 1 else None
+
+        async def fetch_page(page: int):
+            async with semaphore:
+                urls = None
+                try:
+                    result = await self._extract_search_result(client, search_url, params={"page": page})
+                    if result.urls != None and (len(result.urls) != 0 or page == 1):
+                        urls = await asyncio.to_thread(
+                            self.frontier.mark_page_fetched, region.id, page,
+                            result.max_page, result.urls
+                        )
+                    elif result.urls != None:
+                        urls = []
+                except Exception as err:
+                    logger.error(f"Failed to search page {page} of region {region} with error {err}")
+                    result = SearchResult(max_page=0, urls=None)
+            await results.put((page, result, urls))
 
-        while current_page <= max_page:
-            search_result = await self._extract_search_result(client, search_url, params={"page": current_page})
-            max_page = max(search_result.max_page, max_page)
-            current_page += 1
-            corporate_urls.update(search_result.urls)
+        def schedule(page: int):
+            scheduled.add(page)
+            task = asyncio.create_task(fetch_page(page))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-        return corporate_urls
+        if 1 not in fetched_pages:
+            schedule(1)
+        outstanding = len(tasks)
+        progress.searched = True
+
+        try:
+            while True:
+                if last_page != None:
+                    end = min(max_page, last_page)
+                elif 1 in scheduled - set(fetched_pages) and max_page == 0:
+                    # Wait for page 1 to tell the page count
+                    end = 0
+                else:
+                    end = max_page + lookahead
+                for page in range(1, end + 1):
+                    if page not in scheduled:
+                        schedule(page)
+                        outstanding += 1
+                if outstanding == 0:
+                    break
+
+                page, result, urls = await results.get()
+                outstanding -= 1
+                if urls == None:
+                    progress.searched = False
+                    continue
+                if len(result.urls) == 0 and page > 1:
+                    # Past the last page
+                    last_page = min(last_page or page - 1, page - 1)
+                    continue
+                if result.max_page <= page:
+                    # No later page is linked
+                    last_page = min(last_page or page, page)
+                max_page = max(max_page, result.max_page, page)
+
+                for url in urls:
+                    if url not in seen:
+                        seen.add(url)
+                        yield url
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def _extract_search_result(self, client: RetryClient, search_url: str, params: dict = None) -> SearchResult:
         # Fetch content from url
@@ -146,27 +590,10 @@ class CorporateCrawler:
                 logger.error(
                     f"Failed to get data from {search_url} with status {resp.status}"
                 )
-                return SearchResult(max_page=0, urls=set())
-            content = await resp.text()
-
-        # Extract page count
-        document = etree.HTML(content)
-        query = '//ul[@class = "page-numbers"]//a[@class = "page-numbers"]/text()'
-        page_elements = document.xpath(query)
-        max_page = 0
-        for page_elem in page_elements:
-            try:
-                page_no = int(page_elem)
-            except ValueError:
-                page_no = 0
-            max_page = max(max_page, page_no)
-
-        # Extract urls
-        urls = set()
-        query = '//div[@class = "tax-listing"]//div[@data-prefetch != ""]//h3//a/@href'
-        elements = document.xpath(query)
-        for element in elements:
-            url = str(element)
-            urls.add(url)
-
-        return SearchResult(max_page=max_page, urls=urls)
+                return SearchResult(max_page=0, urls=None)
+            content = await resp.read()
+            encoding = resp.charset or "utf-8"
+
+        # Extract page count and urls off the event loop
+        result = await config.parser.parse(parse_search, content, encoding)
+        return SearchResult(max_page=result["max_page"], urls=set(result["urls"]))
@@ -0,0 +1,77 @@
+import bisect
+from array import array
+from typing import Iterable, Union
+
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+
+from .incremental import tax_id_from_url
+
+_BRANCH_BASE = 1001
+
+
+def encode_tax_id(tax_id: str) -> Union[int, None]:
+    # "0101234567" and "0101234567-001" fit a 64-bit integer, leading zeros
+    # are safe since the main part always has 10 digits
+    main, _, branch = tax_id.partition("-")
+    if len(main) != 10 or not main.isdigit():
+        return None
+    if branch == "":
+        return int(main) * _BRANCH_BASE
+    if len(branch) != 3 or not branch.isdigit():
+        return None
+    return int(main) * _BRANCH_BASE + int(branch) + 1
+
+
+class DedupIndex:
+    # Tax IDs stored before the crawl started, as a sorted array of encoded
+    # integers with an exact set for IDs which do not encode, and the tax IDs
+    # or urls claimed by this crawl. Consulted before a detail page is fetched.
+    def __init__(self, tax_ids: Iterable[str] = ()):
+        codes = []
+        self.stored_other: set[str] = set()
+        for tax_id in tax_ids:
+            code = encode_tax_id(tax_id)
+            if code != None:
+                codes.append(code)
+            else:
+                self.stored_other.add(tax_id)
+        codes.sort()
+        self.stored = array("q", codes)
+
+        self.claimed: set[int] = set()
+        self.claimed_other: set[str] = set()
+
+    @classmethod
+    def load(Self, storage_engine: SqlEngine, column) -> "DedupIndex":
+        # Streams the column in chunks, only the encoded integers are kept
+        with SqlSession(storage_engine) as session:
+            query = session.query(column).yield_per(10000)
+            return Self(tax_id for tax_id, in query if tax_id != None)
+
+    def __len__(self) -> int:
+        return len(self.stored) + len(self.stored_other)
+
+    def is_stored(self, url: str) -> bool:
+        tax_id = tax_id_from_url(url)
+        if tax_id == None:
+            return False
+        code = encode_tax_id(tax_id)
+        if code == None:
+            return tax_id in self.stored_other
+        index = bisect.bisect_left(self.stored, code)
+        return index != len(self.stored) and self.stored[index] == code
+
+    def claim(self, url: str) -> bool:
+        # False if the same corporate was already claimed, e.g. under another
+        # region. Urls without a tax ID are deduplicated by themselves.
+        tax_id = tax_id_from_url(url)
+        code = encode_tax_id(tax_id) if tax_id != None else None
+        if code != None:
+            claimed, key = self.claimed, code
+        else:
+            claimed, key = self.claimed_other, tax_id or url
+        if key in claimed:
+            return False
+        claimed.add(key)
+        return True
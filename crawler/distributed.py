@@ -0,0 +1,68 @@
+import asyncio
+
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+
+from .common import *
+from .corporate import CorporateCrawler
+from .frontier import Frontier, ROOT_REGION_ID
+from .region import Region, RegionCrawler
+from .work_queue import WorkQueue, DONE, FAILED
+
+
+async def crawl_distributed(storage_engine: SqlEngine, frontier: Frontier, work_queue: WorkQueue):
+    # Every node runs this, the region tree is crawled by whichever node
+    # claims it first and the other nodes wait for its level 3 regions
+    async with work_queue:
+        await asyncio.to_thread(work_queue.enqueue, "regions", [ROOT_REGION_ID])
+        await crawl_region_tree(storage_engine, frontier, work_queue)
+
+        crawler = CorporateCrawler(storage_engine, frontier, work_queue)
+        await crawler.crawl()
+        logger.success(f"Node {work_queue.node_id} found no more regions to crawl")
+
+
+async def crawl_region_tree(storage_engine: SqlEngine, frontier: Frontier, work_queue: WorkQueue):
+    # The tree is only done once every region listed its sub-regions, until
+    # then it is crawled again from the checkpoints of the frontier
+    while await claim_region_tree(work_queue):
+        logger.info(f"Node {work_queue.node_id} crawls the region tree")
+        try:
+            crawler = RegionCrawler(storage_engine, frontier)
+            await crawler.crawl()
+
+            with SqlSession(storage_engine) as session:
+                query = session.query(Region.id).where(Region.level == 3)
+                region_ids = [region_id for region_id, in query]
+            await asyncio.to_thread(work_queue.enqueue, "region", region_ids)
+            logger.success(f"Queued {len(region_ids)} regions at level 3")
+            missing = await asyncio.to_thread(missing_subregions, storage_engine, frontier)
+        except Exception:
+            await asyncio.to_thread(work_queue.release, "regions", ROOT_REGION_ID)
+            raise
+
+        if len(missing) == 0:
+            await asyncio.to_thread(work_queue.complete, "regions", ROOT_REGION_ID)
+            return
+        logger.warning(f"{len(missing)} regions did not list their sub-regions, releasing the region tree")
+        await asyncio.to_thread(work_queue.release, "regions", ROOT_REGION_ID)
+
+
+async def claim_region_tree(work_queue: WorkQueue) -> bool:
+    # Waits until this node claims the tree, or another node finished it
+    while True:
+        claimed = await asyncio.to_thread(work_queue.claim, "regions", 1)
+        if len(claimed) != 0:
+            return True
+        status = await asyncio.to_thread(work_queue.status, "regions", ROOT_REGION_ID)
+        if status in (DONE, FAILED):
+            return False
+        await asyncio.sleep(work_queue.poll_interval)
+
+
+def missing_subregions(storage_engine: SqlEngine, frontier: Frontier) -> set[str]:
+    # The root and regions above level 3 whose sub-regions are not checkpointed
+    with SqlSession(storage_engine) as session:
+        query = session.query(Region.id).where(Region.level < 3)
+        expected = {ROOT_REGION_ID} | {region_id for region_id, in query}
+    return expected - frontier.done_regions("subregions")
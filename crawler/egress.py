@@ -0,0 +1,236 @@
+import random
+import time
+from dataclasses import dataclass, replace
+from typing import Callable
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+from loguru import logger
+
+from .gateway_pool import GatewayPool
+from .gateway_registry import GatewayRegistry
+
+# Backends are created with the configuration, so this module must not
+# import .common
+
+EGRESS_BACKENDS = ("gateway", "proxy", "direct", "static")
+
+
+@dataclass(frozen=True)
+class Route:
+    # Identity of the route for rate limiters, circuit breakers and metrics
+    key: str
+    # Request paths are appended to this url
+    base_url: str
+    # HTTP proxy of the requests, if any
+    proxy: str = None
+    # Connector of SOCKS proxies, which aiohttp cannot use per request
+    connector: aiohttp.BaseConnector = None
+
+
+def redact(url: str) -> str:
+    # Proxy passwords must not end up in logs and metric labels
+    parts = urlsplit(url)
+    if parts.password == None:
+        return url
+    host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+    netloc = f"{parts.username}:***@{host}" + (f":{parts.port}" if parts.port else "")
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+class EgressBackend:
+    # Where requests to the origin leave from. Routes are picked per request
+    # and released once their response is read, failing ones are retired.
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_route(self, accept: Callable[[str], bool] = None) -> Route:
+        raise NotImplementedError
+
+    def release(self, route: Route, rtt: float = None):
+        pass
+
+    def retire(self, route: Route):
+        pass
+
+    @property
+    def active(self) -> dict[str, Route]:
+        raise NotImplementedError
+
+    @property
+    def spare_count(self) -> int:
+        return 0
+
+
+class GatewayEgress(EgressBackend):
+    # Requests go through the API Gateways of the pool, whose stages proxy
+    # the origin
+    def __init__(self, pool: GatewayPool, scheme: str = "https", registry: GatewayRegistry = None):
+        self.pool = pool
+        self.scheme = scheme
+        self.registry = registry
+        self.routes: dict[str, Route] = {}
+
+    async def start(self):
+        await self.pool.start()
+
+    async def close(self):
+        # Deletes the gateways, or keeps them for the next run with a registry
+        await self.pool.close()
+        if self.registry != None:
+            self.registry.close()
+
+    async def get_route(self, accept: Callable[[str], bool] = None) -> Route:
+        endpoint = await self.pool.get_endpoint(accept)
+        route = self.routes.get(endpoint)
+        if route == None:
+            route = Route(endpoint, f"{self.scheme}://{endpoint}")
+            self.routes[endpoint] = route
+        return route
+
+    def release(self, route: Route, rtt: float = None):
+        self.pool.release(route.key)
+
+    def retire(self, route: Route):
+        self.pool.replace(route.key)
+        self.routes.pop(route.key, None)
+
+    @property
+    def active(self) -> dict[str, Route]:
+        return self.pool.active
+
+    @property
+    def spare_count(self) -> int:
+        return self.pool.spare_count
+
+
+class StaticEgress(EgressBackend):
+    # A fixed list of routes, such as local stand-ins of the origin. Of two
+    # random routes the one with the lower latency is taken. Retired routes
+    # cannot be replaced, they rest for `cooldown` seconds instead.
+    def __init__(self, routes: list[Route], cooldown: float = 300.0):
+        if len(routes) == 0:
+            raise ValueError("An egress backend needs at least one route")
+        self.routes = {route.key: route for route in routes}
+        self.cooldown = cooldown
+        # Random picks tried before a rejected route is taken anyway
+        self.max_picks = 4
+        # Smoothed response time of each route
+        self.latencies: dict[str, float] = {}
+        self.__available: list[str] = list(self.routes)
+        # Resting routes and when they wake, in the order they were retired
+        # which is also the order they wake in
+        self.resting: dict[str, float] = {}
+
+    @classmethod
+    def from_urls(Cls, urls: list[str], cooldown: float = 300.0) -> "StaticEgress":
+        return Cls([Route(url, url.rstrip("/")) for url in urls], cooldown)
+
+    async def get_route(self, accept: Callable[[str], bool] = None) -> Route:
+        # Runs in amortized constant time however many routes there are
+        self.__wake()
+        if len(self.__available) == 0:
+            # Everything rests, the route which rested longest goes back
+            self.__wake(force=True)
+
+        for _ in range(self.max_picks):
+            picks = [random.choice(self.__available), random.choice(self.__available)]
+            picks = [key for key in picks if accept == None or accept(key)]
+            if len(picks) != 0:
+                key = min(picks, key=lambda key: self.latencies.get(key, 0.0))
+                return self.routes[key]
+        return self.routes[random.choice(self.__available)]
+
+    def release(self, route: Route, rtt: float = None):
+        if rtt == None:
+            return
+        latency = self.latencies.get(route.key)
+        self.latencies[route.key] = rtt if latency == None else 0.8 * latency + 0.2 * rtt
+
+    def retire(self, route: Route):
+        if route.key in self.routes and route.key not in self.resting:
+            logger.warning(f"Resting egress route {route.key} for {self.cooldown:g}s")
+            self.__available.remove(route.key)
+            self.resting[route.key] = time.monotonic() + self.cooldown
+            self.latencies.pop(route.key, None)
+
+    @property
+    def active(self) -> dict[str, Route]:
+        self.__wake()
+        return {key: self.routes[key] for key in self.__available}
+
+    @property
+    def spare_count(self) -> int:
+        return len(self.resting)
+
+    def __wake(self, force: bool = False):
+        now = time.monotonic()
+        while len(self.resting) != 0:
+            key, until = next(iter(self.resting.items()))
+            if until > now and not force:
+                break
+            del self.resting[key]
+            self.__available.append(key)
+            force = False
+
+
+class DirectEgress(StaticEgress):
+    # Requests go straight to the origin from this host
+    def __init__(self, target: str, cooldown: float = 30.0):
+        super().__init__([Route("direct", target.rstrip("/"))], cooldown)
+
+
+class ProxyEgress(StaticEgress):
+    # Requests go to the origin through a rotating list of HTTP or SOCKS
+    # proxies. SOCKS proxies need the optional aiohttp-socks package, their
+    # connectors are created on start since they need the running loop.
+    def __init__(self, proxies: list[str], target: str, cooldown: float = 300.0,
+                 connector_options: dict = None):
+        self.proxies = {redact(proxy): proxy for proxy in proxies}
+        self.connector_options = connector_options or {}
+        routes = []
+        for key, proxy in self.proxies.items():
+            scheme = urlsplit(proxy).scheme
+            if scheme.startswith("socks"):
+                self.__socks_connector_class()
+                routes.append(Route(key, target.rstrip("/")))
+            elif scheme in ("http", "https"):
+                routes.append(Route(key, target.rstrip("/"), proxy=proxy))
+            else:
+                raise ValueError(f"Unsupported proxy {key}, expected http, https or socks")
+        super().__init__(routes, cooldown)
+
+    @staticmethod
+    def parse_list(text: str) -> list[str]:
+        # One proxy per line or separated by commas, # starts a comment
+        proxies = []
+        for line in text.splitlines():
+            line = line.split("#", 1)[0]
+            proxies += [proxy.strip() for proxy in line.split(",") if proxy.strip() != ""]
+        return proxies
+
+    async def start(self):
+        for key, route in self.routes.items():
+            if route.proxy == None and route.connector == None:
+                connector = self.__socks_connector_class().from_url(
+                    self.proxies[key], **self.connector_options
+                )
+                self.routes[key] = replace(route, connector=connector)
+        logger.info(f"Egress through {len(self.routes)} proxies")
+
+    async def close(self):
+        for key, route in self.routes.items():
+            if route.connector != None:
+                await route.connector.close()
+                self.routes[key] = replace(route, connector=None)
+
+    @staticmethod
+    def __socks_connector_class():
+        try:
+            from aiohttp_socks import ProxyConnector
+        except ImportError:
+            raise RuntimeError("SOCKS proxies need the aiohttp-socks package") from None
+        return ProxyConnector
@@ -0,0 +1,121 @@
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+from sqlalchemy import Column as SqlColumn, String as SqlString
+from sqlalchemy import Integer as SqlInteger, Boolean as SqlBoolean
+from sqlalchemy import case, func, update
+
+from .common import *
+from .storage import StorageWriter, create_tables, insert_missing
+
+# Frontier key of the root page which lists level 1 regions
+ROOT_REGION_ID = ""
+
+
+class FrontierRegion(SqlTableBase):
+    __tablename__ = "frontier_regions"
+    region_id = SqlColumn(SqlString, primary_key=True)
+    subregions_done = SqlColumn(SqlBoolean, default=False)
+    corporates_done = SqlColumn(SqlBoolean, default=False)
+    max_page = SqlColumn(SqlInteger, default=0)
+
+
+class FrontierSearchPage(SqlTableBase):
+    __tablename__ = "frontier_search_pages"
+    region_id = SqlColumn(SqlString, primary_key=True)
+    page = SqlColumn(SqlInteger, primary_key=True)
+
+
+class FrontierDetailUrl(SqlTableBase):
+    __tablename__ = "frontier_detail_urls"
+    url = SqlColumn(SqlString, primary_key=True)
+    region_id = SqlColumn(SqlString, index=True)
+    done = SqlColumn(SqlBoolean, default=False)
+
+
+class Frontier:
+    def __init__(self, storage_engine: SqlEngine, resume: bool = True):
+        self.storage_engine = storage_engine
+        create_tables(
+            self.storage_engine,
+            tables=[FrontierRegion.__table__,
+                    FrontierSearchPage.__table__,
+                    FrontierDetailUrl.__table__]
+        )
+        if not resume:
+            self.reset()
+
+    def reset(self):
+        with SqlSession(self.storage_engine) as session:
+            session.query(FrontierDetailUrl).delete()
+            session.query(FrontierSearchPage).delete()
+            session.query(FrontierRegion).delete()
+            session.commit()
+        logger.info("Cleared crawl frontier")
+
+    def done_regions(self, stage: str) -> set[str]:
+        column = getattr(FrontierRegion, f"{stage}_done")
+        with SqlSession(self.storage_engine) as session:
+            query = session.query(FrontierRegion.region_id).where(column == True)
+            return {region_id for region_id, in query}
+
+    def register(self, writer: StorageWriter):
+        writer.register(FrontierDetailUrl, mode="update", columns=["done"])
+
+    async def put_region_done(self, writer: StorageWriter, region_id: str, stage: str):
+        state = FrontierRegion(region_id=region_id, subregions_done=False,
+                               corporates_done=False, max_page=0)
+        setattr(state, f"{stage}_done", True)
+        await writer.put(state, mode="update", columns=[f"{stage}_done"])
+
+    async def put_url_done(self, writer: StorageWriter, url: str, region_id: str):
+        await writer.put(FrontierDetailUrl(url=url, region_id=region_id, done=True))
+
+    def fetched_pages(self, region_id: str) -> tuple[int, set[int]]:
+        with SqlSession(self.storage_engine) as session:
+            state = session.get(FrontierRegion, ident=region_id)
+            max_page = state.max_page if state != None else 0
+            query = session.query(FrontierSearchPage.page).where(
+                FrontierSearchPage.region_id == region_id
+            )
+            return max_page or 0, {page for page, in query}
+
+    def mark_page_fetched(self, region_id: str, page: int, max_page: int, urls: set[str]) -> list[str]:
+        # Returns the urls of the page which are not done yet. Pages of
+        # several regions are marked concurrently and may share urls, so
+        # rows are inserted unless they exist and the flags read afterwards.
+        with SqlSession(self.storage_engine) as session:
+            self.__raise_max_page(session, region_id, max_page)
+            insert_missing(session, FrontierSearchPage.__table__,
+                           [{"region_id": region_id, "page": page}])
+            insert_missing(session, FrontierDetailUrl.__table__,
+                           [{"url": url, "region_id": region_id, "done": False} for url in urls])
+
+            done = set()
+            if len(urls) != 0:
+                query = session.query(FrontierDetailUrl.url).where(
+                    FrontierDetailUrl.url.in_(urls), FrontierDetailUrl.done == True
+                )
+                done = {url for url, in query}
+            session.commit()
+
+        return [url for url in urls if url not in done]
+
+    def pending_urls(self, region_id: str) -> list[str]:
+        with SqlSession(self.storage_engine) as session:
+            query = session.query(FrontierDetailUrl.url).where(
+                FrontierDetailUrl.region_id == region_id,
+                FrontierDetailUrl.done == False,
+            )
+            return [url for url, in query]
+
+    def __raise_max_page(self, session: SqlSession, region_id: str, max_page: int):
+        insert_missing(session, FrontierRegion.__table__, [{
+            "region_id": region_id, "subregions_done": False,
+            "corporates_done": False, "max_page": 0,
+        }])
+        current = func.coalesce(FrontierRegion.max_page, 0)
+        session.execute(
+            update(FrontierRegion)
+            .where(FrontierRegion.region_id == region_id)
+            .values(max_page=case((current < max_page, max_page), else_=current))
+        )
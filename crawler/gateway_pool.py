@@ -0,0 +1,248 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Callable
+
+from loguru import logger
+from . import metrics
+from .api_gateway import ApiGateway
+from .gateway_registry import GatewayRegistry
+
+
+class GatewayPool:
+    def __init__(self, source_uri: str, size: int, spares: int,
+                 factory: Callable[[str], ApiGateway] = ApiGateway,
+                 idle_timeout: float = 30.0, registry: GatewayRegistry = None,
+                 wait_timeout: float = 300.0):
+        self.source_uri = source_uri
+        self.size = size
+        self.spares = spares
+        self.factory = factory
+        self.retry_interval = 5.0
+        # Keep-alive time of idle connections to a gateway
+        self.idle_timeout = idle_timeout
+        # Random picks tried before a rejected endpoint is taken anyway
+        self.max_picks = 4
+        # Longest wait for a gateway while none is active, after which the
+        # last provisioning error is raised instead of waiting forever
+        self.wait_timeout = wait_timeout
+        self.__last_error: Exception = None
+        # Gateways are reused across runs if a registry is given
+        self.registry = registry
+        self.__heartbeat_task: asyncio.Task = None
+
+        self.__active: dict[str, ApiGateway] = {}
+        self.__endpoints: list[str] = []
+        self.__spares: list[ApiGateway] = []
+        self.__available = asyncio.Event()
+        # One entry per idle keep-alive connection, as (endpoint, released
+        # at), most recently released last
+        self.__idle: deque[tuple[str, float]] = deque()
+
+        # Background provisioning and deletion jobs
+        self.__tasks: set[asyncio.Task] = set()
+        self.__provisioning = 0
+        self.__closed = False
+
+    @property
+    def active(self) -> dict[str, ApiGateway]:
+        return self.__active
+
+    @property
+    def spare_count(self) -> int:
+        return len(self.__spares)
+
+    async def start(self):
+        # Reuse the gateways of earlier runs, then provision the missing
+        # ones concurrently off the event loop
+        total = self.size + self.spares
+        adopted = []
+        if self.registry != None:
+            try:
+                adopted = await asyncio.to_thread(self.registry.adopt, self.source_uri, total)
+            except Exception as err:
+                logger.error(f"Failed to reuse API Gateways: {err}")
+            self.__heartbeat_task = asyncio.create_task(self.__heartbeat())
+
+        results = adopted + await asyncio.gather(
+            *[self.__provision() for _ in range(total - len(adopted))],
+            return_exceptions=True
+        )
+        for gateway in results:
+            if isinstance(gateway, BaseException):
+                self.__last_error = gateway
+                logger.error(f"Failed to create API Gateway: {gateway}")
+                continue
+            if len(self.__active) < self.size:
+                self.__activate(gateway)
+            else:
+                self.__spares.append(gateway)
+
+        logger.info(
+            f"Gateway pool started with {len(self.__active)} active "
+            f"and {len(self.__spares)} spare gateways, {len(adopted)} of them reused"
+        )
+        if self.registry != None:
+            self.__spawn(self.__sweep())
+        self.__replenish()
+
+    def endpoint(self) -> str:
+        if len(self.__endpoints) == 0:
+            raise RuntimeError("No API Gateway is available in the pool")
+        return random.choice(self.__endpoints)
+
+    async def get_endpoint(self, accept: Callable[[str], bool] = None) -> str:
+        # Prefers the endpoint of the connection which was released last, so
+        # that warm connections and TLS sessions are reused, then random
+        # endpoints which `accept` takes. Runs in amortized constant time.
+        deadline = time.monotonic() + self.wait_timeout
+        while len(self.__endpoints) == 0:
+            if self.__closed:
+                raise RuntimeError("The API Gateway pool is closed")
+            self.__replenish()
+            self.__available.clear()
+            try:
+                await asyncio.wait_for(self.__available.wait(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                raise RuntimeError(
+                    f"No API Gateway became available within {self.wait_timeout:g}s, "
+                    f"last error: {self.__last_error}"
+                ) from self.__last_error
+
+        self.__expire_idle()
+        for _ in range(self.max_picks):
+            if len(self.__idle) == 0:
+                break
+            endpoint, _ = self.__idle.pop()
+            if endpoint in self.__active and (accept == None or accept(endpoint)):
+                return endpoint
+
+        endpoint = random.choice(self.__endpoints)
+        for _ in range(self.max_picks - 1):
+            if accept == None or accept(endpoint):
+                break
+            endpoint = random.choice(self.__endpoints)
+        return endpoint
+
+    def release(self, endpoint: str):
+        # A request to `endpoint` finished and left its connection idle
+        self.__idle.append((endpoint, time.monotonic()))
+
+    def __expire_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while len(self.__idle) != 0 and self.__idle[0][1] < deadline:
+            self.__idle.popleft()
+
+    def replace(self, endpoint: str):
+        gateway = self.__active.pop(endpoint, None)
+        if gateway == None:
+            # Already replaced by another coroutine
+            return
+        self.__endpoints.remove(endpoint)
+
+        if len(self.__spares) != 0:
+            spare = self.__spares.pop()
+            self.__activate(spare)
+            logger.info(f"Replaced API Gateway {endpoint} with {spare.endpoint}")
+
+        self.__spawn(self.__delete(gateway))
+        self.__replenish()
+
+    async def close(self):
+        self.__closed = True
+
+        # Wait for in-flight provisioning so that no gateway leaks
+        while len(self.__tasks) != 0:
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+        gateways = list(self.__active.values()) + self.__spares
+        self.__active.clear()
+        self.__endpoints.clear()
+        self.__spares.clear()
+        if self.registry == None:
+            await asyncio.gather(
+                *[self.__delete(gateway) for gateway in gateways],
+                return_exceptions=True
+            )
+            return
+
+        # Healthy gateways are kept for the next run
+        if self.__heartbeat_task != None:
+            self.__heartbeat_task.cancel()
+            await asyncio.gather(self.__heartbeat_task, return_exceptions=True)
+            self.__heartbeat_task = None
+        try:
+            await asyncio.to_thread(self.registry.release, [gateway.rest_api_id for gateway in gateways])
+        except Exception as err:
+            logger.error(f"Failed to release API Gateways for reuse: {err}")
+        logger.info(f"Released {len(gateways)} API Gateways for reuse")
+
+    async def __provision(self) -> ApiGateway:
+        with metrics.gateway_create_seconds.time():
+            gateway = await asyncio.to_thread(self.factory, self.source_uri)
+        if self.registry != None:
+            await asyncio.to_thread(self.registry.add, gateway)
+        return gateway
+
+    async def __delete(self, gateway: ApiGateway):
+        # Gateways which fail to be deleted are swept by a later run
+        if self.registry != None:
+            await asyncio.to_thread(self.registry.mark_unhealthy, gateway.rest_api_id)
+        with metrics.gateway_delete_seconds.time():
+            deleted = await gateway.delete_api_gateway()
+        if self.registry != None and deleted:
+            await asyncio.to_thread(self.registry.remove, gateway.rest_api_id)
+
+    async def __heartbeat(self):
+        while True:
+            await asyncio.sleep(self.registry.heartbeat_interval)
+            try:
+                await asyncio.to_thread(self.registry.heartbeat)
+            except Exception as err:
+                logger.warning(f"Failed to renew API Gateway ownership: {err}")
+
+    async def __sweep(self):
+        try:
+            await asyncio.to_thread(self.registry.sweep)
+        except Exception as err:
+            logger.error(f"Failed to sweep orphaned API Gateways: {err}")
+
+    def __activate(self, gateway: ApiGateway):
+        self.__active[gateway.endpoint] = gateway
+        self.__endpoints.append(gateway.endpoint)
+        self.__available.set()
+
+    def __replenish(self):
+        if self.__closed:
+            return
+        missing = self.size + self.spares - (
+            len(self.__active) + len(self.__spares) + self.__provisioning
+        )
+        for _ in range(missing):
+            self.__provisioning += 1
+            self.__spawn(self.__provision_spare())
+
+    async def __provision_spare(self):
+        try:
+            gateway = await self.__provision()
+        except Exception as err:
+            self.__provisioning -= 1
+            self.__last_error = err
+            logger.error(f"Failed to create API Gateway: {err}")
+            await asyncio.sleep(self.retry_interval)
+            self.__replenish()
+            return
+
+        self.__provisioning -= 1
+        self.__last_error = None
+
+        if len(self.__active) < self.size:
+            self.__activate(gateway)
+        else:
+            self.__spares.append(gateway)
+
+    def __spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
@@ -0,0 +1,278 @@
+import os
+import pathlib
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+import sqlalchemy
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import Session as SqlSession
+from sqlalchemy import Column as SqlColumn, String as SqlString, Boolean as SqlBoolean
+from sqlalchemy import DateTime as SqlDateTime
+from loguru import logger
+
+from .api_gateway import ALL_REGIONS, ApiGateway, boto_client, delete_api, list_apis
+
+# The gateway pool is created with the configuration, so this module must
+# not import .common
+
+RegistryTableBase = declarative_base()
+
+REGISTRY_TAG = "crawler-registry"
+# Every API carries the process which created it, with or without a registry
+OWNER_TAG = "crawler-owner"
+
+
+class GatewayRecord(RegistryTableBase):
+    __tablename__ = "gateways"
+    rest_api_id = SqlColumn(SqlString, primary_key=True)
+    region = SqlColumn(SqlString)
+    stage_name = SqlColumn(SqlString)
+    source_uri = SqlColumn(SqlString)
+    healthy = SqlColumn(SqlBoolean, default=True)
+    # Process which uses the gateway, None while it waits to be reused
+    owner = SqlColumn(SqlString, index=True)
+    heartbeat_at = SqlColumn(SqlDateTime)
+    created_at = SqlColumn(SqlDateTime)
+
+
+class RegistryMeta(RegistryTableBase):
+    __tablename__ = "registry_meta"
+    key = SqlColumn(SqlString, primary_key=True)
+    value = SqlColumn(SqlString)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def process_owner() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def owner_tags(owner: str = None) -> dict[str, str]:
+    # Tags of APIs created without a registry, which keep the sweeper of
+    # other processes away from them
+    return {OWNER_TAG: owner or process_owner()}
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class GatewayRegistry:
+    # API Gateways created by the crawler, kept in a SQLite file so that a
+    # later run reuses the healthy ones instead of creating new gateways.
+    # Owners keep a heartbeat, gateways of owners which stopped it are free
+    # to adopt. APIs which no running process owns are swept, APIs without
+    # any tag of the crawler only with `sweep_untagged`.
+    def __init__(self, path: pathlib.Path, owner: str = None,
+                 heartbeat_interval: float = 60.0, sweep_grace: timedelta = timedelta(hours=24),
+                 client_factory: Callable = boto_client, sweep_untagged: bool = False):
+        self.path = pathlib.Path(path)
+        self.owner = owner or process_owner()
+        self.heartbeat_interval = heartbeat_interval
+        # Idle and untagged APIs are only swept once unused for this long
+        self.sweep_grace = sweep_grace
+        # Untagged APIs come from older builds and may still be in use, their
+        # age only tells when they were created
+        self.sweep_untagged = sweep_untagged
+        # APIs are created before they are registered, so recent ones are
+        # left alone even if they carry the tag of this registry
+        self.register_margin = timedelta(minutes=10)
+        self.client_factory = client_factory
+
+        self.engine: sqlalchemy.Engine = None
+        self.registry_id: str = None
+        self.__lock = threading.Lock()
+
+    def open(self):
+        # Opened lazily, gateways are provisioned from several threads
+        with self.__lock:
+            if self.engine != None:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            engine = sqlalchemy.create_engine(f"sqlite:///{self.path}")
+            RegistryTableBase.metadata.create_all(engine)
+            with SqlSession(engine) as session:
+                meta = session.get(RegistryMeta, "registry_id")
+                if meta == None:
+                    meta = RegistryMeta(key="registry_id", value=uuid.uuid4().hex)
+                    session.add(meta)
+                    session.commit()
+                self.registry_id = meta.value
+            self.engine = engine
+
+    def close(self):
+        with self.__lock:
+            if self.engine != None:
+                self.engine.dispose()
+                self.engine = None
+
+    @property
+    def tags(self) -> dict[str, str]:
+        # Tags of new APIs, which tell the sweeper they belong here
+        self.open()
+        return {REGISTRY_TAG: self.registry_id, **owner_tags(self.owner)}
+
+    def add(self, gateway: ApiGateway):
+        self.open()
+        now = utcnow()
+        with SqlSession(self.engine) as session:
+            session.merge(GatewayRecord(
+                rest_api_id=gateway.rest_api_id, region=gateway.region,
+                stage_name=gateway.stage_name, source_uri=gateway.uri, healthy=True,
+                owner=self.owner, heartbeat_at=now, created_at=now,
+            ))
+            session.commit()
+
+    def adopt(self, source_uri: str, limit: int) -> list[ApiGateway]:
+        # Claims healthy gateways of the same origin which are idle or whose
+        # owner died, and checks that they still exist
+        self.open()
+        with SqlSession(self.engine) as session:
+            query = session.query(GatewayRecord).where(
+                GatewayRecord.source_uri == source_uri, GatewayRecord.healthy == True
+            ).order_by(GatewayRecord.heartbeat_at.desc())
+            candidates = [record for record in query if not self.__owned(record)]
+
+        gateways = []
+        for record in candidates:
+            if len(gateways) >= limit:
+                break
+            if not self.__claim(record):
+                continue
+            gateway = ApiGateway(record.source_uri, record.region, record.stage_name,
+                                 rest_api_id=record.rest_api_id, client_factory=self.client_factory)
+            if gateway.alive():
+                gateways.append(gateway)
+            else:
+                self.remove(record.rest_api_id)
+        return gateways
+
+    def mark_unhealthy(self, rest_api_id: str):
+        self.open()
+        with self.engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.update(GatewayRecord)
+                .where(GatewayRecord.rest_api_id == rest_api_id)
+                .values(healthy=False)
+            )
+
+    def remove(self, rest_api_id: str):
+        self.open()
+        with self.engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.delete(GatewayRecord).where(GatewayRecord.rest_api_id == rest_api_id)
+            )
+
+    def release(self, rest_api_ids: list[str]):
+        # Healthy gateways wait for the next run
+        self.open()
+        with self.engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.update(GatewayRecord)
+                .where(GatewayRecord.rest_api_id.in_(rest_api_ids),
+                       GatewayRecord.owner == self.owner)
+                .values(owner=None, heartbeat_at=utcnow())
+            )
+
+    def heartbeat(self):
+        self.open()
+        with self.engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.update(GatewayRecord)
+                .where(GatewayRecord.owner == self.owner)
+                .values(heartbeat_at=utcnow())
+            )
+
+    def sweep(self, regions: list[str] = ALL_REGIONS) -> int:
+        # Deletes unhealthy gateways and gateways idle for too long which no
+        # running process owns, and untracked APIs which carry the tag of
+        # this registry or of a dead process on this host. APIs without a
+        # tag are deleted once older than the grace period if enabled.
+        self.open()
+        now = utcnow()
+        with SqlSession(self.engine) as session:
+            records = {record.rest_api_id: record for record in session.query(GatewayRecord)}
+
+        doomed = []
+        for record in records.values():
+            if self.__owned(record):
+                continue
+            idle_for = now - (record.heartbeat_at or record.created_at or now)
+            if not record.healthy or idle_for >= self.sweep_grace:
+                doomed.append((record.region, record.rest_api_id))
+
+        for region in regions:
+            try:
+                apis = list_apis(region, self.client_factory)
+            except Exception as err:
+                logger.warning(f"Failed to list API Gateways in {region}: {err}")
+                continue
+            for api in apis:
+                if api["id"] in records:
+                    continue
+                tags = api.get("tags", {})
+                tag, owner = tags.get(REGISTRY_TAG), tags.get(OWNER_TAG)
+                created_at = api.get("createdDate")
+                if created_at != None and created_at.tzinfo != None:
+                    created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+                age = now - created_at if created_at != None else timedelta(0)
+                if tag != None:
+                    doomed_api = tag == self.registry_id and age >= self.register_margin
+                elif owner != None:
+                    doomed_api = self.__dead_local_owner(owner)
+                else:
+                    doomed_api = self.sweep_untagged and age >= self.sweep_grace
+                if doomed_api:
+                    doomed.append((region, api["id"]))
+
+        deleted = 0
+        for region, rest_api_id in doomed:
+            try:
+                delete_api(region, rest_api_id, self.client_factory)
+            except Exception as err:
+                logger.warning(f"Failed to sweep API Gateway {rest_api_id} in {region}: {err}")
+                continue
+            self.remove(rest_api_id)
+            deleted += 1
+        if deleted != 0:
+            logger.info(f"Swept {deleted} orphaned API Gateways")
+        return deleted
+
+    def __owned(self, record: GatewayRecord) -> bool:
+        # Owned by a running process, this one included
+        if record.owner == None:
+            return False
+        if record.owner == self.owner:
+            return True
+        if self.__dead_local_owner(record.owner):
+            return False
+        heartbeat_at = record.heartbeat_at or record.created_at
+        return heartbeat_at != None and utcnow() - heartbeat_at < timedelta(seconds=3 * self.heartbeat_interval)
+
+    def __dead_local_owner(self, owner: str) -> bool:
+        # Only processes on this host can be told dead without a heartbeat
+        host, _, pid = owner.rpartition("-")
+        return host == socket.gethostname() and pid.isdigit() and not pid_alive(int(pid))
+
+    def __claim(self, record: GatewayRecord) -> bool:
+        # Conditional on the owner seen before, so that processes starting
+        # together never adopt the same gateway
+        with self.engine.begin() as connection:
+            owner = GatewayRecord.owner == record.owner if record.owner != None else GatewayRecord.owner.is_(None)
+            result = connection.execute(
+                sqlalchemy.update(GatewayRecord)
+                .where(GatewayRecord.rest_api_id == record.rest_api_id, owner)
+                .values(owner=self.owner, heartbeat_at=utcnow())
+            )
+            return result.rowcount == 1
@@ -0,0 +1,78 @@
+import hashlib
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Union
+
+
+@dataclass
+class KnownCorporate:
+    tax_id: str
+    content_hash: str = None
+    fetched_at: datetime = None
+    etag: str = None
+    http_last_modified: str = None
+    last_update: str = None
+
+
+_tax_id_pattern = re.compile(r"^/(\d{10}(?:-\d{3})?)(?:-|$)")
+_date_pattern = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+def utcnow() -> datetime:
+    # Timestamps are stored as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def tax_id_from_url(url: str) -> Union[str, None]:
+    # Detail urls start with the tax ID, e.g. /0101234567-cong-ty-abc
+    match = _tax_id_pattern.match(url)
+    return match.group(1) if match != None else None
+
+
+def content_hash(content: bytes) -> str:
+    # Only hash the info section (the table-taxinfo table and the industry
+    # table after it) so that ads and other page furniture do not count as
+    # changes. Falls back to the whole page if the markup is unexpected.
+    start = content.find(b"table-taxinfo")
+    end = content.find(b"</table>", content.find(b"</table>", start) + 1)
+    if start == -1 or end == -1:
+        return hashlib.sha256(content).hexdigest()
+    return hashlib.sha256(content[start:end]).hexdigest()
+
+
+def origin_updated_at(known: KnownCorporate) -> Union[datetime, None]:
+    # last_update holds the origin's text "... lần cuối vào 2023-01-15 10:00:00"
+    if known.last_update == None:
+        return None
+    match = _date_pattern.search(known.last_update)
+    if match == None:
+        return None
+    try:
+        return datetime(*(int(part) for part in match.groups()))
+    except ValueError:
+        return None
+
+
+def recrawl_due(known: KnownCorporate, now: datetime, interval: timedelta) -> bool:
+    if known.fetched_at == None:
+        return True
+
+    # Records which the origin has not updated for a long time rarely change,
+    # so back off up to 8 times the base interval for them
+    updated_at = origin_updated_at(known)
+    if updated_at != None:
+        stable_for = known.fetched_at - updated_at
+        interval = min(max(interval, stable_for / 10), interval * 8)
+
+    return now - known.fetched_at >= interval
+
+
+def conditional_headers(known: KnownCorporate) -> dict[str, str]:
+    # Only validators which the origin sent before, it ignores the rest
+    headers = {}
+    if known.etag != None:
+        headers["If-None-Match"] = known.etag
+    if known.http_last_modified != None:
+        headers["If-Modified-Since"] = known.http_last_modified
+    return headers
@@ -0,0 +1,266 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+
+from .common import *
+from . import metrics
+from .corporate import Corporate, CorporateCrawler
+from .dedup import encode_tax_id
+from .frontier import Frontier, FrontierDetailUrl
+from .incremental import tax_id_from_url, utcnow
+from .parser import parse_search
+from .retry_client import RetryClient
+from .storage import StorageWriter, create_storage_engine
+
+
+class TTLCache:
+    # Bounded LRU whose entries expire after `ttl` seconds
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        entry = self.entries.get(key)
+        if entry == None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+
+    def put(self, key: str, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def corporate_dict(corporate: Corporate) -> dict:
+    return {column.key: getattr(corporate, column.key) for column in Corporate.__table__.columns}
+
+
+def json_record(record: dict) -> dict:
+    return {key: value.isoformat() if hasattr(value, "isoformat") else value
+            for key, value in record.items()}
+
+
+class LookupService:
+    # Answers tax ID lookups from a cache, then the corporates table, then
+    # the origin for rows which are missing or older than the recrawl
+    # interval. Concurrent lookups of one tax ID share a single load.
+    def __init__(self, storage_engine: SqlEngine, cache_size: int = 10000,
+                 cache_ttl: float = 300):
+        self.storage_engine = storage_engine
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.inflight: dict[str, asyncio.Future] = {}
+        # Never reset the frontier of a crawl which may run next to this
+        self.crawler = CorporateCrawler(storage_engine, Frontier(storage_engine, resume=True))
+        self.search_index = Corporate.search_index(storage_engine)
+
+    async def __aenter__(self):
+        self.writer = StorageWriter(self.storage_engine,
+                                    batch_size=config.write_batch_size,
+                                    flush_interval=config.write_flush_interval)
+        self.writer.register(Corporate, mode="update")
+        self.client = RetryClient(max_retries=config.max_retries,
+                                  limiter=config.rate_limiter,
+                                  concurrency=config.concurrency_limiter,
+                                  cookie_jar=aiohttp.DummyCookieJar())
+        await self.writer.__aenter__()
+        await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.client.__aexit__(*args)
+        await self.writer.__aexit__(*args)
+
+    async def lookup(self, tax_id: str) -> Union[dict, None]:
+        # Only well-formed tax IDs reach the database and the origin
+        if not tax_id.isascii() or encode_tax_id(tax_id) == None:
+            raise ValueError(f"Invalid tax ID {tax_id}")
+        start = time.perf_counter()
+        found, record = self.cache.get(tax_id)
+        if found:
+            self.__record("cache", start)
+            return record
+
+        future = self.inflight.get(tax_id)
+        coalesced = future != None
+        if future == None:
+            future = asyncio.ensure_future(self.__load(tax_id))
+            self.inflight[tax_id] = future
+            future.add_done_callback(lambda _: self.inflight.pop(tax_id, None))
+        # A caller which goes away does not cancel the load for the others
+        record, source = await asyncio.shield(future)
+        self.__record("coalesced" if coalesced else source, start)
+        return record
+
+    async def search(self, text: str, limit: int = 20, offset: int = 0,
+                     columns: list[str] = None) -> list[dict]:
+        # Stored corporates only, the origin is not searched
+        corporates = await asyncio.to_thread(self.search_index.search, text, limit, offset, columns)
+        return [json_record(corporate_dict(corporate)) for corporate in corporates]
+
+    def __record(self, source: str, start: float):
+        metrics.lookup_results.inc(source=source)
+        metrics.lookup_seconds.observe(time.perf_counter() - start, source=source)
+
+    async def __load(self, tax_id: str) -> tuple[Union[dict, None], str]:
+        row = await asyncio.to_thread(self._load_row, tax_id)
+        if row != None and row["fetched_at"] != None and utcnow() - row["fetched_at"] < config.recrawl_interval:
+            record, source = row, "database"
+        else:
+            record = await self.__fetch(tax_id, row)
+            source = "origin"
+            if record == None and row != None:
+                # Serve the stale row rather than nothing
+                record, source = row, "stale"
+            elif record == None:
+                source = "missing"
+
+        if record != None:
+            record = json_record(record)
+        self.cache.put(tax_id, record)
+        return record, source
+
+    async def __fetch(self, tax_id: str, row: Union[dict, None]) -> Union[dict, None]:
+        try:
+            url = await self.__detail_url(tax_id)
+            if url == None:
+                return None
+            corporate = await self.crawler._extract_corporate_info(self.client, url)
+        except Exception as err:
+            logger.error(f"Failed to look up tax ID {tax_id} with error {err}")
+            return None
+        if corporate == None or corporate.tax_id != tax_id:
+            return None
+
+        if row != None:
+            corporate.region_id = row["region_id"]
+        await self.writer.put(corporate)
+        return corporate_dict(corporate)
+
+    async def __detail_url(self, tax_id: str) -> Union[str, None]:
+        # Detail urls carry a slug of the name, so they come from the
+        # frontier or from the search of the origin
+        url = await asyncio.to_thread(self._known_url, tax_id)
+        if url != None:
+            return url
+
+        async with self.client.get("/Search/", params={"q": tax_id, "type": "auto", "force-search": 1},
+                                   allow_redirects=False) as resp:
+            if 300 <= resp.status < 400:
+                # Exact matches redirect to the detail page of the origin
+                return urlsplit(resp.headers.get("Location", "")).path or None
+            if not resp.ok:
+                return None
+            content = await resp.read()
+            encoding = resp.charset or "utf-8"
+
+        result = await config.parser.parse(parse_search, content, encoding)
+        for url in result["urls"]:
+            if tax_id_from_url(url) == tax_id:
+                return url
+        return None
+
+    def _load_row(self, tax_id: str) -> Union[dict, None]:
+        with SqlSession(self.storage_engine) as session:
+            corporate = session.get(Corporate, tax_id)
+            return corporate_dict(corporate) if corporate != None else None
+
+    def _known_url(self, tax_id: str) -> Union[str, None]:
+        # Urls starting with "/{tax_id}-", as a range so that the primary
+        # key index is used. "." sorts right after "-".
+        with SqlSession(self.storage_engine) as session:
+            query = session.query(FrontierDetailUrl.url).where(
+                FrontierDetailUrl.url >= f"/{tax_id}-",
+                FrontierDetailUrl.url < f"/{tax_id}.",
+            )
+            for url, in query:
+                if tax_id_from_url(url) == tax_id:
+                    return url
+        return None
+
+
+class LookupServer:
+    def __init__(self, service: LookupService, port: int, host: str = "127.0.0.1"):
+        self.service = service
+        self.port = port
+        self.host = host
+        self.runner: web.AppRunner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/corporates/{tax_id}", self.handle_lookup)
+        if config.search_index:
+            app.router.add_get("/corporates", self.handle_search)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving tax ID lookups on http://{self.host}:{self.port}/corporates/{{tax_id}}")
+
+    async def stop(self):
+        if self.runner != None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_lookup(self, request: web.Request) -> web.Response:
+        tax_id = request.match_info["tax_id"]
+        try:
+            record = await self.service.lookup(tax_id)
+        except ValueError as err:
+            return web.json_response({"error": str(err)}, status=400)
+        if record == None:
+            return web.json_response({"error": f"Unknown tax ID {tax_id}"}, status=404)
+        return web.json_response(record)
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        # /corporates?q=<words>[&column=name][&limit=20][&offset=0]
+        text = request.query.get("q", "")
+        columns = request.query.getall("column", None)
+        try:
+            limit = min(int(request.query.get("limit", "20")), 100)
+            offset = int(request.query.get("offset", "0"))
+            records = await self.service.search(text, limit, offset, columns)
+        except ValueError as err:
+            return web.json_response({"error": str(err)}, status=400)
+        return web.json_response(records)
+
+
+async def main():
+    await config.metrics.start()
+    config.output_path.mkdir(exist_ok=True)
+    storage_engine = create_storage_engine(config.db_url)
+
+    server = None
+    try:
+        await config.start_egress()
+        async with LookupService(storage_engine, config.lookup_cache_size,
+                                 config.lookup_cache_seconds) as service:
+            server = LookupServer(service, config.lookup_port)
+            await server.start()
+            await asyncio.Event().wait()
+    finally:
+        if server != None:
+            await server.stop()
+        await config.close_egress()
+        await config.close_connector()
+        config.parser.close()
+        await config.metrics.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
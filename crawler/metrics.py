@@ -0,0 +1,281 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from aiohttp import web
+from loguru import logger
+
+# Low level modules record into these metrics, so this module must not
+# import .common
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _format_labels(names: tuple[str], values: tuple[str], extra: str = None) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra != None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) != 0 else ""
+
+
+def _format_key(values: tuple[str]) -> str:
+    return "/".join(str(value) for value in values)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+    def summary(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}[{_format_key(key)}] {value:g}" for key, value in values]
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, func: Callable[[], float]):
+        # Gauges are read from `func` when they are collected
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def value(self) -> float:
+        try:
+            return float(self.func())
+        except Exception:
+            return float("nan")
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self.value()}"]
+
+    def summary(self) -> list[str]:
+        return [f"{self.name} {self.value():g}"]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str] = (),
+                 buckets: tuple[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label values: bucket counts (the last one is +Inf), sum, count
+        self.values: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state == None:
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, counts: list[int], count: int, q: float) -> float:
+        # Upper bound of the bucket which holds the quantile
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = _format_labels(self.labels, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+    def summary(self) -> list[str]:
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        return [
+            f"{self.name}[{_format_key(key)}] count={count} mean={total / count:.4g} "
+            f"p50<={self.quantile(counts, count, 0.5):g} p99<={self.quantile(counts, count, 0.99):g}"
+            for key, counts, total, count in values if count != 0
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, object] = {}
+
+    def counter(self, name: str, help: str, labels: tuple[str] = ()) -> Counter:
+        return self.__register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, func: Callable[[], float]) -> Gauge:
+        return self.__register(Gauge(name, help, func))
+
+    def histogram(self, name: str, help: str, labels: tuple[str] = (),
+                  buckets: tuple[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.summary())
+        return "\n".join(lines)
+
+    def __register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+
+registry = MetricsRegistry()
+
+fetch_seconds = registry.histogram(
+    "crawler_fetch_seconds", "Time until response headers of one attempt", ("gateway", "method"))
+fetch_responses = registry.counter(
+    "crawler_fetch_responses_total", "Responses by status", ("gateway", "status"))
+fetch_errors = registry.counter(
+    "crawler_fetch_errors_total", "Attempts failed without a response", ("gateway",))
+fetch_retries = registry.counter(
+    "crawler_fetch_retries_total", "Attempts which were retried", ("gateway",))
+
+limiter_wait_seconds = registry.histogram(
+    "crawler_limiter_wait_seconds", "Time spent waiting for a rate limiter token", ("gateway",))
+
+breaker_transitions = registry.counter(
+    "crawler_breaker_transitions_total", "Circuit breaker state changes", ("gateway", "state"))
+
+gateway_create_seconds = registry.histogram(
+    "crawler_gateway_create_seconds", "API Gateway creation time")
+gateway_delete_seconds = registry.histogram(
+    "crawler_gateway_delete_seconds", "API Gateway deletion time")
+
+parse_seconds = registry.histogram(
+    "crawler_parse_seconds", "Parse time of one page in a parser worker", ("page",))
+parse_queue_seconds = registry.histogram(
+    "crawler_parse_queue_seconds", "Time a page waited for a parser worker", ("page",))
+
+flush_seconds = registry.histogram(
+    "crawler_storage_flush_seconds", "Duration of one storage flush")
+flush_rows = registry.histogram(
+    "crawler_storage_flush_rows", "Rows written by one storage flush", buckets=SIZE_BUCKETS)
+
+lookup_results = registry.counter(
+    "crawler_lookup_results_total", "Tax ID lookups by where they were answered from", ("source",))
+lookup_seconds = registry.histogram(
+    "crawler_lookup_seconds", "Time to answer one tax ID lookup", ("source",))
+
+search_seconds = registry.histogram(
+    "crawler_search_seconds", "Time to answer one full-text search of corporates")
+
+sitemap_entries = registry.counter(
+    "crawler_sitemap_entries_total", "Entries read from sitemaps", ("kind",))
+region_resolutions = registry.counter(
+    "crawler_region_resolutions_total", "Regions of sitemap corporates found from their address", ("level",))
+
+dedup_skips = registry.counter(
+    "crawler_dedup_skips_total", "Detail pages skipped before fetching", ("reason",))
+
+
+class MetricsReporter:
+    # Serves the registry on a local Prometheus endpoint and logs a summary
+    # periodically, either is disabled with 0
+    def __init__(self, registry: MetricsRegistry, port: int = 0,
+                 interval: float = 0, host: str = "127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.interval = interval
+        self.host = host
+        self.runner: web.AppRunner = None
+        self.task: asyncio.Task = None
+
+    async def start(self):
+        if self.port != 0:
+            app = web.Application()
+            app.router.add_get("/metrics", self.handle_metrics)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        if self.interval > 0:
+            self.task = asyncio.create_task(self.__report())
+
+    async def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+            self.log_summary()
+        if self.runner != None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    def log_summary(self):
+        summary = self.registry.summary()
+        if summary != "":
+            logger.info(f"Metrics summary\n{summary}")
+
+    async def __report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.log_summary()
@@ -0,0 +1,189 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable
+
+from lxml import etree
+
+from . import metrics
+
+# Functions in this module run inside worker processes, so they only take and
+# return plain data and must not depend on the crawler configuration
+
+
+@dataclass
+class FieldSpec:
+    name: str
+    # Rows of the info table are only queried for the field if their
+    # signature (itemprops, icon classes, button targets) contains `key`
+    key: str
+    # XPath relative to the row, or to the document if `key` is None
+    value: str
+
+
+CORPORATE_FIELDS = [
+    FieldSpec("tax_id", "taxID", './td[@itemprop="taxID"]/span/text()'),
+    FieldSpec("name", "name", './th[@itemprop="name"]/span/text()'),
+    FieldSpec("international_name", "fa-globe", './td[@itemprop="alternateName"]/span/text()'),
+    FieldSpec("short_name", "fa-reorder", './td[@itemprop="alternateName"]/span/text()'),
+    FieldSpec("representative", "name", './td/span[@itemprop="name"]/a/text()'),
+    FieldSpec("company_type", "fa-building", './td[i[contains(@class, "fa-building")]]/following-sibling::td/a/text()'),
+    FieldSpec("industry", None, '//h3[contains(text(), "Ngành nghề kinh doanh")]//following-sibling::table//td/strong/a/text()'),
+    FieldSpec("address", "address", './td[@itemprop="address"]/span/text()'),
+    FieldSpec("phone", "telephone", './td[@itemprop="telephone"]/span/text()'),
+    FieldSpec("active_date", "fa-calendar", './td[i[contains(@class, "fa-calendar")]]/following-sibling::td/span/text()'),
+    FieldSpec("status", "fa-info", './td[i[contains(@class, "fa-info")]]/following-sibling::td/a/text()'),
+    FieldSpec("last_update", "#modal-update", './/button[@data-target = "#modal-update"]/preceding-sibling::em/text()'),
+]
+
+
+class CorporateExtractor:
+    _tables = etree.XPath('//table[@class = "table-taxinfo"]')
+    _rows = etree.XPath('.//tr')
+    _signature = etree.XPath('.//@itemprop | ./td/i/@class | .//button/@data-target')
+
+    def __init__(self, fields: list[FieldSpec] = CORPORATE_FIELDS):
+        self.fields = fields
+        self.row_fields = [
+            (field.name, field.key, etree.XPath(field.value))
+            for field in fields if field.key != None
+        ]
+        self.document_fields = [
+            (field.name, etree.XPath(field.value))
+            for field in fields if field.key == None
+        ]
+
+    def extract(self, document: etree._Element) -> dict[str, str]:
+        values: dict[str, list] = {}
+
+        # Find the info table once and query each row only for its fields
+        for table in self._tables(document):
+            for row in self._rows(table):
+                signature = " ".join(self._signature(row))
+                for name, key, query in self.row_fields:
+                    if key in signature:
+                        results = query(row)
+                        if len(results) != 0:
+                            values.setdefault(name, []).extend(results)
+
+        for name, query in self.document_fields:
+            results = query(document)
+            if len(results) != 0:
+                values[name] = results
+
+        return {
+            field.name: " ".join(str(result) for result in values[field.name])
+            for field in self.fields if field.name in values
+        }
+
+
+corporate_extractor = CorporateExtractor()
+
+# Parsers are reused per encoding, but an lxml parser must not be used by
+# several threads at once, so each worker thread keeps its own
+_local = threading.local()
+
+
+def parse_html(content: bytes, encoding: str = "utf-8") -> etree._Element:
+    parsers: dict[str, etree.HTMLParser] = getattr(_local, "html_parsers", None)
+    if parsers == None:
+        parsers = _local.html_parsers = {}
+    parser = parsers.get(encoding)
+    if parser == None:
+        parser = etree.HTMLParser(encoding=encoding)
+        parsers[encoding] = parser
+    return etree.fromstring(content, parser)
+
+
+def parse_corporate(content: bytes, encoding: str = "utf-8") -> dict[str, str]:
+    document = parse_html(content, encoding)
+    return corporate_extractor.extract(document)
+
+
+def parse_search(content: bytes, encoding: str = "utf-8") -> dict:
+    document = parse_html(content, encoding)
+
+    # Extract page count
+    query = '//ul[@class = "page-numbers"]//a[@class = "page-numbers"]/text()'
+    max_page = 0
+    for page_elem in document.xpath(query):
+        try:
+            page_no = int(page_elem)
+        except ValueError:
+            page_no = 0
+        max_page = max(max_page, page_no)
+
+    # Extract urls
+    query = '//div[@class = "tax-listing"]//div[@data-prefetch != ""]//h3//a/@href'
+    urls = [str(element) for element in document.xpath(query)]
+
+    return {"max_page": max_page, "urls": urls}
+
+
+def parse_regions(content: bytes, encoding: str = "utf-8") -> dict:
+    document = parse_html(content, encoding)
+    regions = []
+    errors = 0
+    for elem in document.xpath('//div[@id = "sidebar"]//ul/li'):
+        try:
+            url = str(elem.xpath('.//a/@href')[0])
+            name = str(elem.xpath('.//a//text()')[0])
+            id = url.split("-")[-1]
+        except Exception:
+            errors += 1
+            continue
+        regions.append({"id": id, "name": name, "url": url})
+
+    return {"regions": regions, "errors": errors}
+
+
+def timed_parse(func: Callable, content: bytes, encoding: str = "utf-8") -> tuple:
+    # Measures parse time inside the worker, apart from queueing
+    start = time.perf_counter()
+    result = func(content, encoding)
+    return result, time.perf_counter() - start
+
+
+def page_type(func: Callable) -> str:
+    # parse_corporate => corporate, also through partial(parse_blob, ...)
+    while isinstance(func, partial):
+        func = func.args[0] if len(func.args) != 0 and callable(func.args[0]) else func.func
+    return getattr(func, "__name__", "unknown").removeprefix("parse_")
+
+
+class ParsingEngine:
+    def __init__(self, workers: int = None, executor: str = "process"):
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown parsing executor {executor}, expected process or thread")
+        self.workers = workers or multiprocessing.cpu_count()
+        self.executor_type = executor
+        self.executor: Executor = None
+
+    async def parse(self, func: Callable, content: bytes, encoding: str = "utf-8"):
+        if self.executor == None:
+            self.executor = self.__new_executor()
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        result, parse_time = await loop.run_in_executor(self.executor, timed_parse, func, content, encoding)
+        page = page_type(func)
+        metrics.parse_seconds.observe(parse_time, page=page)
+        metrics.parse_queue_seconds.observe(max(0.0, time.perf_counter() - start - parse_time), page=page)
+        return result
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def __new_executor(self) -> Executor:
+        if self.executor_type == "thread":
+            # lxml releases the GIL while parsing
+            return ThreadPoolExecutor(self.workers, thread_name_prefix="parser")
+
+        # Forking a process with running threads is unsafe, spawn instead
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(self.workers, mp_context=context)
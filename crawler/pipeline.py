@@ -0,0 +1,74 @@
+import asyncio
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, Union
+
+from .common import logger
+
+
+class Stage:
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[None]],
+                 workers: int, queue_size: int):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks: list[asyncio.Task] = []
+
+    async def put(self, item):
+        # Blocks while the stage is saturated, which throttles upstream stages
+        await self.queue.put(item)
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.__work()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def __work(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.handler(item)
+            except Exception as err:
+                logger.exception(f"Stage {self.name} failed to handle {item}: {err}")
+            finally:
+                self.queue.task_done()
+
+
+class Pipeline:
+    def __init__(self):
+        self.stages: list[Stage] = []
+
+    def add_stage(self, name: str, handler: Callable[[Any], Awaitable[None]],
+                  workers: int, queue_size: int) -> Stage:
+        stage = Stage(name, handler, workers, queue_size)
+        self.stages.append(stage)
+        return stage
+
+    @property
+    def queue_depths(self) -> dict[str, int]:
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    async def run(self, source: Union[Iterable, AsyncIterable]):
+        for stage in self.stages:
+            stage.start()
+
+        try:
+            head = self.stages[0]
+            if hasattr(source, "__aiter__"):
+                async for item in source:
+                    await head.put(item)
+            else:
+                for item in source:
+                    await head.put(item)
+
+            # Items only flow downstream, so stages drain in order
+            for stage in self.stages:
+                await stage.queue.join()
+        finally:
+            for stage in self.stages:
+                await stage.stop()
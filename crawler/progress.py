@@ -0,0 +1,249 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+from collections import deque
+from typing import Callable, Union
+
+from loguru import logger
+from . import metrics
+
+# Created with the configuration, so this module must not import .common
+
+PROGRESS_MODES = ("log", "dashboard", "off")
+OUTCOMES = ("stored", "unchanged", "skipped", "failed")
+
+
+class ProvinceProgress:
+    def __init__(self, name: str):
+        self.name = name
+        self.wards: set[str] = set()
+        self.done: set[str] = set()
+        # Wards finished by this run, which the ETA is estimated from
+        self.finished = 0
+        self.corporates = 0
+        self.started_at: float = None
+
+    @property
+    def remaining(self) -> int:
+        return len(self.wards) - len(self.done)
+
+    def eta(self, now: float) -> Union[float, None]:
+        # Seconds until every known ward is done at the rate so far
+        if self.remaining == 0:
+            return 0.0
+        if self.finished == 0 or self.started_at == None:
+            return None
+        return self.remaining * (now - self.started_at) / self.finished
+
+
+class ProgressTracker:
+    # Aggregated progress of a crawl, cheap enough to update per record.
+    # Wards are grouped by province through the district they belong to.
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.provinces: dict[str, ProvinceProgress] = {}
+        self.district_provinces: dict[str, str] = {}
+        self.ward_provinces: dict[str, str] = {}
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.queues: dict[str, Callable[[], int]] = {}
+
+    def add_regions(self, regions: list):
+        for region in regions:
+            if region.level == 1:
+                self.__province(region.id, region.name)
+            elif region.level == 2:
+                self.district_provinces[region.id] = region.parent_id
+            elif region.level == 3:
+                province_id = self.district_provinces.get(region.parent_id)
+                self.ward_provinces[region.id] = province_id
+                self.__province(province_id).wards.add(region.id)
+
+    def ward_done(self, region, resumed: bool = False):
+        # Wards done by an earlier run count as done but not towards the rate
+        province = self.__province(self.ward_provinces.get(region.id))
+        province.wards.add(region.id)
+        if region.id in province.done:
+            return
+        province.done.add(region.id)
+        if not resumed:
+            province.finished += 1
+
+    def ward_started(self, region):
+        province = self.__province(self.ward_provinces.get(region.id))
+        if province.started_at == None:
+            province.started_at = time.monotonic()
+
+    def record(self, region_id: Union[str, None], outcome: str, count: int = 1):
+        self.outcomes[outcome] += count
+        if outcome == "stored" and region_id != None:
+            self.__province(self.ward_provinces.get(region_id)).corporates += count
+
+    def watch_pipeline(self, pipeline):
+        for stage in pipeline.stages:
+            self.queues[stage.name] = stage.queue.qsize
+
+    def watch_queue(self, name: str, queue: asyncio.Queue):
+        self.queues[name] = queue.qsize
+
+    def __province(self, province_id: Union[str, None], name: str = None) -> ProvinceProgress:
+        province = self.provinces.get(province_id)
+        if province == None:
+            province = ProvinceProgress(name or province_id or "Unknown province")
+            self.provinces[province_id] = province
+        elif name != None:
+            province.name = name
+        return province
+
+
+def _format_duration(seconds: Union[float, None]) -> str:
+    if seconds == None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+class ProgressReporter:
+    # Reports the tracker and the health of the gateways every `interval`
+    # seconds, as one log line or on a live terminal dashboard. The
+    # dashboard needs a terminal and takes it over, log messages of
+    # warning level and above are shown in it.
+    def __init__(self, tracker: ProgressTracker, mode: str = "log", interval: float = 10.0,
+                 provinces: int = 5, console: Callable[[bool], None] = None):
+        if mode not in PROGRESS_MODES:
+            raise ValueError(f"Unknown progress mode {mode}, expected one of {PROGRESS_MODES}")
+        self.tracker = tracker
+        self.mode = mode
+        self.interval = interval
+        # Provinces listed in the log line, the slowest ones first
+        self.provinces = provinces
+        # Turns logging to the terminal off and on around the dashboard
+        self.console = console
+        self.task: asyncio.Task = None
+        self.app = None
+        self.messages: deque[str] = deque(maxlen=8)
+        self.message_sink: int = None
+        self.last: tuple[float, float, float] = None
+
+    @property
+    def dashboard(self) -> bool:
+        return self.mode == "dashboard" and sys.stdout.isatty()
+
+    async def start(self):
+        if self.mode == "off" or self.interval <= 0 or self.task != None:
+            return
+        if self.mode == "dashboard" and not self.dashboard:
+            logger.warning("The progress dashboard needs a terminal, logging progress instead")
+        corporates, requests, _ = self.__totals()
+        self.last = (time.monotonic(), corporates, requests)
+        runner = self.__run_dashboard() if self.dashboard else self.__report()
+        self.task = asyncio.create_task(runner)
+
+    async def stop(self):
+        if self.task == None:
+            return
+        if self.app != None and self.app.is_running:
+            self.app.exit()
+        else:
+            self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        self.log_progress()
+
+    def log_progress(self):
+        lines = self.status_lines()
+        logger.info(" | ".join(lines[:4]))
+        provinces = self.province_lines(self.provinces)
+        if len(provinces) != 0:
+            logger.info("ETA " + "; ".join(provinces))
+
+    def status_lines(self) -> list[str]:
+        now = time.monotonic()
+        corporates, requests, retries = self.__totals()
+        last_at, last_corporates, last_requests = self.last or (self.tracker.started_at, 0, 0)
+        elapsed = max(now - last_at, 1e-9)
+        self.last = (now, corporates, requests)
+
+        outcomes = self.tracker.outcomes
+        queues = " ".join(f"{name}={size()}" for name, size in self.tracker.queues.items())
+        gauges = metrics.registry.metrics
+        return [
+            f"{(corporates - last_corporates) / elapsed:.1f} corporates/s, "
+            f"{(requests - last_requests) / elapsed:.1f} requests/s",
+            f"stored={outcomes['stored']} unchanged={outcomes['unchanged']} "
+            f"skipped={outcomes['skipped']} failed={outcomes['failed']}",
+            f"queues {queues or '-'} limiter={gauges['crawler_limiter_queue_depth'].value():g} "
+            f"in_flight={gauges['crawler_concurrency_in_flight'].value():g}"
+            f"/{gauges['crawler_concurrency_limit'].value():g}",
+            f"gateways active={gauges['crawler_gateways_active'].value():g} "
+            f"spare={gauges['crawler_gateways_spare'].value():g} "
+            f"open={gauges['crawler_breakers_open'].value():g} retries={retries:g} "
+            f"rate={gauges['crawler_limiter_total_rate'].value():.1f}/s",
+            f"elapsed {_format_duration(now - self.tracker.started_at)}",
+        ]
+
+    def province_lines(self, limit: int = None) -> list[str]:
+        # Unfinished provinces, the one which finishes last first
+        now = time.monotonic()
+        provinces = [province for province in self.tracker.provinces.values()
+                     if province.remaining != 0 and province.started_at != None]
+        provinces.sort(key=lambda province: province.eta(now) or float("inf"), reverse=True)
+        return [
+            f"{province.name} {len(province.done)}/{len(province.wards)} wards "
+            f"{province.corporates} corporates {_format_duration(province.eta(now))}"
+            for province in provinces[:limit]
+        ]
+
+    def __totals(self) -> tuple[float, float, float]:
+        return (self.tracker.outcomes["stored"], metrics.fetch_responses.total(),
+                metrics.fetch_retries.total())
+
+    async def __report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.log_progress()
+
+    async def __run_dashboard(self):
+        from prompt_toolkit.application import Application
+        from prompt_toolkit.key_binding import KeyBindings
+        from prompt_toolkit.layout import Layout, Window
+        from prompt_toolkit.layout.controls import FormattedTextControl
+
+        # The terminal no longer delivers SIGINT, the crawl is stopped the
+        # same way from the dashboard
+        bindings = KeyBindings()
+
+        @bindings.add("c-c")
+        @bindings.add("q")
+        def _(event):
+            os.kill(os.getpid(), signal.SIGINT)
+
+        self.app = Application(
+            layout=Layout(Window(FormattedTextControl(self.__render), wrap_lines=False)),
+            key_bindings=bindings, full_screen=True, refresh_interval=min(self.interval, 1.0),
+        )
+        self.message_sink = logger.add(
+            lambda message: self.messages.append(message.record["message"].splitlines()[0]),
+            level="WARNING", format="{message}",
+        )
+        if self.console != None:
+            self.console(False)
+        try:
+            await self.app.run_async()
+        finally:
+            logger.remove(self.message_sink)
+            if self.console != None:
+                self.console(True)
+            self.app = None
+
+    def __render(self) -> str:
+        lines = ["Corporate info crawler, press q to stop", ""]
+        lines += self.status_lines()
+        lines += ["", "Provinces in progress, slowest first"]
+        lines += self.province_lines() or ["-"]
+        if len(self.messages) != 0:
+            lines += ["", "Recent warnings"] + list(self.messages)
+        return "\n".join(lines)
@@ -1,53 +1,151 @@
 import asyncio
-from datetime import datetime, timedelta
+import time
+from collections import deque
+from typing import Optional
+
+from . import metrics
+
+THROTTLE_STATUSES = {403, 429}
+
+
+def is_throttled(status: Optional[int]) -> bool:
+    # Server errors are not throttling, they are left to circuit breakers
+    return status in THROTTLE_STATUSES
+
+
+class TokenBucket:
+    def __init__(self, rate: float, min_rate: float, max_rate: float,
+                 increase: float, decrease: float, cooldown: float = 1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.decreased_at = 0.0
+
+        # Waiters park on futures which are resolved by a single timer
+        self.waiters: deque[asyncio.Future] = deque()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def capacity(self) -> float:
+        return max(1.0, self.rate)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.waiters)
+
+    def ready(self) -> bool:
+        # A token can be taken without waiting
+        self.__refill()
+        return len(self.waiters) == 0 and self.tokens >= 1.0
+
+    async def acquire(self):
+        self.__refill()
+        if len(self.waiters) == 0 and self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.__schedule()
+        await future
+
+    def on_success(self):
+        # Additive increase: about `increase` requests/sec per second
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttled(self):
+        # Multiplicative decrease, at most once per cooldown period so that a
+        # burst of in-flight failures does not collapse the rate to the floor
+        now = time.monotonic()
+        if now - self.decreased_at < self.cooldown:
+            return
+        self.decreased_at = now
+        self.__refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def __refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def __schedule(self):
+        if self.timer != None or len(self.waiters) == 0:
+            return
+        delay = max(0.0, (1.0 - self.tokens) / self.rate)
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_later(delay, self.__wakeup)
+
+    def __wakeup(self):
+        self.timer = None
+        self.__refill()
+        while len(self.waiters) != 0 and self.tokens >= 1.0:
+            future = self.waiters.popleft()
+            if future.done():
+                # Cancelled waiter does not consume a token
+                continue
+            future.set_result(None)
+            self.tokens -= 1.0
+
+        while len(self.waiters) != 0 and self.waiters[0].done():
+            self.waiters.popleft()
+        self.__schedule()
 
 
 class RateLimiter:
-    def __init__(self, requests_per_sec: int):
+    def __init__(self, requests_per_sec: float, min_requests_per_sec: float = None,
+                 max_requests_per_sec: float = None, increase: float = 1.0,
+                 decrease: float = 0.5):
         self.limit = requests_per_sec
-        self.current_count = 0
+        self.min_limit = min_requests_per_sec or min(1.0, requests_per_sec)
+        self.max_limit = max_requests_per_sec or 4 * requests_per_sec
+        self.increase = increase
+        self.decrease = decrease
+
+        # One token bucket per gateway endpoint
+        self.buckets: dict[str, TokenBucket] = {}
 
-        # history hold timestamps of successful acquire calls
-        # maximum number of element in history is self.limit
-        self.history = [datetime.now()]
+    def bucket(self, key: str) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket == None:
+            bucket = TokenBucket(self.limit, self.min_limit, self.max_limit,
+                                 self.increase, self.decrease)
+            self.buckets[key] = bucket
+        return bucket
 
     @property
-    def average_elapsed_time(self) -> float:
-        if len(self.history) <= 1:
-            return 0.0
+    def total_rate(self) -> float:
+        return sum(bucket.rate for bucket in self.buckets.values())
 
-    async def acquire(self):
-        # Acquire lock
-        while self.current_count >= self.limit:
-            await asyncio.sleep(1.0 / self.limit)
-        self.current_count += 1
-
-        # Lock acquired
-        # Check if in cool down period
-        if len(self.history) < self.limit:
-            current_time = datetime.now()
-            self.history.append(current_time)
+    @property
+    def queue_depth(self) -> int:
+        return sum(bucket.queue_depth for bucket in self.buckets.values())
+
+    def ready(self, key: str) -> bool:
+        bucket = self.buckets.get(key)
+        return bucket == None or bucket.ready()
+
+    async def acquire(self, key: str):
+        with metrics.limiter_wait_seconds.time(gateway=key):
+            await self.bucket(key).acquire()
+
+    def feedback(self, key: str, status: Optional[int]):
+        bucket = self.buckets.get(key)
+        if bucket == None or status == None:
             return
+        # Server errors are left to the circuit breaker of the gateway
+        if is_throttled(status):
+            bucket.on_throttled()
+        elif status < 400:
+            bucket.on_success()
 
-        # Currently in cool down period
-        # Wait untill the period pass
-        while True:
-            current_time = datetime.now()
-            elapsed_time = (current_time - self.history[0]).total_seconds()
-            if elapsed_time >= 1:
-                self.history.pop(0)
-                self.history.append(current_time)
-                return
-            remain_time = self.history[0] + timedelta(seconds=1) - current_time
-            await asyncio.sleep(remain_time.total_seconds())
-
-    async def release(self):
-        self.current_count -= 1
-        await asyncio.sleep(0.0)
-
-    async def __aenter__(self):
-        await self.acquire()
-        return self
-
-    async def __aexit__(self, *args, **kwargs):
-        await self.release()
+    def discard(self, key: str):
+        # Pending waiters keep a reference to the bucket and are still served
+        self.buckets.pop(key, None)
@@ -1,6 +1,6 @@
 import asyncio
 import aiohttp
-from lxml import etree
+from typing import AsyncIterator, Union
 
 import sqlalchemy
 from sqlalchemy import Engine as SqlEngine
@@ -8,7 +8,10 @@ from sqlalchemy.orm import Session as SqlSession
 from sqlalchemy import Column as SqlColumn, String as SqlString, Integer as SqlInteger
 
 from .common import *
-from .ratelimit import RateLimiter
+from .frontier import Frontier, ROOT_REGION_ID
+from .parser import parse_regions
+from .pipeline import Pipeline
+from .storage import StorageWriter, add_missing_indexes, create_tables
 from .retry_client import RetryClient
 
 
@@ -19,15 +22,16 @@ class Region(SqlTableBase):
     __tablename__ = "regions"
     id = SqlColumn(SqlString, primary_key=True)
     name = SqlColumn(SqlString)
-    level = SqlColumn(SqlInteger)
+    level = SqlColumn(SqlInteger, index=True)
     level_name = SqlColumn(SqlString)
     url = SqlColumn(SqlString)
-    parent_id = SqlColumn(SqlString)
+    parent_id = SqlColumn(SqlString, index=True)
     parent_name = SqlColumn(SqlString)
 
     @classmethod
     def create_table(Self, engine: sqlalchemy.Engine):
-        Self.metadata.create_all(engine)
+        create_tables(engine)
+        add_missing_indexes(engine, Self.__table__)
 
     def __str__(self) -> str:
         self_repr = f"{self.id} {self.level_name} {self.name}"
@@ -38,33 +42,101 @@ class Region(SqlTableBase):
 
 
 class RegionCrawler:
-    def __init__(self,  storage_engine: SqlEngine):
+    def __init__(self,  storage_engine: SqlEngine, frontier: Frontier = None):
         self.storage_engine = storage_engine
         Region.create_table(self.storage_engine)
-        self.limiter = RateLimiter(config.rate_limiter)
+        self.frontier = frontier or Frontier(storage_engine, resume=config.resume)
 
     async def crawl(self):
-        async with RetryClient(max_retries=config.max_retries,
-                               limiter=config.rate_limiter,
-                               cookie_jar=aiohttp.DummyCookieJar()) as client:
-            await self._crawl_first_level(client)
-            await self._crawl_other_level(client, level=2)
-            await self._crawl_other_level(client, level=3)
-
-    async def _extract_region_info(self, client: RetryClient, url: str, level: int, parent_region: Region = None):
+        async for _ in self.crawl_wards():
+            pass
+
+    async def crawl_wards(self) -> AsyncIterator[Region]:
+        # Yields regions at level 3 as soon as they are stored, while the
+        # rest of the tree is still being crawled
+        wards = asyncio.Queue()
+        task = asyncio.create_task(self._crawl_tree(wards))
+        try:
+            while True:
+                ward = await wards.get()
+                if ward == None:
+                    break
+                yield ward
+            await task
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _crawl_tree(self, wards: asyncio.Queue):
+        # Sub-regions are queued as soon as their parent page is parsed, so
+        # levels overlap. Ancestry is kept in memory.
+        writer = StorageWriter(self.storage_engine,
+                               batch_size=config.write_batch_size,
+                               flush_interval=config.write_flush_interval)
+        self.frontier.register(writer)
+        self.wards = wards
+        self.done_regions = self.frontier.done_regions("subregions")
+        self.known_subregions = self._load_known_subregions() if len(self.done_regions) != 0 else {}
+
+        try:
+            async with RetryClient(max_retries=config.max_retries,
+                                   limiter=config.rate_limiter,
+                                   concurrency=config.concurrency_limiter,
+                                   cookie_jar=aiohttp.DummyCookieJar()) as client, writer:
+                self.client = client
+                self.writer = writer
+                pipeline = Pipeline()
+                # Unbounded, workers queue the sub-regions they find
+                self.region_stage = pipeline.add_stage(
+                    "regions", self._region_worker, config.region_workers, 0
+                )
+                config.progress.watch_pipeline(pipeline)
+                await pipeline.run([None])
+        finally:
+            await wards.put(None)
+
+    async def _region_worker(self, parent_region: Union[Region, None]):
+        level = parent_region.level + 1 if parent_region != None else 1
+        parent_id = parent_region.id if parent_region != None else ROOT_REGION_ID
+
+        if parent_id in self.done_regions:
+            regions = self.known_subregions.get(parent_id, [])
+        else:
+            url = parent_region.url if parent_region != None else "/"
+            regions = await self._extract_region_info(self.client, url, level, parent_region)
+            if level == 3:
+                # Corporates of a ward reference it, store it first
+                await self.writer.join()
+            logger.debug("Got all sub-regions of {}", parent_region or "the root page")
+
+        config.progress.add_regions(regions)
+        for region in regions:
+            if level == 3:
+                await self.wards.put(region)
+            else:
+                await self.region_stage.put(region)
+
+    def _load_known_subregions(self) -> dict[str, list[Region]]:
+        # Sub-regions of regions finished by an earlier run
+        subregions = {}
+        with SqlSession(self.storage_engine) as session:
+            for region in session.query(Region):
+                parent_id = region.parent_id or ROOT_REGION_ID
+                if parent_id in self.done_regions:
+                    subregions.setdefault(parent_id, []).append(region)
+        return subregions
+
+    async def _extract_region_info(self, client: RetryClient, url: str, level: int,
+                                   parent_region: Region = None) -> list[Region]:
         # Fetch content from url
         async with client.get(url) as resp:
             if not resp.ok:
                 logger.error(
                     f"Failed to get data from {url} with status {resp.status}"
                 )
-                return
-            content = await resp.text()
-
-        # Extract data from response
-        document = etree.HTML(content)
-        query = '//div[@id = "sidebar"]//ul/li'
-        regions = []
+                return []
+            content = await resp.read()
+            encoding = resp.charset or "utf-8"
 
         if parent_region != None:
             parent_id = parent_region.id
@@ -73,52 +145,36 @@ class RegionCrawler:
             parent_id = None
             parent_name = None
 
-        for elem in document.xpath(query):
-            try:
-                url = elem.xpath('.//a/@href')[0]
-                name = elem.xpath('.//a//text()')[0]
-                id = url.split("-")[-1]
-            except Exception as err:
-                logger.error(f"Failed to extract region info from {url}")
-                continue
+        if config.archive != None:
+            await asyncio.to_thread(config.archive.put, url, "region", content, encoding, parent_id)
 
+        # Extract data from response off the event loop
+        result = await config.parser.parse(parse_regions, content, encoding)
+        if result["errors"] != 0:
+            logger.error(f"Failed to extract {result['errors']} region info from {url}")
+        regions = []
+
+        for item in result["regions"]:
             region = Region(
-                id=id,
-                name=name,
+                id=item["id"],
+                name=item["name"],
                 level=level,
                 level_name=_region_levels[level],
-                url=url,
+                url=item["url"],
                 parent_id=parent_id,
                 parent_name=parent_name,
             )
             regions.append(region)
 
-        # Store data into storage
-        with SqlSession(self.storage_engine) as session:
-            for region in regions:
-                if session.get(Region, ident=region.id) == None:
-                    session.add(region)
-            session.commit()
-
-        logger.success(
-            f"Extract and store {len(regions)} region records from {url}"
-        )
-
-    async def _crawl_first_level(self, client: RetryClient):
-        url = "/"
-        await self._extract_region_info(client, url,  level=1)
-        logger.success(
-            f"Got all regions at level 1 - {_region_levels[1]}"
-        )
-
-    async def _crawl_other_level(self, client: RetryClient, level: int):
-        with SqlSession(self.storage_engine) as session:
-            regions_iter = session.query(Region).where(Region.level == level-1)
-            regions = list(regions_iter)
-
-        async def create_task(region: Region):
-            await self._extract_region_info(client, region.url, level=level)
-            logger.success(f"Got all sub-regions of {region}")
+        # Store data into storage, followed by the checkpoint of parent region.
+        # A page which failed to parse or listed nothing is left unchecked so
+        # that the next run fetches it again.
+        for region in regions:
+            await self.writer.put(region)
+        if result["errors"] == 0 and len(regions) != 0:
+            await self.frontier.put_region_done(
+                self.writer, parent_id or ROOT_REGION_ID, "subregions"
+            )
 
-        tasks = [create_task(region) for region in regions]
-        await asyncio.gather(*tasks)
+        logger.debug("Extract and store {} region records from {}", len(regions), url)
+        return regions
@@ -0,0 +1,124 @@
+import asyncio
+from functools import partial
+
+from sqlalchemy import Engine as SqlEngine
+
+from .common import *
+from .archive import ArchivedPage, ResponseArchive, parse_blob
+from .corporate import Corporate
+from .parser import CORPORATE_FIELDS, parse_corporate, parse_regions
+from .pipeline import Pipeline
+from .region import Region, _region_levels
+from .sitemap import RegionResolver
+from .storage import StorageWriter, create_storage_engine
+
+
+class Reparser:
+    # Rebuilds the regions and corporates tables from archived responses,
+    # without network access. Parser workers read and decompress the pages
+    # themselves.
+    def __init__(self, archive: ResponseArchive, storage_engine: SqlEngine):
+        self.archive = archive
+        self.storage_engine = storage_engine
+        Region.create_table(self.storage_engine)
+        Corporate.create_table(self.storage_engine)
+
+    async def reparse(self):
+        writer = StorageWriter(self.storage_engine,
+                               batch_size=config.write_batch_size,
+                               flush_interval=config.write_flush_interval)
+        writer.register(Region, mode="update")
+        # Keep the fetch state of incremental recrawls
+        self.columns = [field.name for field in CORPORATE_FIELDS]
+        writer.register(Corporate, mode="update", columns=self.columns + ["region_id"])
+
+        async with writer:
+            self.writer = writer
+            await self._reparse_regions()
+            # Pages discovered from sitemaps are archived without a region,
+            # it is resolved from the address like the crawler does
+            await writer.join()
+            self.resolver = await asyncio.to_thread(RegionResolver.load, self.storage_engine)
+            await self._reparse_corporates()
+
+    async def _reparse_regions(self):
+        # Walk the region tree from the root page like the crawler does
+        parents = [None]
+        for level in _region_levels:
+            results = await asyncio.gather(*[
+                self._reparse_region_page(level, parent) for parent in parents
+            ])
+            parents = [region for regions in results for region in regions]
+            for region in parents:
+                await self.writer.put(region)
+            logger.success(f"Reparsed {len(parents)} regions at level {level} - {_region_levels[level]}")
+
+    async def _reparse_region_page(self, level: int, parent_region: Region = None) -> list[Region]:
+        url = parent_region.url if parent_region != None else "/"
+        page = await asyncio.to_thread(self.archive.get, url)
+        if page == None:
+            logger.warning(f"Missing archived page of {url}")
+            return []
+
+        result = await self._parse(parse_regions, page)
+        if result["errors"] != 0:
+            logger.error(f"Failed to extract {result['errors']} region info from {url}")
+
+        return [
+            Region(
+                id=item["id"],
+                name=item["name"],
+                level=level,
+                level_name=_region_levels[level],
+                url=item["url"],
+                parent_id=parent_region.id if parent_region != None else None,
+                parent_name=parent_region.name if parent_region != None else None,
+            )
+            for item in result["regions"]
+        ]
+
+    async def _reparse_corporates(self):
+        self.corporate_count = 0
+        pipeline = Pipeline()
+        # Enough parsers in flight to keep every worker busy
+        workers = config.parser.workers * 2
+        pipeline.add_stage("reparse", self._reparse_corporate_page, workers, workers * 4)
+        await pipeline.run(self.archive.pages("corporate"))
+        logger.success(f"Reparsed {self.corporate_count} corporates")
+
+    async def _reparse_corporate_page(self, page: ArchivedPage):
+        fields = await self._parse(parse_corporate, page)
+        if fields.get("tax_id") == None:
+            logger.error(f"Missing tax ID in archived corporate data of {page.url}")
+            return
+        corporate = Corporate(**fields)
+        corporate.region_id = page.region_id
+        if corporate.region_id == None:
+            region = self.resolver.resolve(corporate.address)
+            corporate.region_id = region.id if region != None else None
+        if corporate.region_id != None:
+            await self.writer.put(corporate)
+        else:
+            # Leave the region of a stored corporate alone
+            await self.writer.put(corporate, mode="update", columns=self.columns)
+        self.corporate_count += 1
+
+    async def _parse(self, func, page: ArchivedPage):
+        return await config.parser.parse(partial(parse_blob, func), page.blob, page.encoding)
+
+
+async def main():
+    if config.archive == None:
+        logger.error("No response archive configured, set CRAWLER_ARCHIVE=1")
+        return
+
+    storage_engine = create_storage_engine(config.db_url)
+    try:
+        await Reparser(config.archive, storage_engine).reparse()
+    finally:
+        config.parser.close()
+        config.archive.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,74 +1,143 @@
 import aiohttp
 import asyncio
+import time
 from contextlib import asynccontextmanager
 
+from . import metrics
 from .common import logger, config
-from .ratelimit import RateLimiter
+from .concurrency import ConcurrencyLimiter
+from .egress import Route
+from .ratelimit import RateLimiter, is_throttled
+from .retry_policy import NETWORK_ERROR, classify
 
 
 class RetryClient:
-    def __init__(self, max_retries: int, limiter: RateLimiter, *args, **kwargs):
+    def __init__(self, max_retries: int, limiter: RateLimiter, *args,
+                 concurrency: ConcurrencyLimiter = None, **kwargs):
         self.max_retries = max_retries
         self.limiter = limiter
+        self.concurrency = concurrency
         self.args = args
         self.kwargs = kwargs
 
-    @asynccontextmanager
-    async def get(self, url, *args, **kwargs) -> aiohttp.ClientResponse:
-        for i in range(self.max_retries):
-            domain = config.domain
-            full_url = f"https://{domain}{url}"
-            async with self.limiter as _:
-                try:
-                    async with self.session.get(full_url, *args, **kwargs) as resp:
-                        if resp.ok or (i == self.max_retries - 1):
-                            yield resp
-                            return
-
-                    logger.warning(
-                        f"Retry {i+1}/{self.max_retries} for {full_url} failed with status {resp.status}"
-                    )
-                except Exception as err:
-                    logger.warning(
-                        f"Retry {i+1}/{self.max_retries} for {full_url} failed with error {err}"
-                    )
-
-            await config.remove_gateway(domain)
-            config.new_gateway()
-            timeout = 2**i
-            await asyncio.sleep(timeout)
-
-        # Max retries reached => return errors
-        yield resp
-        return
+    def get(self, url, *args, **kwargs):
+        return self.request("GET", url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self.request("POST", url, *args, **kwargs)
 
     @asynccontextmanager
-    async def post(self, url, *args, **kwargs) -> aiohttp.ClientResponse:
-        for i in range(self.max_retries):
-            domain = config.domain
-            full_url = f"https://{config.domain}{url}"
-            async with self.limiter as _:
-                async with self.session.post(full_url, *args, **kwargs) as resp:
-                    if resp.ok or (i == self.max_retries-1):
-                        yield resp
-                        return
-            logger.warning(
-                f"Retry {i+1}/{self.max_retries} for {full_url} failed with status {resp.status}"
+    async def request(self, method: str, url: str, *args, **kwargs) -> aiohttp.ClientResponse:
+        # Client errors are returned right away, other failures are retried
+        # up to `max_retries` times through another healthy route after a
+        # jittered backoff. The response of the last attempt is returned, or
+        # its error raised.
+        policy = config.retry_policy
+        breakers = config.circuit_breakers
+        attempts = self.max_retries + 1
+        tried = set()
+        for i in range(attempts):
+            route = await config.get_route(
+                accept=lambda key: key not in tried and breakers.available(key)
+                and self.limiter.ready(key)
             )
-            await config.remove_gateway(domain)
-            config.new_gateway()
-            timeout = 2**i
-            await asyncio.sleep(timeout)
+            domain = route.key
+            tried.add(domain)
+            full_url = f"{route.base_url}{url}"
+            if route.proxy != None:
+                kwargs["proxy"] = route.proxy
+            else:
+                kwargs.pop("proxy", None)
+            await self.limiter.acquire(domain)
+            await self.__acquire_slot()
+            start = time.perf_counter()
+            try:
+                resp = await self.__session(route).request(method, full_url, *args, **kwargs)
+            except asyncio.CancelledError:
+                self.__release_slot(None, False)
+                raise
+            except Exception as err:
+                self.__release_slot(None, True)
+                metrics.fetch_errors.inc(gateway=domain)
+                outcome, error = NETWORK_ERROR, err
+                logger.warning(
+                    f"Attempt {i+1}/{attempts} for {full_url} failed with error {err}"
+                )
+            else:
+                rtt, throttled = self.__record(domain, method, start, resp.status)
+                self.limiter.feedback(domain, resp.status)
+                outcome = classify(resp.status)
+                if not policy.retryable(outcome) or i == attempts - 1:
+                    self.__record_outcome(route, outcome)
+                    # The slot is held until the caller has read the response
+                    try:
+                        yield resp
+                    finally:
+                        resp.release()
+                        self.__release_slot(rtt, throttled)
+                        config.release_route(route, rtt)
+                    return
+
+                resp.release()
+                self.__release_slot(rtt, throttled)
+                config.release_route(route, rtt)
+                logger.warning(
+                    f"Attempt {i+1}/{attempts} for {full_url} failed with status {resp.status}"
+                )
+
+            self.__record_outcome(route, outcome)
+            if i == attempts - 1:
+                raise error
+            # Sleeps without a rate limiter token or an in-flight slot
+            metrics.fetch_retries.inc(gateway=domain)
+            await asyncio.sleep(policy.backoff(i))
+
+    def __record_outcome(self, route: Route, outcome: str):
+        if config.circuit_breakers.record(route.key, outcome):
+            logger.warning(f"Retiring egress route {route.key} after sustained failures")
+            config.retire_route(route)
+
+    def __record(self, domain: str, method: str, start: float, status: int) -> tuple[float, bool]:
+        rtt = time.perf_counter() - start
+        metrics.fetch_seconds.observe(rtt, gateway=domain, method=method)
+        metrics.fetch_responses.inc(gateway=domain, status=status)
+        return rtt, is_throttled(status)
+
+    async def __acquire_slot(self):
+        if self.concurrency != None:
+            await self.concurrency.acquire()
+
+    def __release_slot(self, rtt: float, throttled: bool):
+        if self.concurrency != None:
+            self.concurrency.release(rtt, throttled)
+
+    def __session(self, route: Route) -> aiohttp.ClientSession:
+        # Routes through SOCKS proxies bring their own connector, each gets
+        # a session of its own
+        if route.connector == None:
+            return self.session
+        session = self.sessions.get(route.key)
+        if session == None:
+            session = self.__new_session(route.connector)
+            self.sessions[route.key] = session
+        return session
 
-        # Max retries reached => return errors
-        yield resp
-        return
+    def __new_session(self, connector: aiohttp.BaseConnector) -> aiohttp.ClientSession:
+        kwargs = {"trace_configs": config.trace_configs,
+                  "connector": connector, "connector_owner": False,
+                  "headers": {"Accept-Encoding": "gzip, deflate"},
+                  **self.kwargs}
+        return aiohttp.ClientSession(*self.args, **kwargs)
 
     async def __aenter__(self):
-        session = aiohttp.ClientSession(*self.args, **self.kwargs)
-        self.session = await session.__aenter__()
+        # Every client shares the connections of the tuned connector
+        self.session = await self.__new_session(config.get_connector()).__aenter__()
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
         return self
 
     async def __aexit__(self, *args, **kwargs):
+        for session in self.sessions.values():
+            await session.close()
         await self.session.__aexit__(*args, **kwargs)
         del self.session
+        del self.sessions
@@ -0,0 +1,121 @@
+import random
+import time
+from typing import Optional
+
+from . import metrics
+from .ratelimit import is_throttled
+
+# Outcomes of one request attempt
+OK = "ok"
+PERMANENT = "permanent"
+THROTTLED = "throttled"
+SERVER_ERROR = "server_error"
+NETWORK_ERROR = "network_error"
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def classify(status: Optional[int]) -> str:
+    # None stands for an attempt which failed without a response
+    if status == None:
+        return NETWORK_ERROR
+    if is_throttled(status):
+        return THROTTLED
+    if status >= 500:
+        return SERVER_ERROR
+    if status >= 400:
+        return PERMANENT
+    return OK
+
+
+class RetryPolicy:
+    def __init__(self, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def retryable(self, outcome: str) -> bool:
+        # A 404 or another client error comes back the same from any gateway
+        return outcome not in (OK, PERMANENT)
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter, so that requests failed by the same blip do not retry
+        # in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        # Times the breaker opened since it was last closed by a success
+        self.trips = 0
+        self.opened_at = 0.0
+
+    def available(self) -> bool:
+        # Open breakers let requests through again after the reset timeout,
+        # the next outcome closes or opens them
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def on_success(self) -> str:
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        return self.state
+
+    def on_failure(self) -> str:
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+        return self.state
+
+
+class CircuitBreakers:
+    # One breaker per gateway endpoint. Gateways are only retired after
+    # their breaker opened `retire_after` times in a row, so a blip of the
+    # origin, which fails every gateway at once, keeps the fleet.
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 retire_after: int = 3):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retire_after = retire_after
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        breaker = self.breakers.get(key)
+        if breaker == None:
+            breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            self.breakers[key] = breaker
+        return breaker
+
+    @property
+    def open_count(self) -> int:
+        return sum(breaker.state == OPEN for breaker in self.breakers.values())
+
+    def available(self, key: str) -> bool:
+        breaker = self.breakers.get(key)
+        return breaker == None or breaker.available()
+
+    def record(self, key: str, outcome: str) -> bool:
+        # Returns True if the gateway should be retired. Client errors are
+        # answered by the origin, so they prove the gateway works.
+        breaker = self.breaker(key)
+        previous = breaker.state
+        if outcome in (OK, PERMANENT):
+            state = breaker.on_success()
+        else:
+            state = breaker.on_failure()
+        if state != previous:
+            metrics.breaker_transitions.inc(gateway=key, state=state)
+        return state == OPEN and previous != OPEN and breaker.trips >= self.retire_after
+
+    def discard(self, key: str):
+        self.breakers.pop(key, None)
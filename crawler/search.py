@@ -0,0 +1,189 @@
+import argparse
+import re
+import time
+
+import sqlalchemy
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+
+from .common import *
+from . import metrics
+from .storage import create_storage_engine
+
+# Diacritics are folded by the unicode61 tokenizer, except for the
+# Vietnamese đ which is a letter of its own
+TOKENIZER = "unicode61 remove_diacritics 2"
+FOLDED_LETTERS = {"đ": "d", "Đ": "D"}
+
+_term_pattern = re.compile(r"\w+")
+
+
+def fold(text: str) -> str:
+    for letter, replacement in FOLDED_LETTERS.items():
+        text = text.replace(letter, replacement)
+    return text
+
+
+def _fold_sql(expression: str) -> str:
+    # SQL counterpart of fold() which triggers can run without Python
+    for letter, replacement in FOLDED_LETTERS.items():
+        expression = f"replace({expression}, '{letter}', '{replacement}')"
+    return expression
+
+
+def match_query(text: str, columns: list[str] = None) -> str:
+    # Every term of `text` must match the prefix of a word, in any order.
+    # Terms are quoted, so FTS5 operators in user input are searched as is.
+    terms = [f'"{term}"*' for term in _term_pattern.findall(fold(text))]
+    if len(terms) == 0:
+        return None
+    query = " ".join(terms)
+    if columns != None:
+        query = "{" + " ".join(columns) + "}: (" + query + ")"
+    return query
+
+
+class SearchIndex:
+    # FTS5 index over text columns of `model`, ranked by BM25 with a weight
+    # per column. The table keeps no copy of the text, it points at the
+    # rows of `model` through their rowid. Triggers keep it in sync with
+    # every insert, upsert and delete. VACUUM may renumber the rowids, the
+    # index has to be rebuilt after one.
+    def __init__(self, storage_engine: SqlEngine, model, weights: dict[str, float]):
+        self.storage_engine = storage_engine
+        self.model = model
+        self.table = model.__tablename__
+        self.name = f"{self.table}_fts"
+        self.weights = weights
+        self.columns = list(weights)
+
+    @property
+    def supported(self) -> bool:
+        return self.storage_engine.dialect.name == "sqlite"
+
+    def exists(self) -> bool:
+        return sqlalchemy.inspect(self.storage_engine).has_table(self.name)
+
+    def create(self):
+        # Indexes the rows stored by older versions when the index is new
+        if not self.supported:
+            logger.warning(f"Full-text search of {self.table} needs SQLite, the index is not created")
+            return
+        created = not self.exists()
+        columns = ", ".join(self.columns)
+        ranking = ", ".join(str(float(weight)) for weight in self.weights.values())
+        with self.storage_engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} USING fts5("
+                f"{columns}, content='{self.table}', content_rowid='rowid', tokenize='{TOKENIZER}')"
+            ))
+            # ORDER BY rank then ranks by the weighted BM25 score
+            connection.execute(sqlalchemy.text(
+                f"INSERT INTO {self.name}({self.name}, rank) VALUES('rank', 'bm25({ranking})')"
+            ))
+            for statement in self.__triggers():
+                connection.execute(sqlalchemy.text(statement))
+        if created:
+            self.rebuild()
+
+    def drop(self):
+        if not self.supported:
+            return
+        with self.storage_engine.begin() as connection:
+            for event in ("insert", "update", "delete"):
+                connection.execute(sqlalchemy.text(f"DROP TRIGGER IF EXISTS {self.name}_{event}"))
+            connection.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {self.name}"))
+
+    def rebuild(self):
+        # Indexes every row again in one transaction, faster than the
+        # triggers after a bulk load
+        start = time.perf_counter()
+        columns = ", ".join(self.columns)
+        values = ", ".join(_fold_sql(column) for column in self.columns)
+        with self.storage_engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                f"INSERT INTO {self.name}({self.name}) VALUES('delete-all')"
+            ))
+            result = connection.execute(sqlalchemy.text(
+                f"INSERT INTO {self.name}(rowid, {columns}) SELECT rowid, {values} FROM {self.table}"
+            ))
+            connection.execute(sqlalchemy.text(
+                f"INSERT INTO {self.name}({self.name}) VALUES('optimize')"
+            ))
+        logger.info(
+            f"Indexed {result.rowcount} rows of {self.table} for full-text search "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+    def search(self, text: str, limit: int = 20, offset: int = 0,
+               columns: list[str] = None) -> list:
+        # Rows of `model` whose columns contain every term of `text` as a
+        # word prefix, best match first, regardless of case and diacritics
+        if not self.supported:
+            raise RuntimeError(f"Full-text search of {self.table} needs SQLite")
+        if columns != None:
+            unknown = set(columns) - set(self.columns)
+            if len(unknown) != 0:
+                raise ValueError(f"Columns {sorted(unknown)} are not indexed, expected some of {self.columns}")
+        query = match_query(text, columns)
+        if query == None:
+            return []
+
+        statement = sqlalchemy.text(
+            f"SELECT {self.table}.* FROM {self.name} "
+            f"JOIN {self.table} ON {self.table}.rowid = {self.name}.rowid "
+            f"WHERE {self.name} MATCH :query ORDER BY {self.name}.rank LIMIT :limit OFFSET :offset"
+        )
+        with metrics.search_seconds.time():
+            with SqlSession(self.storage_engine) as session:
+                rows = session.scalars(
+                    sqlalchemy.select(self.model).from_statement(statement),
+                    {"query": query, "limit": limit, "offset": offset},
+                ).all()
+        return rows
+
+    def __triggers(self) -> list[str]:
+        # External content tables have to be told the old values of a row
+        # to remove it from the index. Updates of other columns, such as
+        # the fetch state, leave the index alone.
+        columns = ", ".join(self.columns)
+        new = ", ".join(_fold_sql(f"new.{column}") for column in self.columns)
+        old = ", ".join(_fold_sql(f"old.{column}") for column in self.columns)
+        insert = f"INSERT INTO {self.name}(rowid, {columns}) VALUES(new.rowid, {new});"
+        delete = (
+            f"INSERT INTO {self.name}({self.name}, rowid, {columns}) "
+            f"VALUES('delete', old.rowid, {old});"
+        )
+        return [
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_insert AFTER INSERT ON {self.table} "
+            f"BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_update AFTER UPDATE OF {columns} ON {self.table} "
+            f"BEGIN {delete} {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.name}_delete AFTER DELETE ON {self.table} "
+            f"BEGIN {delete} END",
+        ]
+
+
+def main():
+    from .corporate import Corporate
+
+    parser = argparse.ArgumentParser(description="Search the stored corporates by name, representative or address")
+    parser.add_argument("query", nargs="?", help="words to look for, prefixes match too")
+    parser.add_argument("--column", action="append", dest="columns",
+                        help="only search this column, may be repeated")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rebuild", action="store_true", help="index every stored corporate again")
+    args = parser.parse_args()
+
+    storage_engine = create_storage_engine(config.db_url)
+    Corporate.create_table(storage_engine)
+    index = Corporate.search_index(storage_engine)
+    if args.rebuild:
+        index.rebuild()
+    if args.query != None:
+        for corporate in index.search(args.query, limit=args.limit, columns=args.columns):
+            print(f"{corporate.tax_id}\t{corporate.name}\t{corporate.address}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import re
+import unicodedata
+import zlib
+from typing import AsyncIterator, Union
+from urllib.parse import urlsplit
+
+from lxml import etree
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+
+from .common import *
+from . import metrics
+from .region import Region
+from .retry_client import RetryClient
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _local_name(tag) -> str:
+    return tag.rpartition("}")[2] if isinstance(tag, str) else ""
+
+
+class SitemapParser:
+    # Incremental parser of sitemap indexes and url sets, fed with chunks as
+    # they arrive. Entries are cleared once read so that memory stays flat
+    # however large the file is. Yields ("sitemap", loc) for child sitemaps
+    # and ("url", loc) for pages.
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=("end",), tag=("{*}sitemap", "{*}url"),
+                                          huge_tree=True, resolve_entities=False, no_network=True)
+
+    def feed(self, data: bytes) -> list[tuple[str, str]]:
+        self.parser.feed(data)
+        return self.__read()
+
+    def close(self) -> list[tuple[str, str]]:
+        self.parser.close()
+        return self.__read()
+
+    def __read(self) -> list[tuple[str, str]]:
+        entries = []
+        for _, element in self.parser.read_events():
+            kind = _local_name(element.tag)
+            for child in element:
+                if _local_name(child.tag) == "loc" and child.text:
+                    entries.append((kind, child.text.strip()))
+                    break
+            # Drop the entry and the ones before it from the tree
+            element.clear()
+            parent = element.getparent()
+            while parent != None and element.getprevious() != None:
+                del parent[0]
+        return entries
+
+
+def sitemap_path(loc: str) -> str:
+    # Locations are absolute urls of the origin, requests go through the
+    # gateways by path
+    parts = urlsplit(loc)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+async def read_sitemap(client: RetryClient, path: str) -> AsyncIterator[tuple[str, str]]:
+    # Streams the sitemap at `path`, gzipped files are inflated on the fly
+    async with client.get(path) as resp:
+        if not resp.ok:
+            raise RuntimeError(f"Failed to get sitemap {path} with status {resp.status}")
+        inflater = None
+        if urlsplit(path).path.endswith(".gz") and "Content-Encoding" not in resp.headers:
+            inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+
+        parser = SitemapParser()
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            if inflater != None:
+                chunk = inflater.decompress(chunk)
+            for entry in parser.feed(chunk):
+                yield entry
+        if inflater != None:
+            for entry in parser.feed(inflater.flush()):
+                yield entry
+        for entry in parser.close():
+            yield entry
+
+
+_administrative_prefixes = re.compile(
+    r"^(thanh pho|tinh|quan|huyen|thi xa|thi tran|phuong|xa|tp\.?)\s+"
+)
+
+
+def normalize_region_name(name: str) -> str:
+    # "Thành phố Hà Nội" and "TP. Hà Nội" are both "ha noi", "Phường 01"
+    # and "Phường 1" are both "1"
+    name = unicodedata.normalize("NFD", name.strip().lower())
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    name = name.replace("đ", "d")
+    name = " ".join(name.split())
+    name = _administrative_prefixes.sub("", name)
+    if name.isdigit():
+        return name.lstrip("0") or name
+    return name
+
+
+class RegionResolver:
+    # Maps the address of a corporate, "Số 1, Phường X, Quận Y, Thành phố Z",
+    # to its region from the stored region tree
+    def __init__(self, regions: list[Region]):
+        self.provinces: dict[str, Region] = {}
+        self.districts: dict[str, dict[str, Region]] = {}
+        self.wards: dict[str, dict[str, Region]] = {}
+        for region in sorted(regions, key=lambda region: region.level):
+            name = normalize_region_name(region.name or "")
+            if region.level == 1:
+                self.provinces[name] = region
+            elif region.level == 2:
+                self.districts.setdefault(region.parent_id, {})[name] = region
+            elif region.level == 3:
+                self.wards.setdefault(region.parent_id, {})[name] = region
+
+    @classmethod
+    def load(Cls, storage_engine: SqlEngine) -> "RegionResolver":
+        with SqlSession(storage_engine) as session:
+            regions = [region for region in session.query(Region)]
+            session.expunge_all()
+        return Cls(regions)
+
+    def __len__(self) -> int:
+        return len(self.provinces)
+
+    def resolve(self, address: str) -> Union[Region, None]:
+        # The ward, or the district if the ward is unknown. Parts after the
+        # province, such as the country, are skipped.
+        if address == None:
+            metrics.region_resolutions.inc(level="none")
+            return None
+        parts = [normalize_region_name(part) for part in address.split(",")]
+        for index in range(len(parts) - 1, 0, -1):
+            province = self.provinces.get(parts[index])
+            if province == None:
+                continue
+            district = self.districts.get(province.id, {}).get(parts[index - 1])
+            if district == None:
+                break
+            ward = self.wards.get(district.id, {}).get(parts[index - 2]) if index >= 2 else None
+            metrics.region_resolutions.inc(level="ward" if ward != None else "district")
+            return ward or district
+        metrics.region_resolutions.inc(level="none")
+        return None
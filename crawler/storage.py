@@ -0,0 +1,264 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Union
+
+import sqlalchemy
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+from sqlalchemy.dialects import sqlite, postgresql
+
+from .common import *
+from . import metrics
+
+WRITE_MODES = ("skip", "update")
+
+
+def create_storage_engine(url: str) -> SqlEngine:
+    # SQLite databases get the write-path profile on every connection
+    storage_engine = sqlalchemy.create_engine(url)
+    if storage_engine.dialect.name == "sqlite":
+        sqlalchemy.event.listen(storage_engine, "connect", apply_sqlite_profile)
+    return storage_engine
+
+
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    # WAL lets readers run next to the writer and makes commits cheap,
+    # which NORMAL synchronous keeps durable across process crashes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={config.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA cache_size=-{config.sqlite_cache_mb * 1024}")
+    cursor.execute(f"PRAGMA mmap_size={config.sqlite_mmap_mb * 1024 * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute(f"PRAGMA busy_timeout={config.sqlite_busy_timeout_ms}")
+    cursor.close()
+
+
+def create_tables(storage_engine: SqlEngine, tables: list[sqlalchemy.Table] = None):
+    # Nodes starting together race to create the same tables, the loser
+    # finds them on the second try
+    try:
+        SqlTableBase.metadata.create_all(storage_engine, tables=tables)
+    except sqlalchemy.exc.DatabaseError:
+        SqlTableBase.metadata.create_all(storage_engine, tables=tables)
+
+
+def add_missing_columns(storage_engine: SqlEngine, table: sqlalchemy.Table):
+    # Tables created by older versions lack newer nullable columns
+    inspector = sqlalchemy.inspect(storage_engine)
+    if not inspector.has_table(table.name):
+        return
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    with storage_engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=storage_engine.dialect)
+            connection.execute(sqlalchemy.text(
+                f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            ))
+            logger.info(f"Added column {column.name} to table {table.name}")
+
+
+def add_missing_indexes(storage_engine: SqlEngine, table: sqlalchemy.Table):
+    # Tables created by older versions lack newer indexes
+    inspector = sqlalchemy.inspect(storage_engine)
+    if not inspector.has_table(table.name):
+        return
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        logger.info(f"Creating index {index.name} on table {table.name}, this may take a while")
+        index.create(storage_engine, checkfirst=True)
+
+
+def insert_missing(session: SqlSession, table: sqlalchemy.Table, rows: list[dict]):
+    # Inserts the rows whose key does not exist yet, concurrent sessions
+    # inserting the same keys do not fail on each other
+    if len(rows) == 0:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert
+        index_elements = [column.key for column in table.primary_key]
+        session.execute(insert(table).on_conflict_do_nothing(index_elements=index_elements), rows)
+        return
+    for row in rows:
+        where = [column == row[column.key] for column in table.primary_key]
+        if session.execute(sqlalchemy.select(*table.primary_key).where(*where)).first() == None:
+            session.execute(table.insert(), [row])
+
+
+@dataclass
+class TablePolicy:
+    mode: str = "skip"
+    # Columns to overwrite on conflict in update mode, None means all
+    columns: list[str] = None
+    # Existing rows are only updated if their columns have these values
+    where: dict[str, object] = None
+
+
+class StorageWriter:
+    def __init__(self, storage_engine: SqlEngine, batch_size: int = 500,
+                 flush_interval: float = 1.0, queue_size: int = 4096):
+        self.storage_engine = storage_engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = 3
+        self.dialect = storage_engine.dialect.name
+
+        self.policies: dict[sqlalchemy.Table, TablePolicy] = {}
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task: asyncio.Task = None
+        self.wakeup = asyncio.Event()
+        self.flush_requested = asyncio.Event()
+
+        self.flushed_rows = 0
+        self.flush_count = 0
+
+    def register(self, model, mode: str = "skip", columns: list[str] = None,
+                 where: dict[str, object] = None):
+        if mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode {mode}, expected one of {WRITE_MODES}")
+        self.policies[model.__table__] = TablePolicy(mode=mode, columns=columns, where=where)
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.__run())
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def put(self, record: Union[SqlTableBase, dict], model=None,
+                  mode: str = None, columns: list[str] = None):
+        # Records are ORM instances or dicts with every column of `model`.
+        # Records are committed in the order they are put.
+        table = (model or type(record)).__table__
+        if not isinstance(record, dict):
+            record = {column.key: getattr(record, column.key)
+                      for column in table.columns}
+
+        policy = self.policies.get(table, TablePolicy())
+        if mode != None:
+            policy = TablePolicy(mode=mode, columns=columns)
+        await self.queue.put((table, policy, record))
+        if self.queue.qsize() >= self.batch_size:
+            self.wakeup.set()
+
+    async def join(self):
+        # Flush right away and wait until every record put so far is committed
+        self.flush_requested.set()
+        self.wakeup.set()
+        await self.queue.join()
+        self.flush_requested.clear()
+
+    async def close(self):
+        if self.task == None:
+            return
+        await self.join()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while True:
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                timeout = deadline - loop.time()
+                if len(batch) >= self.batch_size or self.flush_requested.is_set() or timeout <= 0:
+                    break
+
+                # Woken up early when a full batch is queued or a flush is requested
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            try:
+                await self.__flush_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def __flush_with_retries(self, batch: list):
+        for i in range(self.max_retries):
+            try:
+                with metrics.flush_seconds.time():
+                    await asyncio.to_thread(self.__flush, batch)
+                metrics.flush_rows.observe(len(batch))
+                return
+            except Exception as err:
+                logger.warning(
+                    f"Retry {i+1}/{self.max_retries} to flush {len(batch)} records failed with error {err}"
+                )
+                await asyncio.sleep(2**i)
+        logger.error(f"Dropped {len(batch)} records after {self.max_retries} failed flushes")
+
+    def __flush(self, batch: list):
+        # Group rows by table and policy, last write of a key wins in a batch
+        groups: dict[tuple, dict] = {}
+        for table, policy, record in batch:
+            key = tuple(record.get(column.key) for column in table.primary_key)
+            group = (table, policy.mode, tuple(policy.columns or ()),
+                     tuple(sorted((policy.where or {}).items())))
+            groups.setdefault(group, {})[key] = record
+
+        with SqlSession(self.storage_engine) as session:
+            for (table, mode, columns, where), records in groups.items():
+                rows = list(records.values())
+                policy = TablePolicy(mode=mode, columns=list(columns) or None, where=dict(where) or None)
+                if self.dialect in ("sqlite", "postgresql"):
+                    session.execute(self.__upsert(table, policy), rows)
+                else:
+                    self.__merge(session, table, policy, rows)
+            session.commit()
+
+        self.flushed_rows += len(batch)
+        self.flush_count += 1
+
+    def __upsert(self, table: sqlalchemy.Table, policy: TablePolicy):
+        # Native INSERT ... ON CONFLICT of SQLite and PostgreSQL
+        dialect = sqlite if self.dialect == "sqlite" else postgresql
+        statement = dialect.insert(table)
+        index_elements = [column.key for column in table.primary_key]
+        if policy.mode == "skip":
+            return statement.on_conflict_do_nothing(index_elements=index_elements)
+
+        columns = policy.columns or [
+            column.key for column in table.columns if not column.primary_key
+        ]
+        where = None
+        if policy.where != None:
+            where = sqlalchemy.and_(*[table.c[column] == value for column, value in policy.where.items()])
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in columns},
+            where=where,
+        )
+
+    def __merge(self, session: SqlSession, table: sqlalchemy.Table,
+                policy: TablePolicy, rows: list[dict]):
+        # Generic fallback for other dialects, one round-trip per row
+        for row in rows:
+            key = [row[column.key] for column in table.primary_key]
+            where = [column == value for column, value in zip(table.primary_key, key)]
+            exists = session.execute(
+                sqlalchemy.select(*table.primary_key).where(*where)
+            ).first()
+            if exists == None:
+                session.execute(table.insert(), [row])
+            elif policy.mode == "update":
+                columns = policy.columns or [
+                    column.key for column in table.columns if not column.primary_key
+                ]
+                conditions = [table.c[column] == value for column, value in (policy.where or {}).items()]
+                session.execute(
+                    table.update().where(*where, *conditions),
+                    [{column: row[column] for column in columns}]
+                )
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import socket
+from datetime import timedelta
+
+import sqlalchemy
+from sqlalchemy import Engine as SqlEngine
+from sqlalchemy.orm import Session as SqlSession
+from sqlalchemy import Column as SqlColumn, String as SqlString
+from sqlalchemy import Integer as SqlInteger, DateTime as SqlDateTime
+
+from .common import *
+from .incremental import utcnow
+from .storage import StorageWriter, create_tables
+
+# Work item states, leased items whose lease expired are claimable again
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkItem(SqlTableBase):
+    __tablename__ = "work_items"
+    kind = SqlColumn(SqlString, primary_key=True)
+    key = SqlColumn(SqlString, primary_key=True)
+    status = SqlColumn(SqlString, default=PENDING, index=True)
+    owner = SqlColumn(SqlString)
+    lease_expires_at = SqlColumn(SqlDateTime)
+    attempts = SqlColumn(SqlInteger, default=0)
+    updated_at = SqlColumn(SqlDateTime)
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    # Work shared by every node pointed at the same database. Nodes claim
+    # items with time-limited leases and extend them with heartbeats while
+    # they work, so the items of a dead node are claimed again once its
+    # leases expire.
+    def __init__(self, storage_engine: SqlEngine, node_id: str = None,
+                 lease_seconds: float = 120, max_attempts: int = 3):
+        self.storage_engine = storage_engine
+        self.node_id = node_id or default_node_id()
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.poll_interval = max(1.0, lease_seconds / 10)
+        self.dialect = storage_engine.dialect.name
+        self.task: asyncio.Task = None
+        create_tables(self.storage_engine, tables=[WorkItem.__table__])
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.__heartbeat())
+        return self
+
+    async def __aexit__(self, *args):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        # Let other nodes take over unfinished work right away
+        released = await asyncio.to_thread(self.release_all)
+        if released != 0:
+            logger.info(f"Released {released} leased work items of node {self.node_id}")
+
+    def enqueue(self, kind: str, keys: list[str]):
+        # Keys which are already queued keep their state
+        if len(keys) == 0:
+            return
+        with SqlSession(self.storage_engine) as session:
+            known = set()
+            for chunk in range(0, len(keys), 500):
+                query = session.query(WorkItem.key).where(
+                    WorkItem.kind == kind, WorkItem.key.in_(keys[chunk:chunk + 500])
+                )
+                known.update(key for key, in query)
+            for key in dict.fromkeys(keys):
+                if key not in known:
+                    session.add(WorkItem(kind=kind, key=key, status=PENDING, attempts=0,
+                                         updated_at=utcnow()))
+            try:
+                session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # Another node enqueued the same keys concurrently
+                session.rollback()
+                self.enqueue(kind, [key for key in keys if key not in known])
+
+    def claim(self, kind: str, limit: int = 1) -> list[str]:
+        now = utcnow()
+        claimable = sqlalchemy.or_(
+            WorkItem.status == PENDING,
+            sqlalchemy.and_(WorkItem.status == LEASED, WorkItem.lease_expires_at < now),
+        )
+        candidates = (
+            sqlalchemy.select(WorkItem.key)
+            .where(WorkItem.kind == kind, claimable)
+            .order_by(WorkItem.key)
+            .limit(limit)
+        )
+        values = {"status": LEASED, "owner": self.node_id,
+                  "lease_expires_at": now + self.lease, "updated_at": now,
+                  "attempts": WorkItem.attempts + 1}
+
+        with self.storage_engine.begin() as connection:
+            if self.dialect == "postgresql":
+                # Concurrent claims skip rows locked by other nodes instead
+                # of waiting for them
+                candidates = candidates.with_for_update(skip_locked=True)
+            if self.storage_engine.dialect.update_returning:
+                # The claimable condition is checked again by the update, so
+                # a row is never claimed twice even without row locks
+                statement = (
+                    sqlalchemy.update(WorkItem)
+                    .where(WorkItem.kind == kind, claimable,
+                           WorkItem.key.in_(candidates.scalar_subquery()))
+                    .values(**values)
+                    .returning(WorkItem.key)
+                )
+                keys = [key for key, in connection.execute(statement)]
+            else:
+                keys = []
+                for key, in connection.execute(candidates).all():
+                    result = connection.execute(
+                        sqlalchemy.update(WorkItem)
+                        .where(WorkItem.kind == kind, WorkItem.key == key, claimable)
+                        .values(**values)
+                    )
+                    if result.rowcount == 1:
+                        keys.append(key)
+
+        if len(keys) != 0:
+            logger.debug(f"Node {self.node_id} claimed {len(keys)} {kind} work items")
+        return keys
+
+    def complete(self, kind: str, key: str):
+        # Items which were reclaimed by another node are left to that node
+        with self.storage_engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.update(WorkItem)
+                .where(WorkItem.kind == kind, WorkItem.key == key,
+                       WorkItem.owner == self.node_id)
+                .values(status=DONE, lease_expires_at=None, updated_at=utcnow())
+            )
+
+    def register(self, writer: StorageWriter):
+        # Items which were reclaimed by another node are left to that node
+        writer.register(WorkItem, mode="update", columns=["status", "lease_expires_at", "updated_at"],
+                        where={"owner": self.node_id})
+
+    async def put_done(self, writer: StorageWriter, kind: str, key: str):
+        # Committed in order with the records of the item, so other nodes
+        # only see it done once its results are stored. Like complete, it
+        # only applies while this node still holds the lease.
+        item = WorkItem(kind=kind, key=key, status=DONE, owner=self.node_id,
+                        lease_expires_at=None, attempts=0, updated_at=utcnow())
+        await writer.put(item)
+
+    def release(self, kind: str, key: str):
+        # Failed items are retried by any node until they run out of attempts
+        with SqlSession(self.storage_engine) as session:
+            item = session.get(WorkItem, (kind, key))
+            if item == None or item.owner != self.node_id:
+                return
+            item.status = FAILED if item.attempts >= self.max_attempts else PENDING
+            item.lease_expires_at = None
+            item.updated_at = utcnow()
+            session.commit()
+            if item.status == FAILED:
+                logger.error(f"Gave up {kind} work item {key} after {item.attempts} attempts")
+
+    def release_all(self) -> int:
+        with self.storage_engine.begin() as connection:
+            result = connection.execute(
+                sqlalchemy.update(WorkItem)
+                .where(WorkItem.owner == self.node_id, WorkItem.status == LEASED)
+                .values(status=PENDING, lease_expires_at=None, updated_at=utcnow())
+            )
+            return result.rowcount
+
+    def status(self, kind: str, key: str) -> str:
+        with SqlSession(self.storage_engine) as session:
+            item = session.get(WorkItem, (kind, key))
+            return item.status if item != None else None
+
+    def remaining(self, kind: str) -> int:
+        # Pending items and items leased by any node, including dead ones
+        with SqlSession(self.storage_engine) as session:
+            return session.query(WorkItem).where(
+                WorkItem.kind == kind, WorkItem.status.in_([PENDING, LEASED])
+            ).count()
+
+    def extend_leases(self) -> int:
+        now = utcnow()
+        with self.storage_engine.begin() as connection:
+            result = connection.execute(
+                sqlalchemy.update(WorkItem)
+                .where(WorkItem.owner == self.node_id, WorkItem.status == LEASED)
+                .values(lease_expires_at=now + self.lease, updated_at=now)
+            )
+            return result.rowcount
+
+    async def __heartbeat(self):
+        # Extend leases well before they expire
+        interval = self.lease.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.extend_leases)
+            except Exception as err:
+                logger.warning(f"Failed to extend leases of node {self.node_id}: {err}")
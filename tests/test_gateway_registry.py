@@ -0,0 +1,257 @@
+import socket
+import subprocess
+from datetime import timedelta
+
+import pytest
+import sqlalchemy
+
+from crawler.api_gateway import API_NAME, ApiGateway
+from crawler.gateway_registry import (
+    OWNER_TAG, REGISTRY_TAG, GatewayRecord, GatewayRegistry, owner_tags, process_owner, utcnow,
+)
+
+SOURCE_URI = "https://masothue.com"
+REGION = "us-east-1"
+
+
+class StubApiGatewayClient:
+    # The calls of the apigateway client which the registry makes, backed
+    # by a dict of APIs per region
+    def __init__(self, page_size: int = 2):
+        self.apis: dict[str, dict[str, dict]] = {}
+        self.deleted: list[str] = []
+        self.failing_regions: set[str] = set()
+        self.page_size = page_size
+
+    def add_api(self, region: str, rest_api_id: str, tags: dict = None, age: timedelta = timedelta(0),
+                name: str = API_NAME):
+        self.apis.setdefault(region, {})[rest_api_id] = {
+            "id": rest_api_id, "name": name, "tags": tags or {}, "createdDate": utcnow() - age,
+        }
+
+    def __call__(self, region: str) -> "StubRegionClient":
+        return StubRegionClient(self, region)
+
+
+class StubRegionClient:
+    def __init__(self, stub: StubApiGatewayClient, region: str):
+        self.stub = stub
+        self.region = region
+
+    def get_rest_apis(self, limit: int, position: str = None) -> dict:
+        if self.region in self.stub.failing_regions:
+            raise RuntimeError("AccessDenied")
+        items = list(self.stub.apis.get(self.region, {}).values())
+        start = int(position or 0)
+        response = {"items": items[start:start + self.stub.page_size]}
+        if start + self.stub.page_size < len(items):
+            response["position"] = str(start + self.stub.page_size)
+        return response
+
+    def delete_rest_api(self, restApiId: str) -> dict:
+        del self.stub.apis[self.region][restApiId]
+        self.stub.deleted.append(restApiId)
+        return {}
+
+    def get_stage(self, restApiId: str, stageName: str) -> dict:
+        if restApiId not in self.stub.apis.get(self.region, {}):
+            raise RuntimeError("NotFoundException")
+        return {"stageName": stageName}
+
+
+@pytest.fixture
+def stub() -> StubApiGatewayClient:
+    return StubApiGatewayClient()
+
+
+@pytest.fixture
+def registry(stub) -> GatewayRegistry:
+    registry = GatewayRegistry(":memory:", owner="node-a", client_factory=stub,
+                               sweep_grace=timedelta(hours=24))
+    registry.open()
+    yield registry
+    registry.close()
+
+
+def other_registry(registry: GatewayRegistry, owner: str) -> GatewayRegistry:
+    # Another process on the same registry database
+    other = GatewayRegistry(registry.path, owner=owner, client_factory=registry.client_factory,
+                            sweep_grace=registry.sweep_grace)
+    other.engine = registry.engine
+    other.registry_id = registry.registry_id
+    return other
+
+
+def add_gateway(registry: GatewayRegistry, stub: StubApiGatewayClient, rest_api_id: str,
+                source_uri: str = SOURCE_URI) -> ApiGateway:
+    stub.add_api(REGION, rest_api_id, registry.tags)
+    gateway = ApiGateway(source_uri, REGION, rest_api_id=rest_api_id, client_factory=stub)
+    registry.add(gateway)
+    return gateway
+
+
+def set_record(registry: GatewayRegistry, rest_api_id: str, **values):
+    with registry.engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.update(GatewayRecord)
+            .where(GatewayRecord.rest_api_id == rest_api_id)
+            .values(**values)
+        )
+
+
+def get_record(registry: GatewayRegistry, rest_api_id: str) -> GatewayRecord:
+    with registry.engine.connect() as connection:
+        return connection.execute(
+            sqlalchemy.select(GatewayRecord).where(GatewayRecord.rest_api_id == rest_api_id)
+        ).first()
+
+
+def test_adopt_released_gateways(registry, stub):
+    add_gateway(registry, stub, "api1")
+    add_gateway(registry, stub, "api2")
+    registry.release(["api1", "api2"])
+
+    other = other_registry(registry, "node-b")
+    gateways = other.adopt(SOURCE_URI, 5)
+    assert sorted(gateway.rest_api_id for gateway in gateways) == ["api1", "api2"]
+    assert gateways[0].endpoint.endswith(".execute-api.us-east-1.amazonaws.com/default")
+    assert get_record(registry, "api1").owner == "node-b"
+
+
+def test_adopt_respects_limit_origin_and_health(registry, stub):
+    add_gateway(registry, stub, "api1")
+    add_gateway(registry, stub, "api2")
+    add_gateway(registry, stub, "api3", source_uri="https://other.example")
+    add_gateway(registry, stub, "api4")
+    registry.mark_unhealthy("api4")
+    registry.release(["api1", "api2", "api3", "api4"])
+
+    gateways = other_registry(registry, "node-b").adopt(SOURCE_URI, 1)
+    assert len(gateways) == 1
+    assert gateways[0].rest_api_id in ("api1", "api2")
+
+
+def test_adopt_skips_gateways_of_live_owners(registry, stub):
+    add_gateway(registry, stub, "api1")
+    assert other_registry(registry, "node-b").adopt(SOURCE_URI, 5) == []
+    # The owner itself does not adopt what it already uses
+    assert registry.adopt(SOURCE_URI, 5) == []
+
+
+def test_adopt_expired_leases(registry, stub):
+    add_gateway(registry, stub, "api1")
+    stale = utcnow() - timedelta(seconds=3 * registry.heartbeat_interval + 1)
+    set_record(registry, "api1", heartbeat_at=stale)
+
+    gateways = other_registry(registry, "node-b").adopt(SOURCE_URI, 5)
+    assert [gateway.rest_api_id for gateway in gateways] == ["api1"]
+
+
+def test_adopt_gateways_of_dead_local_processes(registry, stub):
+    add_gateway(registry, stub, "api1")
+    set_record(registry, "api1", owner=dead_owner())
+
+    gateways = other_registry(registry, "node-b").adopt(SOURCE_URI, 5)
+    assert [gateway.rest_api_id for gateway in gateways] == ["api1"]
+
+
+def test_adopt_drops_deleted_apis(registry, stub):
+    add_gateway(registry, stub, "api1")
+    registry.release(["api1"])
+    del stub.apis[REGION]["api1"]
+
+    assert other_registry(registry, "node-b").adopt(SOURCE_URI, 5) == []
+    assert get_record(registry, "api1") == None
+
+
+def test_claim_is_conditional_on_the_owner_seen(registry, stub):
+    add_gateway(registry, stub, "api1")
+    registry.release(["api1"])
+    with registry.engine.connect() as connection:
+        record = connection.execute(sqlalchemy.select(GatewayRecord)).first()
+
+    first, second = other_registry(registry, "node-b"), other_registry(registry, "node-c")
+    assert first._GatewayRegistry__claim(record)
+    assert not second._GatewayRegistry__claim(record)
+    assert get_record(registry, "api1").owner == "node-b"
+
+
+def test_release_only_own_gateways(registry, stub):
+    add_gateway(registry, stub, "api1")
+    other_registry(registry, "node-b").release(["api1"])
+    assert get_record(registry, "api1").owner == "node-a"
+    registry.release(["api1"])
+    assert get_record(registry, "api1").owner == None
+
+
+def test_heartbeat_only_own_gateways(registry, stub):
+    add_gateway(registry, stub, "api1")
+    add_gateway(registry, stub, "api2")
+    old = utcnow() - timedelta(minutes=30)
+    set_record(registry, "api1", heartbeat_at=old)
+    set_record(registry, "api2", heartbeat_at=old, owner="node-b")
+
+    registry.heartbeat()
+    assert get_record(registry, "api1").heartbeat_at > old
+    assert get_record(registry, "api2").heartbeat_at == old
+
+
+def test_sweep_registered_gateways(registry, stub):
+    add_gateway(registry, stub, "unhealthy")
+    add_gateway(registry, stub, "idle")
+    add_gateway(registry, stub, "waiting")
+    add_gateway(registry, stub, "in-use")
+    registry.mark_unhealthy("unhealthy")
+    registry.release(["unhealthy", "idle", "waiting"])
+    set_record(registry, "idle", heartbeat_at=utcnow() - timedelta(hours=25))
+
+    assert registry.sweep([REGION]) == 2
+    assert sorted(stub.deleted) == ["idle", "unhealthy"]
+    assert get_record(registry, "idle") == None
+    assert get_record(registry, "waiting") != None
+    assert get_record(registry, "in-use") != None
+
+
+def dead_owner() -> str:
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return f"{socket.gethostname()}-{process.pid}"
+
+
+def add_untracked_apis(registry: GatewayRegistry, stub: StubApiGatewayClient):
+    ours = registry.tags
+    stub.add_api(REGION, "tagged-old", ours, age=timedelta(minutes=11))
+    stub.add_api(REGION, "tagged-new", ours, age=timedelta(minutes=1))
+    stub.add_api(REGION, "untagged-old", age=timedelta(hours=25))
+    stub.add_api(REGION, "untagged-new", age=timedelta(hours=1))
+    stub.add_api(REGION, "foreign", {REGISTRY_TAG: "another-registry"}, age=timedelta(days=7))
+    stub.add_api(REGION, "unrelated", age=timedelta(days=7), name="someone-else")
+    # Created without a registry, by a running and by a dead process
+    stub.add_api(REGION, "owned-live", owner_tags("other-host-1"), age=timedelta(days=7))
+    stub.add_api(REGION, "owned-here", owner_tags(process_owner()), age=timedelta(days=7))
+    stub.add_api(REGION, "owned-dead", owner_tags(dead_owner()), age=timedelta(minutes=1))
+
+
+def test_sweep_untracked_apis(registry, stub):
+    add_untracked_apis(registry, stub)
+    assert registry.sweep([REGION]) == 2
+    assert sorted(stub.deleted) == ["owned-dead", "tagged-old"]
+
+
+def test_sweep_untagged_apis_when_enabled(registry, stub):
+    registry.sweep_untagged = True
+    add_untracked_apis(registry, stub)
+    assert registry.sweep([REGION]) == 3
+    assert sorted(stub.deleted) == ["owned-dead", "tagged-old", "untagged-old"]
+
+
+def test_new_apis_are_tagged(registry):
+    assert registry.tags == {REGISTRY_TAG: registry.registry_id, OWNER_TAG: "node-a"}
+    assert owner_tags() == {OWNER_TAG: process_owner()}
+
+
+def test_sweep_continues_past_failing_regions(registry, stub):
+    stub.failing_regions.add("eu-west-1")
+    stub.add_api(REGION, "tagged-old", registry.tags, age=timedelta(minutes=11))
+    assert registry.sweep(["eu-west-1", REGION]) == 1
+    assert stub.deleted == ["tagged-old"]
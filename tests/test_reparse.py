@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from sqlalchemy.orm import Session as SqlSession
+
+from benchmark.__main__ import count_without_region, new_egress
+from benchmark.server import SiteSpec, serve
+from crawler.archive import ResponseArchive
+from crawler.common import config
+from crawler.corporate import Corporate, CorporateCrawler
+from crawler.frontier import Frontier
+from crawler.parser import ParsingEngine
+from crawler.ratelimit import RateLimiter
+from crawler.region import RegionCrawler
+from crawler.reparse import Reparser
+from crawler.storage import create_storage_engine
+
+SPEC = SiteSpec(provinces=2, districts=2, wards=2, corporates=10, latency=0.0)
+
+
+@pytest.fixture
+def crawler_config(monkeypatch, tmp_path):
+    # Sitemap discovery against the stand-in origin, with an archive
+    monkeypatch.setattr(config, "discovery", "sitemap")
+    monkeypatch.setattr(config, "connections_per_host", 0)
+    monkeypatch.setattr(config, "rate_limiter", RateLimiter(200, 50, 800))
+    monkeypatch.setattr(config, "parser", ParsingEngine(1, "thread"))
+    monkeypatch.setattr(config, "archive", ResponseArchive(tmp_path / "archive"))
+    monkeypatch.setattr(config, "connector", None)
+    # Replaced once the stand-in origin is up
+    monkeypatch.setattr(config, "egress", config.egress)
+    yield config
+    config.parser.close()
+    config.archive.close()
+
+
+def count_corporates(engine) -> int:
+    with SqlSession(engine) as session:
+        return session.query(Corporate).count()
+
+
+async def crawl_and_reparse(tmp_path) -> dict[str, int]:
+    runner = await serve(SPEC)
+    host = f"127.0.0.1:{runner.addresses[0][1]}"
+    config.egress = new_egress("gateway", host, 2)
+    engine = create_storage_engine(f"sqlite:///{tmp_path / 'crawl.db'}")
+    try:
+        await config.start_egress()
+        frontier = Frontier(engine, resume=False)
+        wards = RegionCrawler(engine, frontier).crawl_wards()
+        await CorporateCrawler(engine, frontier).crawl(wards)
+        config.archive.flush()
+
+        # Into a fresh database, and over the crawled one
+        fresh_engine = create_storage_engine(f"sqlite:///{tmp_path / 'reparse.db'}")
+        await Reparser(config.archive, fresh_engine).reparse()
+        crawled_without_region = count_without_region(engine)
+        await Reparser(config.archive, engine).reparse()
+    finally:
+        await config.close_egress()
+        await config.close_connector()
+        await runner.cleanup()
+
+    return {
+        "corporates": count_corporates(engine),
+        "crawled_without_region": crawled_without_region,
+        "reparsed": count_corporates(fresh_engine),
+        "reparsed_without_region": count_without_region(fresh_engine),
+        "rereparsed_without_region": count_without_region(engine),
+    }
+
+
+def test_sitemap_regions_survive_reparse(crawler_config, tmp_path):
+    counts = asyncio.run(crawl_and_reparse(tmp_path))
+    expected = SPEC.provinces * SPEC.districts * SPEC.wards * SPEC.corporates
+    assert counts == {
+        "corporates": expected,
+        "crawled_without_region": 0,
+        "reparsed": expected,
+        "reparsed_without_region": 0,
+        "rereparsed_without_region": 0,
+    }
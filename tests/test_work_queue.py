@@ -0,0 +1,155 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+import sqlalchemy
+
+from crawler.storage import StorageWriter, create_storage_engine
+from crawler.work_queue import DONE, FAILED, LEASED, PENDING, WorkItem, WorkQueue, utcnow
+
+KIND = "region"
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_storage_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def queue(engine) -> WorkQueue:
+    return WorkQueue(engine, node_id="node-a", lease_seconds=60, max_attempts=2)
+
+
+def other_queue(queue: WorkQueue, node_id: str) -> WorkQueue:
+    # Another node on the same database
+    return WorkQueue(queue.storage_engine, node_id=node_id, lease_seconds=60,
+                     max_attempts=queue.max_attempts)
+
+
+def set_item(queue: WorkQueue, key: str, **values):
+    with queue.storage_engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.update(WorkItem)
+            .where(WorkItem.kind == KIND, WorkItem.key == key)
+            .values(**values)
+        )
+
+
+def get_item(queue: WorkQueue, key: str) -> WorkItem:
+    with queue.storage_engine.connect() as connection:
+        return connection.execute(
+            sqlalchemy.select(WorkItem).where(WorkItem.kind == KIND, WorkItem.key == key)
+        ).first()
+
+
+def expire(queue: WorkQueue, key: str):
+    set_item(queue, key, lease_expires_at=utcnow() - timedelta(seconds=1))
+
+
+async def put_done(queue: WorkQueue, key: str):
+    async with StorageWriter(queue.storage_engine) as writer:
+        queue.register(writer)
+        await queue.put_done(writer, KIND, key)
+
+
+def test_enqueue_keeps_known_items(queue):
+    queue.enqueue(KIND, ["a", "b", "a"])
+    set_item(queue, "a", status=DONE)
+    queue.enqueue(KIND, ["a", "c"])
+    assert [queue.status(KIND, key) for key in "abc"] == [DONE, PENDING, PENDING]
+    assert queue.remaining(KIND) == 2
+
+
+def test_claims_are_exclusive(queue):
+    queue.enqueue(KIND, ["a", "b", "c"])
+    other = other_queue(queue, "node-b")
+    assert queue.claim(KIND, 2) == ["a", "b"]
+    assert other.claim(KIND, 2) == ["c"]
+    assert queue.claim(KIND, 2) == []
+    assert get_item(queue, "a").owner == "node-a"
+    assert get_item(queue, "c").owner == "node-b"
+    assert get_item(queue, "c").status == LEASED
+
+
+def test_reclaim_expired_leases(queue):
+    queue.enqueue(KIND, ["a"])
+    queue.claim(KIND)
+    other = other_queue(queue, "node-b")
+    assert other.claim(KIND) == []
+
+    expire(queue, "a")
+    assert other.claim(KIND) == ["a"]
+    item = get_item(queue, "a")
+    assert (item.owner, item.attempts) == ("node-b", 2)
+    assert item.lease_expires_at > utcnow()
+
+
+def test_heartbeat_extends_own_leases(queue):
+    queue.enqueue(KIND, ["a", "b"])
+    queue.claim(KIND)
+    other_queue(queue, "node-b").claim(KIND)
+    soon = utcnow() + timedelta(seconds=1)
+    set_item(queue, "a", lease_expires_at=soon)
+    set_item(queue, "b", lease_expires_at=soon)
+
+    assert queue.extend_leases() == 1
+    assert get_item(queue, "a").lease_expires_at > soon + timedelta(seconds=30)
+    assert get_item(queue, "b").lease_expires_at == soon
+
+
+def test_release_only_own_items(queue):
+    queue.enqueue(KIND, ["a"])
+    queue.claim(KIND)
+    other_queue(queue, "node-b").release(KIND, "a")
+    assert queue.status(KIND, "a") == LEASED
+    queue.release(KIND, "a")
+    item = get_item(queue, "a")
+    assert (item.status, item.lease_expires_at) == (PENDING, None)
+
+
+def test_give_up_after_max_attempts(queue):
+    queue.enqueue(KIND, ["a"])
+    for _ in range(queue.max_attempts):
+        assert queue.claim(KIND) == ["a"]
+        queue.release(KIND, "a")
+    assert queue.status(KIND, "a") == FAILED
+    assert queue.claim(KIND) == []
+    assert queue.remaining(KIND) == 0
+
+
+def test_release_all_own_items(queue):
+    queue.enqueue(KIND, ["a", "b"])
+    queue.claim(KIND)
+    other_queue(queue, "node-b").claim(KIND)
+    assert queue.release_all() == 1
+    assert [queue.status(KIND, key) for key in "ab"] == [PENDING, LEASED]
+
+
+def test_complete_only_own_items(queue):
+    queue.enqueue(KIND, ["a"])
+    queue.claim(KIND)
+    expire(queue, "a")
+    other = other_queue(queue, "node-b")
+    other.claim(KIND)
+
+    queue.complete(KIND, "a")
+    assert queue.status(KIND, "a") == LEASED
+    other.complete(KIND, "a")
+    assert queue.status(KIND, "a") == DONE
+
+
+def test_put_done_only_own_items(queue):
+    queue.enqueue(KIND, ["a", "b"])
+    queue.claim(KIND, 2)
+    expire(queue, "b")
+    other_queue(queue, "node-b").claim(KIND)
+
+    asyncio.run(put_done(queue, "a"))
+    asyncio.run(put_done(queue, "b"))
+    item = get_item(queue, "a")
+    assert (item.status, item.owner, item.lease_expires_at) == (DONE, "node-a", None)
+    item = get_item(queue, "b")
+    assert (item.status, item.owner) == (LEASED, "node-b")
+    assert item.lease_expires_at > utcnow()